@@ -0,0 +1,70 @@
+# Copyright (c) 2023 Bundesanstalt für Materialforschung und -prüfung, see LICENSE file
+# Fuses the measurement rays of many sweeps (written by rigs with a configured pose) into a voxel grid and localizes the source.
+# Example: python ./fuse_rays.py "./campaign_2024/*_rays.npy" --voxel-size 0.5 --output fused.npz
+# Example: python ./fuse_rays.py "./campaign_2024/*.json" --method nnls
+
+import argparse
+import glob
+import json
+import logging
+
+import numpy as np
+
+import gascamera.localization
+import gascamera.rays
+
+logger = logging.getLogger(__name__)
+
+
+def load_rays(filename: str) -> np.ndarray:
+    """Loads a ray file, or the rays of an experiment JSON file with pose."""
+    if filename.endswith(".json"):
+        with open(filename, 'r') as json_file:
+            experiment = json.load(json_file)
+        if not experiment.get("pose"):
+            logger.warning(f"skipping {filename}, no pose")
+            return np.zeros(0, gascamera.rays.RAY_DTYPE)
+        return gascamera.rays.experiment_rays(experiment)
+    return gascamera.rays.load_rays(filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fuse measurement rays into a voxel grid for source localization.")
+    parser.add_argument("patterns", nargs="+", help="ray files (*_rays.npy), experiment JSON files with pose or glob patterns")
+    parser.add_argument("--method", choices=("backprojection",) + gascamera.localization.SOLVERS, default="backprojection",
+                        help="backprojection (fast, blurred) or a tomographic solver (default: backprojection)")
+    parser.add_argument("--voxel-size", type=float, default=0.5, help="edge length of the voxels in meters (default: 0.5)")
+    parser.add_argument("--max-range", type=float, default=50.0, help="length of rays without range in meters (default: 50)")
+    parser.add_argument("--height", type=float, nargs=2, default=(-2.0, 10.0), metavar=("MIN", "MAX"),
+                        help="vertical extent of the grid in meters (default: -2 10)")
+    parser.add_argument("--output", default="fused.npz", help="voxel grid to write (default: fused.npz)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    files = sorted({filename for pattern in args.patterns for filename in glob.glob(pattern)})
+    rays = np.concatenate([load_rays(filename) for filename in files]) if files else np.zeros(0, gascamera.rays.RAY_DTYPE)
+    if len(rays) == 0:
+        logger.error("no rays found")
+        return
+    logger.info(f"loaded {len(rays)} rays from {len(files)} files")
+
+    # horizontal extent: all ray origins plus the ray length, vertical extent as given
+    grid = gascamera.localization.grid_around(rays, args.voxel_size, args.max_range, tuple(args.height))
+    if args.method == "backprojection":
+        accumulator = gascamera.rays.VoxelAccumulator(grid.origin, grid.shape, grid.size, args.max_range)
+        accumulator.add(rays)
+        position, concentration = accumulator.localize()
+        accumulator.save(args.output)
+    else:
+        result = gascamera.localization.localize(rays, grid, args.max_range, args.method)
+        position, concentration = result.source, result.peak
+        np.savez_compressed(args.output, concentration=result.concentration, origin=grid.origin, size=grid.size,
+                            rays=result.rays, residual=result.residual)
+    logger.info(f"highest concentration {concentration:.1f} ppm at east {position[0]:.1f} m, "
+                f"north {position[1]:.1f} m, up {position[2]:.1f} m")
+    logger.info(f"voxel grid written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+# Copyright (c) 2023 Bundesanstalt für Materialforschung und -prüfung, see LICENSE file
+# Background subtraction and drift correction of the column densities from measurements of clean reference cells.
+
+from logging import getLogger
+from typing import NamedTuple, Sequence, Tuple
+
+import numpy as np
+
+logger = getLogger(__name__)
+
+
+class BaselineSettings(NamedTuple):
+    """
+    Reference cells (x_step, y_step) are known to be free of the target gas, their column densities are the ambient
+    background plus the sensor drift. The first one is measured again every interval visited cells (0: only when the
+    sweep visits it), and a polynomial of order in time is fitted to all reference measurements.
+    Without reference cells, no correction is applied.
+    """
+    reference_cells: Sequence[Tuple[int, int]] = ()
+    interval: int = 0
+    order: int = 1 # 0: constant background, 1: linear drift
+
+
+def fit_baseline(times, values, order: int = 1) -> np.ndarray:
+    """
+    Returns the polynomial coefficients (highest power first, see numpy.polyval()) of the baseline fitted to the
+    reference measurements. The order is reduced if there are not enough measurements at distinct times.
+    """
+    times = np.asarray(times, dtype=float)
+    values = np.asarray(values, dtype=float)
+    valid = ~(np.isnan(times) | np.isnan(values))
+    times, values = times[valid], values[valid]
+    if len(values) == 0:
+        raise ValueError("no reference measurements to fit the baseline")
+    order = min(order, len(np.unique(times)) - 1)
+    if order < 1:
+        return np.array([np.mean(values)])
+    return np.polyfit(times, values, order)
+
+
+def correct(column_densities, cell_times, coefficients) -> np.ndarray:
+    """
+    Returns the column densities minus the baseline at the measurement time of every cell, for the whole grid at once.
+    Cells without measurement time are NaN.
+    """
+    grid = np.asarray(column_densities, dtype=float)
+    times = np.array([[np.nan if time is None else time for time in row] for row in cell_times], dtype=float)
+    return grid - np.polyval(coefficients, times)
+
+
+def reference_measurements(cell_times, column_densities, reference_cells: Sequence[Tuple[int, int]],
+                           extra: Sequence[Tuple[float, float]] = ()) -> Tuple[list, list]:
+    """
+    Returns the times and values of all reference measurements: the reference cells of the grid plus the extra
+    (time, value) measurements of the periodic re-measurement.
+    """
+    times = [cell_times[y_step][x_step] for x_step, y_step in reference_cells]
+    values = [column_densities[y_step][x_step] for x_step, y_step in reference_cells]
+    times += [time for time, _ in extra]
+    values += [value for _, value in extra]
+    return [np.nan if time is None else time for time in times], values
@@ -0,0 +1,758 @@
+# Copyright (c) 2023 Bundesanstalt für Materialforschung und -prüfung, see LICENSE file
+# The sweep engine of the virtual gas camera as instantiable object, one instance per camera rig (gimbal, camera, sensors).
+
+import os
+import select
+import sys
+import threading
+from datetime import datetime
+from logging import getLogger
+from time import perf_counter, sleep, time
+from typing import NamedTuple, Sequence, Tuple, Union
+
+import cv2
+import numpy as np
+import serial
+
+import gascamera.baseline
+import gascamera.detection
+import gascamera.dwell
+import gascamera.export
+import gascamera.geometry
+import gascamera.mosaic
+import gascamera.overlay
+import gascamera.quality
+import gascamera.rays
+import gascamera.recording
+import gascamera.sensors
+import gascamera.stream
+import gascamera.tuning
+import simplebgc.gimbal
+from simplebgc.gimbal import ControlMode, RealtimeDataField
+
+logger = getLogger(__name__)
+
+DEGREE_FACTOR = 0.02197265625 # conversion factor for angles returned by simplebgc
+# fields polled while settling and after it, the frame angles have the zero and signs of the angle_rel_frame control
+ANGLE_FIELDS = RealtimeDataField.imu_angles | RealtimeDataField.target_angles | RealtimeDataField.stator_rotor_angle
+
+
+class CameraConfig(NamedTuple):
+    """
+    All settings of one camera rig. The defaults are the settings of the original single rig setup.
+    Rigs running on the same host need their own serial ports, capture device and stream port.
+    """
+    name: str = None # prefix of the experiment files and of the log messages, needed when running several rigs
+    # gas sensors as (name, serial port, boresight yaw, boresight pitch), sampled concurrently at every visited cell
+    # the first one is the main sensor on the beam axis (see beam_offset_x/y), further Laser Falcons are given with the
+    # direction of their beam relative to the main beam in degrees, e.g. ("laserfalcon2", "/dev/ttyUSB2", 1.5, 0.0)
+    # cells already covered by a sensor are not visited again, so sensors pointing at adjacent cells speed up the sweep
+    sensors: Sequence[Tuple[str, str, float, float]] = (("laserfalcon", "/dev/ttyUSB1", 0.0, 0.0),)
+    gimbal_port: str = "/dev/ttyUSB0"
+    capture_device: Union[int, str] = 0
+    # session recording/replay: set record_session to a directory to record all serial traffic and camera frames,
+    # set replay_session to a recorded directory to run offline without devices
+    record_session: str = None
+    replay_session: str = None
+    replay_speed: float = None # None replays as fast as possible, 1.0 in real time
+    # live stream, see gascamera.stream.StreamConfig, and the running column density overlay in it
+    stream: gascamera.stream.StreamConfig = gascamera.stream.StreamConfig()
+    live_overlay: bool = True
+    # direction of the gimbal (degrees) at the center of the sweep, the "neutral" view of this rig
+    center_yaw: float = 0.0
+    center_pitch: float = 0.0
+    # pose of the rig in a world frame, if given the measurement rays are exported for fusion (see gascamera.rays)
+    pose: gascamera.rays.RobotPose = None
+    range_estimate: float = None # meters to the reflecting surface, None if unknown
+    speed: float = 720 # degree/s for direct moves (neutral, calibration)
+    fov_yaw: float = 22.7 # degrees full field of view, 0,0473 deg/pixel * 480
+    fov_pitch: float = 18.0 # degrees full field of view, 0,0563 deg/pixel * 320
+    x_steps: int = 15
+    y_steps: int = 15
+    beam_offset_x: int = -28 # pixels, position of the measurement beam relative to the image center
+    beam_offset_y: int = +5 # pixels
+    calibration_file: str = "calibration.json" # written by a calibration run, if missing the calibration is derived from the FOV
+    calibration_steps: int = 5 # calibration run uses calibration_steps * calibration_steps angles
+    # registration of the saved pixels against the neutral image: "phase", "orb" or None (fixed ROI)
+    mosaic_registration: str = "phase"
+    # settle settings, None selects the defaults (less strict with registration), a settle profile overrides them
+    angle_settle_threshold: float = None # degrees
+    angle_settle_delay: float = 0.01 # seconds, a poll of the angle fields takes about 2 ms at 115200 baud
+    video_settle_threshold: float = None # mean pixel difference of frames
+    video_settle_delay: float = 0.2 # seconds
+    settle_profile: str = "settle_profile.json" # written by tune_settling.py
+    # motion planning of the sweep, use a single speed for sessions that are recorded for replay
+    motion_speeds: Sequence[float] = (180, 360, 720) # degree/s, candidate maximum speeds
+    motion_max_acceleration: float = 720 # degree/s^2
+    # while idle the gimbal holds neutral: the target is sent once and only sent again if the angle error exceeds
+    # hold_tolerance or after hold_keepalive, the angles are polled every hold_check_interval
+    hold_tolerance: float = 1.0 # degrees
+    hold_keepalive: float = 60.0 # seconds
+    hold_check_interval: float = 2.0 # seconds
+    # quality scoring of the cells after the sweep, flagged cells are measured again and the better measurement is kept
+    quality_thresholds: gascamera.quality.QualityThresholds = gascamera.quality.QualityThresholds()
+    remeasure_flagged_cells: bool = True
+    # dwell-time scheduling within a time budget per sweep: repeated measurements and stricter settling where they
+    # reduce the noise most, expected and achieved noise per cell are stored in the experiment (dwell)
+    dwell: gascamera.dwell.DwellSettings = gascamera.dwell.DwellSettings()
+    # background/drift correction from clean reference cells, the corrected maps are stored next to the raw ones
+    baseline: gascamera.baseline.BaselineSettings = gascamera.baseline.BaselineSettings()
+    # online plume detection, alerts are logged, sent to local listeners, flagged in the live stream and can trigger a dense re-scan
+    detection: gascamera.detection.DetectionSettings = gascamera.detection.DetectionSettings()
+    # reconstruction of the overlay at image resolution: "block", "idw", "kriging" or "deconvolution"
+    overlay_reconstruction: str = "block"
+    # export of results, written in background threads: "png", "webp" (lossless) or "npy" (raw arrays)
+    export_image_format: str = "png"
+    export_compression: int = 1
+    output_dir: str = "."
+
+
+class VirtualGasCamera:
+    """
+    One camera rig: gimbal, camera with live stream and gas sensors. All device state lives in the instance, so
+    several rigs can run in one process (threads) or in separate processes, see gascamera.fleet.
+    Typical use is run(), or open(), wait_for_start(), sweep(), export() and close() step by step.
+    """
+
+    def __init__(self, config: CameraConfig = CameraConfig()) -> None:
+        self.config = config
+        self.logger = logger.getChild(config.name) if config.name else logger
+        self.experiment = {} # dict for holding all experiment data
+        # direction of the gimbal at the center of the sweep, can be changed between sweeps (e.g. panorama blocks)
+        self.center_yaw = config.center_yaw
+        self.center_pitch = config.center_pitch
+        self.frame_current = None # most recent frame, updated by the live stream thread
+        self.progress = {"phase": "idle", "cells_done": 0, "cells_total": 0} # read by other threads, e.g. gascamera.server
+        self.cell_listeners = [] # called with a dict per measured cell from the sweep thread
+        self._abort = threading.Event()
+        self.calibration = None
+        self.settle_settings = None # gascamera.tuning.SettleProfile
+        self.neutral_image = None
+        self.assembled_image = None
+        self.sensor_array = None
+        self.gimbal = None
+        self.live_overlay = None
+        self._gimbal_connection = None
+        self._capture = None
+        self._out = None
+        self._stream_task = None
+
+    def __enter__(self) -> "VirtualGasCamera":
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def open(self) -> None:
+        """Opens all devices, starts the live stream and loads calibration and settle profile."""
+        config = self.config
+        if config.replay_session is not None:
+            replay = gascamera.recording.SessionReplay(config.replay_session, config.replay_speed)
+            sensor_connections = [replay.serial(name) for name, _, _, _ in config.sensors]
+            self._gimbal_connection = replay.serial("gimbal")
+            self._capture = replay.capture()
+        else:
+            sensor_connections = [serial.Serial(port, baudrate=19200, timeout=2) for _, port, _, _ in config.sensors]
+            self._gimbal_connection = serial.Serial(config.gimbal_port, baudrate=115200, timeout=2)
+            self._capture = cv2.VideoCapture(config.capture_device)
+            if config.record_session is not None:
+                recorder = gascamera.recording.SessionRecorder(config.record_session)
+                sensor_connections = [recorder.serial(name, connection) for (name, _, _, _), connection in zip(config.sensors, sensor_connections)]
+                self._gimbal_connection = recorder.serial("gimbal", self._gimbal_connection)
+                self._capture = recorder.capture(self._capture)
+
+        # open laser falcons
+        self.logger.info("opening gas sensors")
+        self.sensor_array = gascamera.sensors.SensorArray([
+            gascamera.sensors.LaserFalconSensor(name, connection, boresight_yaw, boresight_pitch)
+            for (name, _, boresight_yaw, boresight_pitch), connection in zip(config.sensors, sensor_connections)])
+        for sensor in self.sensor_array.sensors:
+            if sensor.version != "SA3C30A":
+                self.logger.warning(f"unexpected version for laser falcon device {sensor.name}")
+        sensor_settings = self.sensor_array.settings()
+        self.experiment["laserfalcon_settings"] = sensor_settings[config.sensors[0][0]]
+        self.experiment["sensors"] = [{"name": name, "boresight_yaw": boresight_yaw, "boresight_pitch": boresight_pitch, "settings": sensor_settings[name]}
+                                      for name, _, boresight_yaw, boresight_pitch in config.sensors]
+
+        # open gimbal
+        self.logger.info("opening gimbal")
+        self.gimbal = simplebgc.gimbal.Gimbal(connection=self._gimbal_connection)
+        self.gimbal.set_realtime_fields(ANGLE_FIELDS)
+
+        # get video dimensions and fps
+        self.frame_width = int(self._capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.frame_height = int(self._capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.fps = int(self._capture.get(cv2.CAP_PROP_FPS))
+        self.logger.debug(f"video width, height, fps: {self.frame_width},{self.frame_height},{self.fps}")
+
+        # start separate thread for live video
+        self._out = gascamera.stream.StreamBackend(config.stream, self.frame_width, self.frame_height, self.fps)
+        self.live_overlay = gascamera.overlay.LiveOverlay(self.frame_width, self.frame_height) if config.live_overlay else None
+        self._stream_task = threading.Thread(target=self.live_stream, name=f"stream_{config.name}" if config.name else "stream")
+        self._stream_task.start()
+
+        self.settle_settings = self._settle_settings()
+        self.experiment["settle_settings"] = self.settle_settings._asdict()
+
+        # load angle to pixel calibration
+        if os.path.exists(config.calibration_file):
+            self.logger.info(f"loading calibration from {config.calibration_file}")
+            self.calibration = gascamera.geometry.Calibration.load(config.calibration_file)
+        else:
+            self.logger.info("no calibration file found, using calibration derived from FOV")
+            self.calibration = gascamera.geometry.Calibration.from_fov(self.frame_width, self.frame_height, config.fov_yaw,
+                                                                       config.fov_pitch, config.beam_offset_x, config.beam_offset_y)
+
+    def _settle_settings(self) -> gascamera.tuning.SettleProfile:
+        """Returns the settle settings from the config, overridden by the settle profile if it exists."""
+        config = self.config
+        if config.settle_profile is not None and os.path.exists(config.settle_profile):
+            self.logger.info(f"loading settle profile from {config.settle_profile}")
+            return gascamera.tuning.load_profile(config.settle_profile)
+        # residual pointing errors are measured and compensated by the registration, so the gimbal/video may settle less strictly
+        registration = config.mosaic_registration is not None
+        angle_threshold = config.angle_settle_threshold if config.angle_settle_threshold is not None else (0.2 if registration else 0.1)
+        video_threshold = config.video_settle_threshold if config.video_settle_threshold is not None else (20.0 if registration else 10.0)
+        return gascamera.tuning.SettleProfile(angle_threshold, config.angle_settle_delay, video_threshold, config.video_settle_delay)
+
+    def close(self) -> None:
+        """Stops the live stream and releases all devices."""
+        if self._stream_task is not None:
+            sleep(1) # allow buffer on receiver side to get final image
+            self._stream_task.streaming = False
+            self._stream_task.join()
+            self._stream_task = None
+        if self._capture is not None:
+            self._capture.release()
+            self._capture = None
+        if self._out is not None:
+            self._out.release()
+            self._out = None
+        if self.sensor_array is not None:
+            self.sensor_array.close() # also finishes the serial logs when recording
+            self.sensor_array = None
+        if self._gimbal_connection is not None:
+            self._gimbal_connection.close()
+            self._gimbal_connection = None
+
+    def live_stream(self) -> None:
+        """
+        Streams live video via the stream backend. Used in separate thread. If enabled, the live overlay is composited
+        onto the sent frames. Frames are read (and frame_current is updated) even if the backend does not stream.
+        """
+        capture, out_writer, overlay = self._capture, self._out, self.live_overlay
+        next_frame_time = 0
+        fps = int(capture.get(cv2.CAP_PROP_FPS))
+
+        self.logger.debug("starting live stream")
+        mythread = threading.current_thread()
+        while getattr(mythread, "streaming", True) and capture.isOpened() and out_writer.isOpened():
+            ret, frame = capture.read()
+            if ret:
+                # save frame for wait_video_settle()
+                self.frame_current = frame
+                # wait for correct time to send frame
+                while time() < next_frame_time:
+                    sleep(0.001)
+                if overlay is not None and out_writer.streaming:
+                    frame = overlay.apply(frame) # frame_current keeps the raw frame
+                out_writer.write(frame) # send frame to stream pipeline
+                next_frame_time = time() + (1/fps) # save at what time next frame is due
+            else:
+                self.logger.error(f"error getting frame. Return value from capture.read() was {ret}")
+                break
+        self.logger.debug("stopping live stream")
+
+    def wait_angle_error(self, threshold: float, check_delay: float) -> list:
+        """
+        Waits until the gimbal has settled using the difference between target angle and current angle as indicator.
+        If the angle error on all axes is below threshold (in degrees), the function returns. Else it blocks.
+        The check_delay specifies how often to query the gimbal angles.
+        Returns the trace of the largest angle error as list of [seconds since call, degrees] for tuning.
+        """
+        diff1 = threshold + 10
+        diff2 = diff1
+        diff3 = diff1
+        trace = []
+        start = perf_counter()
+
+        while abs(diff1) > threshold or abs(diff2) > threshold or abs(diff3) > threshold:
+            sleep(check_delay)
+            # only the angles are transferred, see ANGLE_FIELDS
+            angles = self.gimbal.get_realtime_data()
+            target, imu = angles["target_angles"], angles["imu_angles"]
+            diff1 = (target[0] - imu[0]) * DEGREE_FACTOR
+            diff2 = (target[1] - imu[1]) * DEGREE_FACTOR
+            diff3 = (target[2] - imu[2]) * DEGREE_FACTOR
+
+            trace.append([perf_counter() - start, max(abs(diff1), abs(diff2), abs(diff3))])
+
+            self.logger.debug(f"target angle error [deg]: {diff1}, {diff2}, {diff3}")
+        return trace
+
+    def wait_video_settle(self, threshold: float, check_delay: float) -> list:
+        """
+        Waits until the video input has settled (motion, automatic gain and white balance) using the difference between
+        consecutive frames from the camera (frame_current, updated by the live stream thread).
+        The check_delay specifies with which delay to compare the frames. As a consequence this is also the loop delay.
+        Returns the trace of the difference values as list of [seconds since call, difference] for tuning.
+        """
+        difference_value = None
+        trace = []
+        start = perf_counter()
+
+        while difference_value is None or difference_value > threshold:
+            frame_previous = self.frame_current # get current frame (filled by livestream thread)
+            sleep(check_delay)
+
+            # convert last two frames to grayscale
+            gray1 = cv2.cvtColor(self.frame_current, cv2.COLOR_BGR2GRAY) # frame current contains most recent frame at this point
+            gray2 = cv2.cvtColor(frame_previous, cv2.COLOR_BGR2GRAY) # frame saved previously above
+
+            # mean of the absolute differences between the two frames
+            difference_value = cv2.absdiff(gray1, gray2).mean()
+
+            trace.append([perf_counter() - start, float(difference_value)])
+
+            self.logger.debug(f"difference between frames: {difference_value}")
+        return trace
+
+    def settle(self) -> Tuple[list, list]:
+        """Waits for gimbal and video to settle with the current settle settings, returns both traces."""
+        angle_errors = self.wait_angle_error(self.settle_settings.angle_settle_threshold, self.settle_settings.angle_settle_delay)
+        frame_diffs = self.wait_video_settle(self.settle_settings.video_settle_threshold, self.settle_settings.video_settle_delay)
+        return angle_errors, frame_diffs
+
+    def _control_arguments(self, yaw: float, pitch: float) -> dict:
+        return dict(
+            pitch_mode=ControlMode.angle_rel_frame, pitch_speed=self.config.speed, pitch_angle=self.center_pitch + pitch,
+            yaw_mode=ControlMode.angle_rel_frame, yaw_speed=self.config.speed, yaw_angle=self.center_yaw + yaw)
+
+    def control(self, yaw: float, pitch: float) -> None:
+        """Moves the gimbal directly to yaw, pitch relative to the center of the sweep (degrees)."""
+        self.gimbal.control(**self._control_arguments(yaw, pitch))
+
+    def hold(self, yaw: float = 0, pitch: float = 0) -> None:
+        """
+        Moves the gimbal to yaw, pitch relative to the center of the sweep and holds it there while idle, see
+        simplebgc.gimbal.Gimbal.hold(). Call check_hold() every hold_check_interval until the next move.
+        """
+        self.gimbal.hold(self.config.hold_tolerance, self.config.hold_keepalive, **self._control_arguments(yaw, pitch))
+
+    def check_hold(self) -> bool:
+        """Sends the hold target again if the gimbal deviates or the keepalive is due, returns whether it was sent."""
+        return self.gimbal.check_hold()
+
+    def read_gimbal_angles(self) -> Tuple[float, float, float]:
+        """
+        Returns the angles of the gimbal relative to the frame (roll, pitch, yaw in degrees), i.e. in the convention of
+        the control commands and the cell angles. The IMU yaw has its own drifting zero and is not used for the rays.
+        """
+        roll, pitch, yaw = self.gimbal.get_realtime_data()["stator_rotor_angle"]
+        return roll * DEGREE_FACTOR, pitch * DEGREE_FACTOR, yaw * DEGREE_FACTOR
+
+    def run_calibration(self) -> gascamera.geometry.Calibration:
+        """
+        Runs a calibration sweep: the gimbal is moved to a grid of angles and the resulting image shifts are measured
+        against the neutral view. The fitted gascamera.geometry.Calibration is written to the calibration file and returned.
+        """
+        config = self.config
+        self.logger.info("starting calibration run")
+        self.control(0, 0)
+        self.settle()
+        reference_frame = self.frame_current
+
+        angles = gascamera.geometry.calibration_angles(config.fov_yaw, config.fov_pitch, config.calibration_steps)
+        shifts = []
+        for yaw, pitch in angles:
+            self.logger.info(f"calibration: moving to pitch {pitch:.2f} deg, yaw {yaw:.2f} deg")
+            self.control(yaw, pitch)
+            self.settle()
+            shifts.append(gascamera.geometry.measure_image_shift(reference_frame, self.frame_current))
+
+        self.control(0, 0)
+
+        # the beam offset can not be seen in the image shifts, keep the configured one
+        self.calibration = gascamera.geometry.fit_calibration(angles, shifts, self.frame_width, self.frame_height,
+                                                              config.beam_offset_x, config.beam_offset_y)
+        self.calibration.save(config.calibration_file)
+        self.logger.info(f"calibration saved to {config.calibration_file}")
+        return self.calibration
+
+    def wait_for_start(self) -> None:
+        """
+        Moves the gimbal to neutral and waits until enter is pressed, c and enter runs a calibration first.
+        The gimbal controller holds the angle by itself, so the neutral command is only sent again on a deviation or
+        after the keepalive interval (see hold()).
+        """
+        self.logger.info("press enter to start measurement, or c and enter to run a calibration")
+        self.hold(0, 0)
+        if self.config.replay_session is not None:
+            return # the replay starts right away
+        while True:
+            # wait for data on sys.stdin (keyboard), check the hold in between
+            if not select.select([sys.stdin], [], [], self.config.hold_check_interval)[0]:
+                self.check_hold()
+                continue
+            key = sys.stdin.readline().strip()
+            if key != "c":
+                break
+            self.run_calibration()
+            self.hold(0, 0)
+            self.logger.info("press enter to start measurement, or c and enter to run a calibration")
+
+    def abort(self) -> None:
+        """Requests the running sweep to stop after the current cell, it returns to neutral and keeps the data measured so far."""
+        self._abort.set()
+
+    def reset_experiment(self) -> None:
+        """Starts new experiment data for the next sweep, keeping the device information collected by open()."""
+        self.experiment = {key: value for key, value in self.experiment.items()
+                           if key in ("laserfalcon_settings", "sensors", "settle_settings")}
+
+    def _notify_cell(self, cell: dict) -> None:
+        for listener in self.cell_listeners:
+            try:
+                listener(cell)
+            except Exception:
+                self.logger.exception("cell listener failed")
+
+    def measure_until_valid(self, planner: simplebgc.gimbal.MotionPlanner, yaw: float, pitch: float, indices=None):
+        """
+        Takes a measurement with the sensors at indices (default: all) concurrently, failed measurements are retried
+        after repositioning the gimbal to yaw, pitch.
+        Returns the measurements and the lists of error codes of the failed attempts, both per sensor.
+        """
+        # reposition gimbal in hopes of clearing optically related errors
+        return self.sensor_array.measure(indices, reposition=lambda: planner.move_to(yaw, pitch))
+
+    def measure_reference(self, planner: simplebgc.gimbal.MotionPlanner, cell: gascamera.geometry.CellGeometry) -> float:
+        """Measures the reference cell with the main sensor and returns the median column density."""
+        curr_yaw, curr_pitch = self.center_yaw + cell.yaw, self.center_pitch + cell.pitch
+        self.logger.info(f"measuring reference cell {cell.x_step}, {cell.y_step}")
+        planner.move_to(curr_yaw, curr_pitch)
+        self.settle()
+        measurements, _ = self.measure_until_valid(planner, curr_yaw, curr_pitch, indices=[0])
+        return gascamera.quality.cell_statistics(measurements[0])["median"]
+
+    def dense_rescan(self, planner: simplebgc.gimbal.MotionPlanner, cell: gascamera.geometry.CellGeometry, sweep_start: float) -> dict:
+        """Measures a dense grid of points around cell with the main sensor (see gascamera.detection.rescan_points())."""
+        config = self.config
+        points = gascamera.detection.rescan_points(self.calibration, cell, config.detection.rescan_steps,
+                                                   config.detection.rescan_radius, config.x_steps, config.y_steps)
+        self.logger.info(f"dense re-scan of {len(points)} points around cell {cell.x_step}, {cell.y_step}")
+        measured = []
+        for yaw, pitch in points:
+            curr_yaw, curr_pitch = self.center_yaw + yaw, self.center_pitch + pitch
+            planner.move_to(curr_yaw, curr_pitch)
+            self.settle()
+            measurements, _ = self.measure_until_valid(planner, curr_yaw, curr_pitch, indices=[0])
+            statistics = gascamera.quality.cell_statistics(measurements[0])
+            measured.append({"yaw": curr_yaw, "pitch": curr_pitch, "median": statistics["median"], "mean": statistics["mean"],
+                             "time": perf_counter() - sweep_start})
+        return {"x_step": cell.x_step, "y_step": cell.y_step, "points": measured}
+
+    def _correct_baseline(self, reference_measurements: list) -> None:
+        """Fits the baseline to the reference measurements and stores the corrected maps next to the raw ones."""
+        experiment = self.experiment
+        settings = self.config.baseline
+        times, values = gascamera.baseline.reference_measurements(experiment["cell_times"], experiment["column_densities_median"],
+                                                                  settings.reference_cells, reference_measurements)
+        try:
+            coefficients = gascamera.baseline.fit_baseline(times, values, settings.order)
+        except ValueError:
+            self.logger.warning("no reference measurements, column densities are not corrected") # e.g. aborted sweep
+            return
+        self.logger.info(f"baseline from {len(values)} reference measurements: {coefficients}")
+        experiment["baseline"] = {"reference_cells": [list(cell) for cell in settings.reference_cells], "reference_times": times,
+                                  "reference_values": values, "coefficients": coefficients.tolist()}
+        for key in ("column_densities_mean", "column_densities_median"):
+            corrected = gascamera.baseline.correct(experiment[key], experiment["cell_times"], coefficients)
+            experiment[f"{key}_corrected"] = [[None if np.isnan(value) else float(value) for value in row] for row in corrected]
+
+    def sweep(self) -> dict:
+        """Runs a measurement sweep over all cells and returns the experiment data."""
+        config = self.config
+        experiment = self.experiment
+        x_steps, y_steps = config.x_steps, config.y_steps
+        live_overlay = self.live_overlay
+        center_yaw, center_pitch = self.center_yaw, self.center_pitch
+        self._abort.clear()
+        aborted = False
+        if live_overlay is not None:
+            live_overlay.reset() # cells of the previous sweep
+
+        # precompute angles and ROIs of all cells, so the sweep loop does no geometry math
+        cell_table = gascamera.geometry.build_cell_table(self.calibration, x_steps, y_steps)
+        experiment["calibration"] = self.calibration.to_dict()
+        experiment["sector"] = {"center_yaw": center_yaw, "center_pitch": center_pitch}
+        experiment["cell_angles"] = [[[center_yaw + cell.yaw, center_pitch + cell.pitch] for cell in cell_table[y_step * x_steps:(y_step + 1) * x_steps]]
+                                     for y_step in range(y_steps)]
+
+        column_densities_mean = [[0] * x_steps for _ in range(y_steps)]
+        column_densities_median = [[0] * x_steps for _ in range(y_steps)]
+
+        # return gimbal to neutral and save current view image
+        self.logger.info("saving reference view image")
+        self.control(0, 0)
+        self.settle()
+        self.neutral_image = self.frame_current
+        mosaic = gascamera.mosaic.MosaicBuilder(self.neutral_image, config.mosaic_registration) # assembles the pixels saved during measurement
+        registration_offsets = [[None] * x_steps for _ in range(y_steps)]
+        planner = simplebgc.gimbal.MotionPlanner(self.gimbal, config.motion_speeds, config.motion_max_acceleration,
+                                                 yaw=center_yaw, pitch=center_pitch) # starts at neutral
+        cell_telemetry = [] # settle traces and measurement quality per cell, used by tune_settling.py
+        cell_statistics = [[None] * x_steps for _ in range(y_steps)] # signal levels and sub-value spread per cell, used for quality scoring
+        cell_gimbal_angles = [[None] * x_steps for _ in range(y_steps)] # roll, pitch, yaw (frame) per cell, for the measurement rays
+        cell_times = [[None] * x_steps for _ in range(y_steps)] # seconds since sweep start of the measurement per cell, for drift correction
+        reference_measurements = [] # (seconds since sweep start, median) of the periodic reference re-measurement
+        detector = gascamera.detection.PlumeDetector(config.detection, x_steps, y_steps) if config.detection.enabled else None
+        notifier = gascamera.detection.AlertNotifier(config.detection, config.name) if config.detection.enabled else None
+        rescans = [] # dense re-scans around alerting cells
+
+        self.logger.info("starting measurement sweep")
+        beam_x, beam_y = self.calibration.angle_to_pixel(0, 0)
+        if live_overlay is not None:
+            live_overlay.set_target(beam_x, beam_y) # the beam spot stays at the same pixel while the view moves
+        # with several sensors, cells already covered by a sensor at an earlier position are skipped
+        sweep_plan = gascamera.sensors.plan_sweep(self.calibration, cell_table, self.sensor_array.sensors, x_steps, y_steps)
+        cells_by_step = {(cell.x_step, cell.y_step): cell for cell in cell_table}
+        visited_steps = {(cell.x_step, cell.y_step) for cell, _ in sweep_plan}
+        for cell in cell_table:
+            if (cell.x_step, cell.y_step) not in visited_steps:
+                mosaic.insert_neutral(cell)
+        cell_measurements = [[[] for _ in range(x_steps)] for _ in range(y_steps)] # statistics of all measurements of a cell, merged into cell_statistics
+        self.logger.info(f"visiting {len(sweep_plan)} of {len(cell_table)} cells with {len(self.sensor_array.sensors)} sensors")
+        experiment["start"] = datetime.now().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        sweep_start = perf_counter()
+        baseline = config.baseline
+        reference_cell = cells_by_step[tuple(baseline.reference_cells[0])] if baseline.reference_cells else None
+        scheduler = None
+        if config.dwell.time_budget is not None:
+            scheduler = gascamera.dwell.DwellScheduler.from_settings(config.dwell, [(cell.x_step, cell.y_step) for cell, _ in sweep_plan],
+                                                                     x_steps, y_steps)
+            self.logger.info(f"dwell schedule: {int(scheduler.planned.sum())} measurements planned within {config.dwell.time_budget} s")
+        self.progress = {"phase": "sweep", "cells_done": 0, "cells_total": len(sweep_plan)}
+        for index, (cell, sensor_targets) in enumerate(sweep_plan):
+            if self._abort.is_set():
+                self.logger.warning(f"sweep aborted after {index} of {len(sweep_plan)} cells")
+                aborted = True
+                break
+            if reference_cell is not None and baseline.interval > 0 and index > 0 and index % baseline.interval == 0:
+                reference_measurements.append((perf_counter() - sweep_start, self.measure_reference(planner, reference_cell)))
+            x_step, y_step = cell.x_step, cell.y_step
+            curr_pitch, curr_yaw = center_pitch + cell.pitch, center_yaw + cell.yaw # the beam points at the middle of the subframe
+
+            cell_start = perf_counter()
+            self.logger.info(f"moving to pitch {curr_pitch:.2f} deg, yaw {curr_yaw:.2f} deg")
+            if live_overlay is not None:
+                # the beam spot moves onto the cell center, the view moves accordingly
+                live_overlay.set_view_offset(cell.destination.x + cell.destination.width / 2 - beam_x, cell.destination.y + cell.destination.height / 2 - beam_y)
+            planner.move_to(curr_yaw, curr_pitch)
+
+            self.logger.info("waiting for gimbal/video to settle")
+            settle_start = perf_counter()
+            settle_scale = scheduler.settle_scale(index) if scheduler is not None else 1.0 # stricter for cells with repeats
+            angle_errors = self.wait_angle_error(self.settle_settings.angle_settle_threshold * settle_scale, self.settle_settings.angle_settle_delay) # wait until controller has reached target angle
+            planner.record_settle(perf_counter() - settle_start)
+            frame_diffs = self.wait_video_settle(self.settle_settings.video_settle_threshold * settle_scale, self.settle_settings.video_settle_delay) # wait until video movement has settled
+
+            self.logger.info("saving pixels")
+            # save the pixels/region of interest (roi) we are looking at
+            offset_x, offset_y = mosaic.insert(self.frame_current, cell)
+            self.logger.debug(f"registration offset: {offset_x:.1f}, {offset_y:.1f} pixels")
+            registration_offsets[y_step][x_step] = [offset_x, offset_y] # residual pointing error of the gimbal
+
+            self.logger.info("measuring")
+
+            measure_start = perf_counter()
+            measurements, error_codes = self.measure_until_valid(planner, curr_yaw, curr_pitch)
+            if scheduler is not None:
+                scheduler.record_cell_time(measure_start - cell_start)
+                scheduler.record_measurement_time(perf_counter() - measure_start)
+                repeats = scheduler.repeats(index, perf_counter() - sweep_start, gascamera.quality.cell_statistics(measurements[0]))
+                if repeats:
+                    self.logger.info(f"measuring {repeats} more times")
+                repeated = [self.measure_until_valid(planner, curr_yaw, curr_pitch)[0] for _ in range(repeats)]
+            else:
+                repeated = []
+            roll, pitch, yaw = self.read_gimbal_angles()
+            measurement_time = perf_counter() - sweep_start
+            alerts = []
+            for sensor_index, (sensor, measurement, target) in enumerate(zip(self.sensor_array.sensors, measurements, sensor_targets)):
+                if target is None:
+                    continue # beam of this sensor is outside of the neutral frame
+                target_x, target_y = target
+                cell_gimbal_angles[target_y][target_x] = [roll, pitch + sensor.boresight_pitch, yaw + sensor.boresight_yaw]
+                cell_times[target_y][target_x] = measurement_time
+                main_value = measurement["main_value"]
+                subsamples = [sub_val_dict["value"] for sub_val_dict in measurement["sub_values"]] # get the ppm*m values for all subsamples as a list
+
+                self.logger.info(f"{sensor.name} at cell {target_x}, {target_y}: main value is {main_value}")
+                self.logger.info(f"collected {len(subsamples)} subsamples: {subsamples}")
+                cell_measurements[target_y][target_x].append(gascamera.quality.cell_statistics(measurement))
+                cell_measurements[target_y][target_x].extend(gascamera.quality.cell_statistics(repeat[sensor_index]) for repeat in repeated)
+                statistics = gascamera.sensors.merge_statistics(cell_measurements[target_y][target_x])
+                column_density_median = statistics["median"]
+                column_density_mean = statistics["mean"]
+                self.logger.info(f"column density is {column_density_mean} ppm*m mean, {column_density_median} ppm*m median")
+                column_densities_mean[target_y][target_x] = column_density_mean # use matplotlib comaptible axis order
+                column_densities_median[target_y][target_x] = column_density_median # use matplotlib comaptible axis order
+                cell_statistics[target_y][target_x] = statistics
+                if live_overlay is not None:
+                    live_overlay.update_cell(cells_by_step[target].destination, column_density_median)
+                if detector is not None:
+                    alerts.extend(detector.update(target_x, target_y, column_density_median, measurement_time))
+                self._notify_cell({"x_step": target_x, "y_step": target_y, "mean": column_density_mean,
+                                   "median": column_density_median, "time": measurement_time, "sensor": sensor.name})
+            # spread of the main sensor's measurement right after settling, also if its beam has a boresight offset
+            cell_telemetry.append({"x_step": x_step, "y_step": y_step, "angle_errors": angle_errors, "frame_diffs": frame_diffs,
+                                   "error_codes": error_codes[0], "subsample_std": gascamera.quality.cell_statistics(measurements[0])["std"],
+                                   "settle_scale": settle_scale})
+            for alert in alerts:
+                notifier.notify(alert)
+                if live_overlay is not None:
+                    live_overlay.flag_cell(cells_by_step[(alert.x_step, alert.y_step)].destination)
+            if alerts and config.detection.dense_rescan:
+                # the first alert is the cell that triggered, the re-scan around it also covers its cluster neighbours
+                rescans.append(self.dense_rescan(planner, cells_by_step[(alerts[0].x_step, alerts[0].y_step)], sweep_start))
+            self.progress = dict(self.progress, cells_done=index + 1)
+
+        # score the cells and re-measure only the flagged ones (weak reflection, high sub-value spread, outlier values)
+        cell_flags = gascamera.quality.flag_cells(cell_statistics, config.quality_thresholds)
+        flagged_cells = [cell for cell in cell_table if cell_flags[cell.y_step][cell.x_step]] if config.remeasure_flagged_cells and not aborted else []
+        remeasured_cells = []
+        self.logger.info(f"{sum(1 for cell in cell_table if cell_flags[cell.y_step][cell.x_step])} cells flagged, re-measuring {len(flagged_cells)}")
+        self.progress = {"phase": "remeasure", "cells_done": 0, "cells_total": len(flagged_cells)}
+        for index, cell in enumerate(flagged_cells):
+            if self._abort.is_set():
+                self.logger.warning(f"re-measurement aborted after {index} of {len(flagged_cells)} cells")
+                aborted = True
+                break
+            if scheduler is not None and scheduler.remaining(perf_counter() - sweep_start) < scheduler.cell_time + scheduler.measurement_time:
+                self.logger.info(f"time budget used up, re-measured {index} of {len(flagged_cells)} cells")
+                break
+            self.progress = dict(self.progress, cells_done=index)
+            x_step, y_step = cell.x_step, cell.y_step
+            curr_pitch, curr_yaw = center_pitch + cell.pitch, center_yaw + cell.yaw
+            self.logger.info(f"re-measuring cell {x_step}, {y_step}: {', '.join(cell_flags[y_step][x_step])}")
+            if live_overlay is not None:
+                live_overlay.set_view_offset(cell.destination.x + cell.destination.width / 2 - beam_x, cell.destination.y + cell.destination.height / 2 - beam_y)
+            planner.move_to(curr_yaw, curr_pitch)
+            self.settle()
+            measurements, error_codes = self.measure_until_valid(planner, curr_yaw, curr_pitch, indices=[0]) # main sensor only
+            gimbal_angles = list(self.read_gimbal_angles())
+            measurement_time = perf_counter() - sweep_start
+            error_codes = error_codes[0]
+            # the re-measurement is one more repeat of the cell, try it merged with the earlier repeats and on its own
+            # (if those were bad), each flagged in the context of the other cells
+            new_statistics = gascamera.quality.cell_statistics(measurements[0])
+            candidates = []
+            for candidate_measurements in (cell_measurements[y_step][x_step] + [new_statistics], [new_statistics]):
+                trial_statistics = [list(row) for row in cell_statistics]
+                trial_statistics[y_step][x_step] = gascamera.sensors.merge_statistics(candidate_measurements)
+                candidates.append((trial_statistics[y_step][x_step],
+                                   gascamera.quality.flag_cells(trial_statistics, config.quality_thresholds)[y_step][x_step],
+                                   candidate_measurements))
+            if gascamera.quality.is_better(*candidates[1][:2], *candidates[0][:2]):
+                candidates.reverse()
+            statistics, flags, candidate_measurements = candidates[0]
+            replaced = gascamera.quality.is_better(statistics, flags, cell_statistics[y_step][x_step], cell_flags[y_step][x_step])
+            remeasured_cells.append({"x_step": x_step, "y_step": y_step, "flags_before": cell_flags[y_step][x_step],
+                                     "flags_after": flags, "error_codes": error_codes, "replaced": replaced})
+            if replaced:
+                self.logger.info(f"keeping re-measured value {statistics['median']} ppm*m median of {len(candidate_measurements)} "
+                                 f"measurements, flags: {flags}")
+                cell_measurements[y_step][x_step] = candidate_measurements # the dwell report counts what is kept
+                cell_statistics[y_step][x_step] = statistics
+                cell_flags[y_step][x_step] = flags
+                cell_gimbal_angles[y_step][x_step] = gimbal_angles
+                cell_times[y_step][x_step] = measurement_time
+                column_densities_mean[y_step][x_step] = statistics["mean"]
+                column_densities_median[y_step][x_step] = statistics["median"]
+                if live_overlay is not None:
+                    live_overlay.update_cell(cell.destination, statistics["median"])
+
+        # return gimbal to neutral
+        if live_overlay is not None:
+            live_overlay.set_view_offset(0, 0)
+            live_overlay.set_target(None, None)
+        planner.move_to(center_yaw, center_pitch)
+        self.hold(0, 0) # until the next move, e.g. between the sweeps of the control server
+
+        experiment["end"] = datetime.now().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        experiment["aborted"] = aborted
+        experiment["column_densities_mean"] = column_densities_mean
+        experiment["column_densities_median"] = column_densities_median
+        experiment["registration_offsets"] = registration_offsets
+        experiment["cell_telemetry"] = cell_telemetry
+        experiment["cell_statistics"] = cell_statistics
+        experiment["cell_gimbal_angles"] = cell_gimbal_angles
+        experiment["cell_gimbal_angles_reference"] = "frame" # earlier experiments stored the IMU angles
+        experiment["cell_times"] = cell_times
+        if detector is not None:
+            notifier.close()
+            experiment["alerts"] = [alert._asdict() for alert in detector.alerts]
+            experiment["rescans"] = rescans
+        if scheduler is not None:
+            experiment["dwell"] = scheduler.report(cell_measurements)
+            self.logger.info(f"sweep took {perf_counter() - sweep_start:.1f} s of the time budget of {config.dwell.time_budget} s")
+        if reference_cell is not None:
+            self._correct_baseline(reference_measurements)
+        if config.pose is not None:
+            experiment["pose"] = config.pose._asdict()
+        experiment["cell_flags"] = cell_flags
+        experiment["remeasured_cells"] = remeasured_cells
+        experiment["stream_statistics"] = self._out.statistics() # CPU cost of the stream, for choosing the settings per robot
+        self.assembled_image = mosaic.assembled_image
+        self.progress = dict(self.progress, phase="aborted" if aborted else "done")
+        return experiment
+
+    def export(self, identifier: str = None) -> gascamera.export.Exporter:
+        """
+        Starts writing the experiment JSON, the neutral and assembled images and the overlays in the background.
+        Returns the exporter, its close() waits for the files and returns their names.
+        """
+        config = self.config
+        if identifier is None:
+            identifier = datetime.now().strftime('%Y-%m-%dT%H.%M.%S')
+            if config.name:
+                identifier = f"{config.name}_{identifier}"
+        base = os.path.join(config.output_dir, identifier)
+        experiment = self.experiment
+
+        exporter = gascamera.export.Exporter(config.export_image_format, config.export_compression)
+        exporter.write_json(f"{base}.json", experiment)
+        exporter.write_image(f'{base}_neutral', self.neutral_image)
+        exporter.write_image(f'{base}_assembled', self.assembled_image)
+
+        # create and save overlays
+        exporter.write_overlay(f'{base}_overlay_mean', self.assembled_image, experiment["column_densities_mean"], config.overlay_reconstruction)
+        exporter.write_overlay(f'{base}_overlay_median', self.assembled_image, experiment["column_densities_median"], config.overlay_reconstruction)
+        if "column_densities_median_corrected" in experiment:
+            # unvisited cells (None, NaN) are skipped by the reconstruction and left out of the color range
+            corrected = np.array([[np.nan if value is None else value for value in row]
+                                  for row in experiment["column_densities_median_corrected"]], dtype=float)
+            exporter.write_overlay(f'{base}_overlay_median_corrected', self.assembled_image, corrected, config.overlay_reconstruction)
+        if config.pose is not None:
+            exporter.write_array(f"{base}_rays.npy", gascamera.rays.experiment_rays(experiment, config.pose, range_estimate=config.range_estimate))
+        return exporter
+
+    def run(self, interactive: bool = True) -> dict:
+        """
+        Runs a complete experiment: opens the devices, waits for the start (interactive) or starts right away, sweeps,
+        exports and closes. Returns the experiment data.
+        """
+        self.open()
+        try:
+            if interactive:
+                self.wait_for_start()
+            self.sweep()
+            exporter = self.export()
+        finally:
+            self.close()
+        # wait for the background export, it ran while the stream was stopped and devices were released
+        for filename in exporter.close():
+            self.logger.info(f"written {filename}")
+        return self.experiment
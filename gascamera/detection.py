@@ -0,0 +1,192 @@
+# Copyright (c) 2023 Bundesanstalt für Materialforschung und -prüfung, see LICENSE file
+# Online plume detection during the sweep: every finished cell is scored against the running background, alerts are sent out immediately.
+
+import json
+import socket
+import threading
+import urllib.request
+from collections import deque
+from logging import getLogger
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+
+from gascamera.geometry import cell_edges
+
+logger = getLogger(__name__)
+
+REASON_THRESHOLD = "threshold"
+REASON_SCORE = "score"
+REASON_CLUSTER = "cluster"
+
+
+class DetectionSettings(NamedTuple):
+    """
+    Criteria for plume alerts. A cell alerts if it is more than threshold (ppm*m, None disables) above the running
+    background, if its robust z-score against the background is above z_threshold, or if it belongs to at least
+    cluster_size adjacent cells with a z-score above cluster_z. The background is the median of the last
+    background_window cells that did not score above cluster_z.
+    Alerts are logged and, if given, sent as JSON to a local UDP listener (host, port) and posted to a webhook URL.
+    With dense_rescan, the surroundings of an alerting cell are measured right away at rescan_steps points per cell
+    and axis within rescan_radius cells.
+    """
+    enabled: bool = True
+    threshold: float = None
+    z_threshold: float = 5.0
+    cluster_z: float = 2.5
+    cluster_size: int = 3
+    background_window: int = 50
+    min_background_cells: int = 5 # no alerts before this many background cells are known
+    udp_address: Tuple[str, int] = None
+    webhook_url: str = None
+    dense_rescan: bool = False
+    rescan_steps: int = 3
+    rescan_radius: int = 1
+
+
+class Alert(NamedTuple):
+    x_step: int
+    y_step: int
+    value: float # column density, ppm*m
+    background: float # running background, ppm*m
+    score: float # robust z-score against the background
+    reasons: List[str]
+    time: float # seconds since sweep start
+
+
+class PlumeDetector:
+    """
+    Scores each finished cell against the running background of the sweep (see DetectionSettings). Every cell alerts
+    at most once, the elevated cells of a cluster alert together when the cluster reaches cluster_size.
+    """
+
+    def __init__(self, settings: DetectionSettings, x_steps: int, y_steps: int) -> None:
+        self.settings = settings
+        self._background = deque(maxlen=settings.background_window)
+        self._elevated = np.zeros((y_steps, x_steps), bool)
+        self._values = np.full((y_steps, x_steps), np.nan)
+        self._scores = np.full((y_steps, x_steps), np.nan)
+        self._alerted = np.zeros((y_steps, x_steps), bool)
+        self.alerts = []
+
+    def _statistics(self) -> Tuple[float, float]:
+        """Returns median and robust standard deviation (scaled MAD) of the background."""
+        values = np.asarray(self._background)
+        median = float(np.median(values))
+        return median, max(1.4826 * float(np.median(np.abs(values - median))), 1e-9)
+
+    def _cluster(self, x_step: int, y_step: int) -> List[Tuple[int, int]]:
+        """Returns the elevated cells connected (8-neighbourhood) to the given one."""
+        height, width = self._elevated.shape
+        cluster, pending = {(x_step, y_step)}, [(x_step, y_step)]
+        while pending:
+            x, y = pending.pop()
+            for neighbour_y in range(max(0, y - 1), min(height, y + 2)):
+                for neighbour_x in range(max(0, x - 1), min(width, x + 2)):
+                    if self._elevated[neighbour_y, neighbour_x] and (neighbour_x, neighbour_y) not in cluster:
+                        cluster.add((neighbour_x, neighbour_y))
+                        pending.append((neighbour_x, neighbour_y))
+        return sorted(cluster)
+
+    def update(self, x_step: int, y_step: int, value: float, time: float) -> List[Alert]:
+        """Scores a finished cell and returns the new alerts (possibly for several cells of a cluster)."""
+        settings = self.settings
+        if len(self._background) < settings.min_background_cells:
+            self._background.append(value)
+            return []
+        background, spread = self._statistics()
+        score = (value - background) / spread
+        if score <= settings.cluster_z:
+            self._background.append(value)
+            return []
+
+        self._elevated[y_step, x_step] = True
+        self._values[y_step, x_step] = value
+        self._scores[y_step, x_step] = score
+        reasons = []
+        if settings.threshold is not None and value - background > settings.threshold:
+            reasons.append(REASON_THRESHOLD)
+        if score > settings.z_threshold:
+            reasons.append(REASON_SCORE)
+        cluster = self._cluster(x_step, y_step)
+        new_alerts = []
+        if len(cluster) >= settings.cluster_size:
+            # the cells of the cluster that did not alert yet, scored when they were measured
+            for cluster_x, cluster_y in cluster:
+                if not self._alerted[cluster_y, cluster_x] and (cluster_x, cluster_y) != (x_step, y_step):
+                    self._alerted[cluster_y, cluster_x] = True
+                    new_alerts.append(Alert(cluster_x, cluster_y, float(self._values[cluster_y, cluster_x]), background,
+                                            float(self._scores[cluster_y, cluster_x]), [REASON_CLUSTER], time))
+            reasons.append(REASON_CLUSTER)
+        if reasons and not self._alerted[y_step, x_step]:
+            self._alerted[y_step, x_step] = True
+            new_alerts.insert(0, Alert(x_step, y_step, value, background, score, reasons, time))
+        self.alerts.extend(new_alerts)
+        return new_alerts
+
+
+class AlertNotifier:
+    """
+    Sends alerts to the log and, if configured, as JSON datagram to a local UDP listener and as POST to a webhook.
+    The webhook is called from a background thread, so a slow listener does not stall the sweep.
+    """
+
+    def __init__(self, settings: DetectionSettings, name: str = None) -> None:
+        self.settings = settings
+        self.name = name
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) if settings.udp_address is not None else None
+        self._threads = []
+
+    def _post(self, payload: bytes) -> None:
+        try:
+            request = urllib.request.Request(self.settings.webhook_url, data=payload, headers={"Content-Type": "application/json"})
+            urllib.request.urlopen(request, timeout=5).close()
+        except OSError as error:
+            logger.error(f"could not post alert to {self.settings.webhook_url}: {error}")
+
+    def notify(self, alert: Alert) -> None:
+        logger.warning(f"plume alert at cell {alert.x_step}, {alert.y_step}: {', '.join(alert.reasons)}, "
+                       f"value {alert.value} ppm*m, background {alert.background:.1f} ppm*m")
+        payload = json.dumps(dict(alert._asdict(), rig=self.name)).encode()
+        if self._socket is not None:
+            try:
+                self._socket.sendto(payload, tuple(self.settings.udp_address))
+            except OSError as error:
+                logger.error(f"could not send alert to {self.settings.udp_address}: {error}")
+        if self.settings.webhook_url is not None:
+            thread = threading.Thread(target=self._post, args=(payload,), name="alert_webhook", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self) -> None:
+        """Waits for pending webhook calls and closes the socket."""
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+def rescan_points(calibration, cell, steps: int, radius: int, x_steps: int, y_steps: int) -> List[Tuple[float, float]]:
+    """
+    Returns the gimbal angles (yaw, pitch relative to the sweep center) of a dense grid around a cell: steps points
+    per cell and axis, covering the cell and radius cells around it (clipped to the grid). The cells have the pixel
+    edges of the sweep (see gascamera.geometry.cell_edges()).
+    """
+
+    def positions(step: int, n_cells: int, n_pixels: int) -> np.ndarray:
+        edges = cell_edges(n_cells, n_pixels)
+        cells = range(max(0, step - radius), min(n_cells, step + radius + 1))
+        return np.concatenate([edges[index] + (np.arange(steps) + 0.5) * (edges[index + 1] - edges[index]) / steps
+                               for index in cells])
+
+    xs = positions(cell.x_step, x_steps, calibration.frame_width)
+    ys = positions(cell.y_step, y_steps, calibration.frame_height)
+    rows, columns = len(ys), len(xs)
+    grid_x, grid_y = np.meshgrid(xs, ys)
+    yaw, pitch = calibration.pixel_to_angle(grid_x.ravel(), grid_y.ravel())
+    # serpentine order, so the gimbal moves only to neighbouring points
+    points = np.stack([yaw, pitch], axis=1).reshape(rows, columns, 2)
+    points[1::2] = points[1::2, ::-1]
+    return [(float(yaw), float(pitch)) for yaw, pitch in points.reshape(-1, 2)]
@@ -0,0 +1,202 @@
+# Copyright (c) 2023 Bundesanstalt für Materialforschung und -prüfung, see LICENSE file
+# Dwell-time scheduling: distributes repeated measurements over the cells of a sweep within a fixed time budget.
+
+import heapq
+import json
+from logging import getLogger
+from typing import List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+
+logger = getLogger(__name__)
+
+
+class DwellSettings(NamedTuple):
+    """
+    Time budget of a sweep (seconds, None disables the scheduler: one measurement per cell). Every visited cell is
+    measured at least once, the remaining time goes to repeated measurements (up to max_repeats per cell) where they
+    reduce the weighted noise most: noisy cells (high sub-value spread, e.g. weak 1f signal) and cells at or next to
+    suspected plumes (plume_weight), taken from the maps of a prior experiment of the same sector (prior_file) and
+    from the cells measured so far. Cells with repeats settle with their thresholds scaled by strict_settle_factor.
+    The time per visited cell (move and settle) and per measurement are estimates until measured during the sweep.
+    """
+    time_budget: float = None
+    max_repeats: int = 4
+    prior_file: str = None # experiment JSON of a previous sweep of the same sector
+    plume_z: float = 2.5 # robust z-score of the column density above which a cell is a suspected plume
+    plume_weight: float = 4.0 # weight of suspected plume cells relative to background cells
+    plume_radius: float = 1.0 # cells, the plume weight decays with the distance to suspected plume cells
+    strict_settle_factor: float = 0.5
+    cell_time: float = 1.0 # seconds, estimate of move and settle per visited cell
+    measurement_time: float = 1.0 # seconds, estimate per measurement
+
+
+def measurement_noise(statistics: dict) -> float:
+    """Returns the standard error (ppm*m) of the column density of gascamera.quality.cell_statistics()."""
+    return statistics["std"] / np.sqrt(statistics.get("subsamples", 1))
+
+
+def achieved_noise(measurements: Sequence[dict]) -> float:
+    """
+    Returns the noise (ppm*m) of a cell from the statistics of all its measurements: the pooled standard error of the
+    sub-values, or the standard error of the repeated medians if that is higher (e.g. turbulence between repeats).
+    """
+    subsamples = sum(entry.get("subsamples", 1) for entry in measurements)
+    noise = float(np.sqrt(np.mean([entry["std"] ** 2 for entry in measurements]) / subsamples))
+    if len(measurements) > 1:
+        noise = max(noise, float(np.std([entry["median"] for entry in measurements], ddof=1) / np.sqrt(len(measurements))))
+    return noise
+
+
+def _robust_z(values: np.ndarray) -> np.ndarray:
+    """Returns the robust z-scores (median, scaled MAD) of the values, NaN values are ignored."""
+    median = np.nanmedian(values)
+    spread = max(1.4826 * float(np.nanmedian(np.abs(values - median))), 1e-9)
+    return (values - median) / spread
+
+
+class DwellScheduler:
+    """
+    Plans the measurements per cell of a sweep (see DwellSettings). The cells are given in visit order as
+    (x_step, y_step). After the first measurement of a cell, repeats() re-plans the remaining budget with the measured
+    noise and timing and returns the number of further measurements for this cell, so the sweep finishes in time
+    even if moves, settling or re-scans take longer than estimated.
+    """
+
+    def __init__(self, settings: DwellSettings, cells: Sequence[Tuple[int, int]], x_steps: int, y_steps: int,
+                 prior: dict = None) -> None:
+        self.settings = settings
+        self.cells = list(cells)
+        self._index = {cell: index for index, cell in enumerate(self.cells)}
+        self._positions = np.array(self.cells, dtype=float).reshape(-1, 2)
+        self.cell_time = settings.cell_time
+        self.measurement_time = settings.measurement_time
+        self._cell_times = []
+        self._measurement_times = []
+        self._medians = [] # first measurement of the visited cells, for the online plume suspicion
+        # noise of a single measurement and weight per cell, NaN noise is unknown (filled with the typical noise)
+        self.noise = np.full(len(self.cells), np.nan)
+        self._plume = np.zeros(len(self.cells), bool)
+        self._settle_scales = np.ones(len(self.cells))
+        if prior is not None:
+            self._apply_prior(prior, x_steps, y_steps)
+        self.planned = self._allocate(0, settings.time_budget - len(self.cells) * (self.cell_time + self.measurement_time))
+
+    @classmethod
+    def from_settings(cls, settings: DwellSettings, cells: Sequence[Tuple[int, int]], x_steps: int, y_steps: int) -> "DwellScheduler":
+        """Creates the scheduler with the prior experiment of the settings, if given."""
+        prior = None
+        if settings.prior_file is not None:
+            with open(settings.prior_file, 'r') as json_file:
+                prior = json.load(json_file)
+            if len(prior["column_densities_median"]) != y_steps or len(prior["column_densities_median"][0]) != x_steps:
+                raise ValueError(f"the grid of the prior experiment {settings.prior_file} does not match the sweep")
+        return cls(settings, cells, x_steps, y_steps, prior)
+
+    def _apply_prior(self, prior: dict, x_steps: int, y_steps: int) -> None:
+        statistics = prior.get("cell_statistics") or [[None] * x_steps for _ in range(y_steps)]
+        repeats = prior.get("dwell", {}).get("repeats")
+        for index, (x_step, y_step) in enumerate(self.cells):
+            entry = statistics[y_step][x_step]
+            if entry is not None:
+                # the prior statistics are merged over all measurements of the cell, scale back to a single one
+                self.noise[index] = measurement_noise(entry) * np.sqrt(repeats[y_step][x_step] if repeats else 1)
+        densities = np.array([[np.nan if value is None else value for value in row]
+                              for row in prior["column_densities_median"]], dtype=float)
+        elevated = _robust_z(densities) > self.settings.plume_z
+        for index, (x_step, y_step) in enumerate(self.cells):
+            self._plume[index] = elevated[y_step, x_step]
+        logger.info(f"dwell prior: {int(np.sum(~np.isnan(self.noise)))} cells with noise, {int(np.sum(self._plume))} suspected plume cells")
+
+    def _weights(self) -> np.ndarray:
+        """Returns the weight per cell: 1 plus the plume weight decaying with the distance to suspected plume cells."""
+        if not self._plume.any():
+            return np.ones(len(self.cells))
+        plume_positions = self._positions[self._plume]
+        distances = np.abs(self._positions[:, None, :] - plume_positions[None, :, :]).max(axis=2).min(axis=1)
+        return 1 + self.settings.plume_weight * np.exp(-distances / max(self.settings.plume_radius, 1e-9))
+
+    def _allocate(self, start: int, extra_time: float) -> np.ndarray:
+        """
+        Returns the planned number of measurements of the cells from start on: one each, plus the repeats that reduce
+        the weighted expected variance most (greedy, optimal for this separable convex problem) within extra_time.
+        """
+        planned = np.ones(len(self.cells), int)
+        budget = int(max(extra_time, 0) // self.measurement_time)
+        if budget == 0 or self.settings.max_repeats <= 1:
+            return planned
+        known = self.noise[~np.isnan(self.noise)]
+        typical = float(np.median(known)) if len(known) else 1.0
+        variance = np.where(np.isnan(self.noise), typical, self.noise) ** 2 * self._weights()
+        # gain of the next repeat of a cell with n measurements: variance * (1 / n - 1 / (n + 1))
+        heap = [(-variance[index] / 2, index) for index in range(start, len(self.cells))]
+        heapq.heapify(heap)
+        while heap and budget > 0:
+            _, index = heapq.heappop(heap)
+            planned[index] += 1
+            budget -= 1
+            count = planned[index]
+            if count < self.settings.max_repeats:
+                heapq.heappush(heap, (-variance[index] / (count * (count + 1)), index))
+        return planned
+
+    def settle_scale(self, index: int) -> float:
+        """Returns the factor for the settle thresholds of the cell at index, stricter for cells with planned repeats."""
+        self._settle_scales[index] = self.settings.strict_settle_factor if self.planned[index] > 1 else 1.0
+        return float(self._settle_scales[index])
+
+    def repeats(self, index: int, elapsed: float, statistics: dict) -> int:
+        """
+        Takes the first measurement of the cell at index (gascamera.quality.cell_statistics()) and the seconds since
+        the sweep start, re-plans the cells from index on and returns the number of further measurements of this cell.
+        """
+        self.noise[index] = measurement_noise(statistics)
+        self._medians.append(statistics["median"])
+        if len(self._medians) >= 5 and _robust_z(np.array(self._medians))[-1] > self.settings.plume_z:
+            self._plume[index] = True
+        remaining_cells = len(self.cells) - index - 1
+        extra_time = self.settings.time_budget - elapsed - remaining_cells * (self.cell_time + self.measurement_time)
+        self.planned[index:] = self._allocate(index, extra_time)[index:]
+        return int(self.planned[index]) - 1
+
+    def record_cell_time(self, seconds: float) -> None:
+        """Records the time of a visited cell without its measurements (move, settle, saving pixels)."""
+        self._cell_times.append(seconds)
+        self.cell_time = float(np.median(self._cell_times))
+
+    def record_measurement_time(self, seconds: float) -> None:
+        """Records the time of one measurement."""
+        self._measurement_times.append(seconds)
+        self.measurement_time = float(np.median(self._measurement_times))
+
+    def remaining(self, elapsed: float) -> float:
+        """Returns the seconds left in the budget."""
+        return self.settings.time_budget - elapsed
+
+    def report(self, cell_measurements: List[List[List[dict]]]) -> dict:
+        """
+        Returns the dwell summary of the sweep for the experiment data from the statistics of all measurements per
+        cell: measurements, settle scale, expected noise (single measurement noise over the square root of the
+        measurements) and achieved noise per cell (y_steps * x_steps).
+        """
+        y_steps, x_steps = len(cell_measurements), len(cell_measurements[0])
+        known = self.noise[~np.isnan(self.noise)]
+        typical = float(np.median(known)) if len(known) else None
+        expected = [[None] * x_steps for _ in range(y_steps)]
+        achieved = [[None] * x_steps for _ in range(y_steps)]
+        repeats = [[len(measurements) for measurements in row] for row in cell_measurements]
+        settle = [[None] * x_steps for _ in range(y_steps)]
+        for index, (x_step, y_step) in enumerate(self.cells):
+            settle[y_step][x_step] = float(self._settle_scales[index])
+        for y_step in range(y_steps):
+            for x_step in range(x_steps):
+                if not cell_measurements[y_step][x_step]:
+                    continue
+                index = self._index.get((x_step, y_step))
+                noise = self.noise[index] if index is not None and not np.isnan(self.noise[index]) else typical
+                if noise is not None:
+                    expected[y_step][x_step] = float(noise / np.sqrt(repeats[y_step][x_step]))
+                achieved[y_step][x_step] = achieved_noise(cell_measurements[y_step][x_step])
+        return {"time_budget": self.settings.time_budget, "repeats": repeats, "settle_scale": settle,
+                "expected_noise": expected, "achieved_noise": achieved,
+                "cell_time": self.cell_time, "measurement_time": self.measurement_time}
@@ -0,0 +1,101 @@
+# Copyright (c) 2023 Bundesanstalt für Materialforschung und -prüfung, see LICENSE file
+# Asynchronous export of experiment results (JSON, images, overlays) off the critical path of the sweep.
+
+import json
+from concurrent.futures import Future, ThreadPoolExecutor
+from logging import getLogger
+
+import cv2
+import numpy as np
+
+import gascamera.overlay
+
+logger = getLogger(__name__)
+
+# file extension and imwrite parameters (from the compression level) for each image format
+IMAGE_FORMATS = {
+    "png": (".png", lambda level: [cv2.IMWRITE_PNG_COMPRESSION, level]), # level 0-9, 1 is fast with reasonable size
+    "webp": (".webp", lambda level: [cv2.IMWRITE_WEBP_QUALITY, 101]), # quality above 100 selects lossless WebP
+    "npy": (".npy", None), # raw array, fastest to write and to reload for processing
+}
+
+
+class Exporter:
+    """
+    Writes experiment files in background threads (cv2.imwrite and numpy release the GIL while encoding/writing).
+    All write_* methods return immediately with a Future; images are copied, so callers may keep modifying them.
+    Call close() (or use as context manager) to wait for all pending exports.
+    """
+
+    def __init__(self, image_format: str = "png", compression: int = 1, max_workers: int = 2) -> None:
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f"unknown image format '{image_format}', expected one of {list(IMAGE_FORMATS)}")
+        self.image_format = image_format
+        self.compression = compression
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="export")
+        self._futures = []
+
+    def __enter__(self) -> "Exporter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _submit(self, function, *args) -> Future:
+        future = self._executor.submit(function, *args)
+        self._futures.append(future)
+        return future
+
+    def _write_image(self, basename: str, image) -> str:
+        extension, parameters = IMAGE_FORMATS[self.image_format]
+        filename = basename + extension
+        if parameters is None:
+            np.save(filename, image)
+        elif not cv2.imwrite(filename, image, parameters(self.compression)):
+            raise RuntimeError(f"could not write image {filename}")
+        logger.debug(f"written {filename}")
+        return filename
+
+    def _write_overlay(self, basename: str, assembled_image, column_densities, method: str) -> str:
+        return self._write_image(basename, gascamera.overlay.create_overlay(assembled_image, column_densities, method))
+
+    @staticmethod
+    def _write_json(filename: str, data: dict) -> str:
+        with open(filename, 'w') as jsonfile:
+            json.dump(data, jsonfile, indent=2)
+        logger.debug(f"written {filename}")
+        return filename
+
+    @staticmethod
+    def _write_array(filename: str, array) -> str:
+        np.save(filename, array)
+        logger.debug(f"written {filename}")
+        return filename
+
+    def write_image(self, basename: str, image) -> Future:
+        """Writes image to basename plus the extension of the configured format."""
+        return self._submit(self._write_image, basename, image.copy())
+
+    def write_overlay(self, basename: str, assembled_image, column_densities, method: str = "block") -> Future:
+        """Renders the overlay (see gascamera.overlay.create_overlay()) and writes it like write_image()."""
+        return self._submit(self._write_overlay, basename, assembled_image.copy(), np.array(column_densities, dtype=float), method)
+
+    def write_json(self, filename: str, data: dict) -> Future:
+        """Writes data as JSON to filename. The dict is serialized in the background, do not modify it afterwards."""
+        return self._submit(self._write_json, filename, data)
+
+    def write_array(self, filename: str, array) -> Future:
+        """Writes array as .npy file to filename, e.g. the rays of gascamera.rays."""
+        return self._submit(self._write_array, filename, np.array(array))
+
+    def wait(self) -> list:
+        """Waits for all pending exports and returns the written filenames. Raises the first failed export's exception."""
+        futures, self._futures = self._futures, []
+        return [future.result() for future in futures]
+
+    def close(self) -> list:
+        """Waits for all pending exports (see wait()) and shuts down the worker threads."""
+        try:
+            return self.wait()
+        finally:
+            self._executor.shutdown()
@@ -0,0 +1,99 @@
+# Copyright (c) 2023 Bundesanstalt für Materialforschung und -prüfung, see LICENSE file
+# Coordination of several camera rigs on one host: scene split into sectors, parallel sweeps and a stitched density map.
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from logging import getLogger
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+from gascamera.camera import CameraConfig, VirtualGasCamera
+
+logger = getLogger(__name__)
+
+
+def split_sectors(scene_yaw: float, scene_pitch: float, columns: int, rows: int = 1, center_yaw: float = 0.0,
+                  center_pitch: float = 0.0) -> List[Tuple[float, float]]:
+    """
+    Splits a scene of scene_yaw * scene_pitch degrees around center_yaw, center_pitch into columns * rows sectors.
+    Returns the (yaw, pitch) centers of the sectors row by row, to be used as center_yaw/center_pitch of the rigs.
+    The field of view of a rig (fov_yaw, fov_pitch) should be at least the sector size.
+    """
+    if columns < 1 or rows < 1:
+        raise ValueError("at least one sector is required")
+    sector_yaw = scene_yaw / columns
+    sector_pitch = scene_pitch / rows
+    return [(center_yaw - scene_yaw / 2 + (column + 0.5) * sector_yaw, center_pitch - scene_pitch / 2 + (row + 0.5) * sector_pitch)
+            for row in range(rows) for column in range(columns)]
+
+
+def _run_rig(config: CameraConfig) -> dict:
+    """Runs one rig without waiting for enter, module level so it can run in a worker process."""
+    return VirtualGasCamera(config).run(interactive=False)
+
+
+def run_fleet(configs: Sequence[CameraConfig], processes: bool = True) -> List[dict]:
+    """
+    Runs the sweeps of all rigs in parallel and returns their experiment data in the order of configs.
+    Every rig needs its own serial ports, capture device and stream port. With processes=True, every rig runs in its
+    own process (no shared GIL for frame handling and encoding), else in a thread of this process.
+    A failing rig is logged and returns None, so the other rigs' results are kept.
+    """
+    names = [config.name for config in configs]
+    if None in names or len(set(names)) != len(names):
+        raise ValueError("every rig needs a unique name")
+    executor_type = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with executor_type(max_workers=len(configs)) as executor:
+        futures = [executor.submit(_run_rig, config) for config in configs]
+        experiments = []
+        for config, future in zip(configs, futures):
+            try:
+                experiments.append(future.result())
+            except Exception:
+                logger.exception(f"rig {config.name} failed")
+                experiments.append(None)
+    return experiments
+
+
+def stitch(experiments: Sequence[dict], resolution: float = None, key: str = "column_densities_median") -> Tuple[np.ndarray, Tuple[float, float, float, float]]:
+    """
+    Merges the density maps of several sweeps into one map on a common yaw/pitch grid using the absolute cell
+    angles of the experiments ("cell_angles"). Overlapping cells are averaged, grid cells without measurement are NaN.
+    This assumes rigs at the same position with aligned yaw references (e.g. on a common mount), so the angles of
+    different rigs are comparable. The resolution (degrees) defaults to the finest cell pitch of the experiments.
+    Returns the map (pitch rows, yaw columns) and its extent (yaw_min, yaw_max, pitch_min, pitch_max) in degrees.
+    """
+    angles, values = [], []
+    for experiment in experiments:
+        if experiment is None:
+            continue
+        cell_angles = np.asarray(experiment["cell_angles"], dtype=float).reshape(-1, 2)
+        angles.append(cell_angles)
+        values.append(np.asarray(experiment[key], dtype=float).reshape(-1))
+    if not angles:
+        raise ValueError("no experiments to stitch")
+
+    if resolution is None:
+        pitches = []
+        for cell_angles in angles:
+            for axis in (0, 1):
+                steps = np.diff(np.unique(np.round(cell_angles[:, axis], 6)))
+                if len(steps):
+                    pitches.append(steps.min())
+        resolution = min(pitches) if pitches else 1.0
+
+    angles, values = np.concatenate(angles), np.concatenate(values)
+    yaw_min, pitch_min = angles.min(axis=0) - resolution / 2
+    columns = np.floor((angles[:, 0] - yaw_min) / resolution).astype(int)
+    rows = np.floor((angles[:, 1] - pitch_min) / resolution).astype(int)
+    shape = (rows.max() + 1, columns.max() + 1)
+
+    sums = np.zeros(shape)
+    counts = np.zeros(shape)
+    np.add.at(sums, (rows, columns), values)
+    np.add.at(counts, (rows, columns), 1)
+    with np.errstate(invalid="ignore"):
+        density_map = sums / counts
+    extent = (float(yaw_min), float(yaw_min + shape[1] * resolution), float(pitch_min), float(pitch_min + shape[0] * resolution))
+    logger.info(f"stitched {len(values)} cells into a {shape[1]} x {shape[0]} map at {resolution:.3f} deg")
+    return density_map, extent
@@ -0,0 +1,203 @@
+# Copyright (c) 2023 Bundesanstalt für Materialforschung und -prüfung, see LICENSE file
+# Sweep geometry: calibration of the gimbal angle to camera pixel mapping and the per-cell lookup table of angles and ROIs.
+
+import json
+from logging import getLogger
+from typing import List, NamedTuple, Tuple
+
+import cv2
+import numpy as np
+
+logger = getLogger(__name__)
+
+
+class Roi(NamedTuple):
+    """Rectangular region of interest in pixels, x/y is the top left corner."""
+    x: int
+    y: int
+    width: int
+    height: int
+
+
+class CellGeometry(NamedTuple):
+    """Precomputed geometry of a single cell of the sweep."""
+    x_step: int
+    y_step: int
+    yaw: float # degrees, gimbal target angle so the measurement beam points at the cell center
+    pitch: float # degrees
+    source: Roi # region in the current camera frame (around the beam spot)
+    destination: Roi # region in the assembled image
+
+
+def cell_edges(n_cells: int, n_pixels: int) -> np.ndarray:
+    """
+    Returns the n_cells+1 pixel edges that distribute n_pixels as evenly as possible over n_cells.
+    Cells differ in size by at most one pixel, no remainder pixels are cropped.
+    """
+    return np.linspace(0, n_pixels, n_cells + 1).astype(int)
+
+
+class Calibration:
+    """
+    Mapping between gimbal angles (degrees, relative to neutral) and pixels of the neutral camera image.
+    The camera is modelled as pinhole camera with focal lengths focal_x/focal_y (pixels) and a single radial distortion
+    coefficient k1. The measurement beam hits the image at the center plus beam_offset_x/beam_offset_y (pixels) at neutral.
+    Positive yaw moves right in the image, positive pitch moves down.
+    """
+
+    def __init__(self, frame_width: int, frame_height: int, focal_x: float, focal_y: float,
+                 beam_offset_x: float = 0, beam_offset_y: float = 0, k1: float = 0) -> None:
+        self.frame_width = frame_width
+        self.frame_height = frame_height
+        self.focal_x = focal_x
+        self.focal_y = focal_y
+        self.beam_offset_x = beam_offset_x
+        self.beam_offset_y = beam_offset_y
+        self.k1 = k1
+
+    @classmethod
+    def from_fov(cls, frame_width: int, frame_height: int, fov_yaw: float, fov_pitch: float,
+                 beam_offset_x: float = 0, beam_offset_y: float = 0) -> "Calibration":
+        """Creates an undistorted calibration from the full field of view (degrees) of the camera."""
+        focal_x = (frame_width / 2) / np.tan(np.radians(fov_yaw / 2))
+        focal_y = (frame_height / 2) / np.tan(np.radians(fov_pitch / 2))
+        return cls(frame_width, frame_height, focal_x, focal_y, beam_offset_x, beam_offset_y)
+
+    @classmethod
+    def load(cls, filename: str) -> "Calibration":
+        with open(filename, 'r') as jsonfile:
+            return cls(**json.load(jsonfile))
+
+    def save(self, filename: str) -> None:
+        with open(filename, 'w') as jsonfile:
+            json.dump(self.to_dict(), jsonfile, indent=2)
+
+    def to_dict(self) -> dict:
+        return {key: float(value) if isinstance(value, np.floating) else value for key, value in vars(self).items()}
+
+    def angle_to_pixel(self, yaw, pitch) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the pixel(s) of the neutral image hit by the measurement beam at the given gimbal angle(s)."""
+        tan_x = np.tan(np.radians(yaw))
+        tan_y = np.tan(np.radians(pitch))
+        distortion = 1 + self.k1 * (tan_x ** 2 + tan_y ** 2)
+        x = self.frame_width / 2 + self.beam_offset_x + self.focal_x * tan_x * distortion
+        y = self.frame_height / 2 + self.beam_offset_y + self.focal_y * tan_y * distortion
+        return x, y
+
+    def beam_angles(self) -> Tuple[float, float]:
+        """
+        Returns the direction of the measurement beam relative to the camera axis (yaw, pitch in degrees), i.e. the
+        angle of the pixel hit by the beam at neutral as seen through the camera model.
+        """
+        camera = Calibration(self.frame_width, self.frame_height, self.focal_x, self.focal_y, k1=self.k1)
+        yaw, pitch = camera.pixel_to_angle(self.frame_width / 2 + self.beam_offset_x, self.frame_height / 2 + self.beam_offset_y)
+        return float(yaw), float(pitch)
+
+    def pixel_to_angle(self, x, y, iterations: int = 5) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the gimbal angle(s) (yaw, pitch in degrees) at which the measurement beam hits the given pixel(s)."""
+        tan_x_distorted = (np.asarray(x, dtype=float) - self.frame_width / 2 - self.beam_offset_x) / self.focal_x
+        tan_y_distorted = (np.asarray(y, dtype=float) - self.frame_height / 2 - self.beam_offset_y) / self.focal_y
+        # invert the radial distortion by fixed point iteration, converges quickly for the small k1 of typical lenses
+        tan_x, tan_y = tan_x_distorted, tan_y_distorted
+        for _ in range(iterations):
+            distortion = 1 + self.k1 * (tan_x ** 2 + tan_y ** 2)
+            tan_x = tan_x_distorted / distortion
+            tan_y = tan_y_distorted / distortion
+        return np.degrees(np.arctan(tan_x)), np.degrees(np.arctan(tan_y))
+
+
+def calibration_angles(fov_yaw: float, fov_pitch: float, steps: int = 5, coverage: float = 0.5) -> List[Tuple[float, float]]:
+    """
+    Returns a grid of steps * steps (yaw, pitch) angles for a calibration run.
+    The grid spans coverage times the field of view, so the central template stays visible for measure_image_shift().
+    """
+    yaws = np.linspace(-fov_yaw * coverage / 2, fov_yaw * coverage / 2, steps)
+    pitches = np.linspace(-fov_pitch * coverage / 2, fov_pitch * coverage / 2, steps)
+    return [(float(yaw), float(pitch)) for pitch in pitches for yaw in yaws]
+
+
+def measure_image_shift(reference_frame, frame, template_fraction: float = 0.25) -> Tuple[float, float]:
+    """
+    Returns how far (x, y in pixels) the view moved between reference_frame and frame, i.e. the position of the
+    reference center in the reference frame minus its position in frame. Uses template matching of the central region.
+    """
+    reference_gray = cv2.cvtColor(reference_frame, cv2.COLOR_BGR2GRAY)
+    frame_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    height, width = reference_gray.shape
+    template_width = int(width * template_fraction)
+    template_height = int(height * template_fraction)
+    template_x = (width - template_width) // 2
+    template_y = (height - template_height) // 2
+    template = reference_gray[template_y:template_y+template_height, template_x:template_x+template_width]
+
+    scores = cv2.matchTemplate(frame_gray, template, cv2.TM_CCOEFF_NORMED)
+    _, max_score, _, max_location = cv2.minMaxLoc(scores)
+    logger.debug(f"template match score: {max_score}")
+    return template_x - max_location[0], template_y - max_location[1]
+
+
+def find_beam_spot(frame, channel: int = 1, blur_sigma: float = 3.0) -> Tuple[int, int]:
+    """Returns the pixel position (x, y) of the brightest spot in the given color channel, e.g. the green aiming laser."""
+    blurred = cv2.GaussianBlur(frame[:, :, channel], (0, 0), blur_sigma)
+    _, _, _, max_location = cv2.minMaxLoc(blurred)
+    return max_location
+
+
+def fit_calibration(angles, shifts, frame_width: int, frame_height: int,
+                    beam_offset_x: float = 0, beam_offset_y: float = 0) -> Calibration:
+    """
+    Fits a Calibration to the image shifts (see measure_image_shift()) observed at the given (yaw, pitch) angles of a
+    calibration run. The shift model shift = focal * tan(angle) * (1 + k1 * r^2) + c is linear in focal, focal * k1
+    and c, so it is solved with linear least squares for each axis. The beam offset can not be observed from image
+    shifts, it has to be measured separately, e.g. using find_beam_spot().
+    """
+    angles = np.radians(np.asarray(angles, dtype=float))
+    shifts = np.asarray(shifts, dtype=float)
+    tan_x = np.tan(angles[:, 0])
+    tan_y = np.tan(angles[:, 1])
+    r_squared = tan_x ** 2 + tan_y ** 2
+
+    focal = []
+    distortion = []
+    for axis, tan_axis in enumerate((tan_x, tan_y)):
+        design = np.column_stack((tan_axis, tan_axis * r_squared, np.ones_like(tan_axis)))
+        (axis_focal, axis_focal_k1, axis_intercept), residuals, _, _ = np.linalg.lstsq(design, shifts[:, axis], rcond=None)
+        logger.info(f"calibration axis {axis}: focal {axis_focal:.1f} px, k1 {axis_focal_k1 / axis_focal:.4f}, intercept {axis_intercept:.1f} px, residuals {residuals}")
+        focal.append(axis_focal)
+        distortion.append(axis_focal_k1 / axis_focal)
+
+    return Calibration(frame_width, frame_height, float(focal[0]), float(focal[1]),
+                       beam_offset_x, beam_offset_y, float(np.mean(distortion)))
+
+
+def _clamp_roi(roi: Roi, frame_width: int, frame_height: int) -> Roi:
+    """Moves roi (keeping its size) so that it lies completely inside the frame."""
+    x = min(max(roi.x, 0), frame_width - roi.width)
+    y = min(max(roi.y, 0), frame_height - roi.height)
+    return Roi(x, y, roi.width, roi.height)
+
+
+def build_cell_table(calibration: Calibration, x_steps: int, y_steps: int) -> List[CellGeometry]:
+    """
+    Precomputes gimbal angles, source and destination ROIs for all cells of an x_steps * y_steps sweep covering the
+    full neutral frame. The result is in sweep order (row by row), so the sweep loop does not need any geometry math.
+    """
+    width = calibration.frame_width
+    height = calibration.frame_height
+    x_edges = cell_edges(x_steps, width)
+    y_edges = cell_edges(y_steps, height)
+    beam_x, beam_y = calibration.angle_to_pixel(0, 0)
+
+    table = []
+    for y_step in range(y_steps):
+        for x_step in range(x_steps):
+            destination = Roi(int(x_edges[x_step]), int(y_edges[y_step]),
+                              int(x_edges[x_step + 1] - x_edges[x_step]), int(y_edges[y_step + 1] - y_edges[y_step]))
+            center_x = destination.x + destination.width / 2
+            center_y = destination.y + destination.height / 2
+            yaw, pitch = calibration.pixel_to_angle(center_x, center_y)
+            # after moving, the cell center is under the beam spot, so take the same sized region around it
+            source = _clamp_roi(Roi(int(round(beam_x - destination.width / 2)), int(round(beam_y - destination.height / 2)),
+                                    destination.width, destination.height), width, height)
+            table.append(CellGeometry(x_step, y_step, float(yaw), float(pitch), source, destination))
+    return table
@@ -0,0 +1,108 @@
+# Copyright (c) 2023 Bundesanstalt für Materialforschung und -prüfung, see LICENSE file
+# Gas source localization: tomographic reconstruction of the concentration field from the rays of several sweeps.
+
+from logging import getLogger
+from time import perf_counter
+from typing import NamedTuple, Sequence, Tuple
+
+import numpy as np
+import scipy.optimize
+import scipy.sparse
+import scipy.sparse.linalg
+
+from gascamera.rays import experiment_rays, sample_rays
+
+logger = getLogger(__name__)
+
+SOLVERS = ("nnls", "lsqr")
+
+
+class Grid(NamedTuple):
+    """Voxel grid starting at origin (meters, east/north/up) with shape voxels of size meters edge length."""
+    origin: Tuple[float, float, float]
+    shape: Tuple[int, int, int]
+    size: float
+
+    def center(self, index) -> np.ndarray:
+        """Returns the world position of the center of a voxel index."""
+        return np.asarray(self.origin) + (np.asarray(index) + 0.5) * self.size
+
+
+class LocalizationResult(NamedTuple):
+    concentration: np.ndarray # ppm per voxel, NaN for voxels not crossed by any ray
+    source: np.ndarray # world position of the voxel with the highest concentration
+    peak: float # ppm at the source
+    residual: float # root mean square of the column density residuals, ppm*m
+    rays: int
+    voxels: int # crossed voxels, i.e. unknowns of the solved system
+
+
+def grid_around(rays: np.ndarray, size: float, max_range: float, height: Tuple[float, float] = (-2.0, 10.0)) -> Grid:
+    """Returns a grid covering the ray origins plus max_range horizontally and height (meters) vertically."""
+    low = rays["origin"].min(axis=0).astype(np.float64) - max_range
+    high = rays["origin"].max(axis=0).astype(np.float64) + max_range
+    low[2], high[2] = height
+    return Grid(tuple(low), tuple(int(n) for n in np.ceil((high - low) / size)), size)
+
+
+def system_matrix(rays: np.ndarray, grid: Grid, max_range: float = 50.0) -> scipy.sparse.csr_matrix:
+    """
+    Returns the sparse rays x voxels matrix of path lengths (meters), so that the column densities of the rays are
+    the matrix times the concentrations (ppm) of the voxels, i.e. every ray is a line integral through the grid.
+    """
+    rows, columns, lengths = [], [], []
+    for ray_index, voxel, step in sample_rays(rays, grid.origin, grid.shape, grid.size, max_range):
+        rows.append(ray_index)
+        columns.append(voxel)
+        lengths.append(np.full(len(voxel), step))
+    if not rows:
+        return scipy.sparse.csr_matrix((len(rays), int(np.prod(grid.shape))))
+    # duplicate entries (several samples of a ray in a voxel) are summed
+    return scipy.sparse.coo_matrix((np.concatenate(lengths), (np.concatenate(rows), np.concatenate(columns))),
+                                   shape=(len(rays), int(np.prod(grid.shape)))).tocsr()
+
+
+def localize(rays: np.ndarray, grid: Grid, max_range: float = 50.0, solver: str = "nnls",
+             regularization: float = 0.01) -> LocalizationResult:
+    """
+    Solves for the concentration field that explains the column densities of the rays. Only voxels crossed by rays
+    are unknowns, so the system stays small for sparse viewpoints. The solver "nnls" (bounded least squares) keeps
+    the concentrations non-negative, "lsqr" is faster but unconstrained. The Tikhonov regularization (relative to
+    the mean path length per voxel) stabilizes the solution where few rays cross.
+    """
+    if solver not in SOLVERS:
+        raise ValueError(f"unknown solver '{solver}', expected one of {list(SOLVERS)}")
+    start = perf_counter()
+    matrix = system_matrix(rays, grid, max_range)
+    crossed = np.flatnonzero(matrix.getnnz(axis=0))
+    if len(crossed) == 0:
+        raise RuntimeError("no ray crosses the grid")
+    matrix = matrix[:, crossed]
+    column_densities = rays["column_density"].astype(np.float64)
+
+    damp = regularization * matrix.sum() / len(crossed)
+    if solver == "lsqr":
+        values = scipy.sparse.linalg.lsqr(matrix, column_densities, damp=damp)[0]
+    else:
+        # the regularization is appended as damp * identity rows with zero targets
+        augmented = scipy.sparse.vstack([matrix, damp * scipy.sparse.identity(len(crossed), format="csr")]).tocsr()
+        targets = np.concatenate([column_densities, np.zeros(len(crossed))])
+        values = scipy.optimize.lsq_linear(augmented, targets, bounds=(0, np.inf), lsmr_tol="auto").x
+
+    residual = float(np.sqrt(np.mean((matrix @ values - column_densities) ** 2)))
+    concentration = np.full(int(np.prod(grid.shape)), np.nan)
+    concentration[crossed] = values
+    concentration = concentration.reshape(grid.shape)
+    index = np.unravel_index(np.nanargmax(concentration), grid.shape)
+    logger.info(f"solved {len(rays)} rays x {len(crossed)} voxels with {solver} in {perf_counter() - start:.2f} s, "
+                f"residual {residual:.1f} ppm*m")
+    return LocalizationResult(concentration, grid.center(index), float(concentration[index]), residual, len(rays), len(crossed))
+
+
+def localize_experiments(experiments: Sequence[dict], size: float = 0.5, max_range: float = 50.0, **kwargs) -> LocalizationResult:
+    """Localizes the source from experiments with known viewpoints ("pose"), see gascamera.rays.experiment_rays()."""
+    missing = [index for index, experiment in enumerate(experiments) if not experiment.get("pose")]
+    if missing:
+        raise ValueError(f"experiments {missing} have no pose")
+    rays = np.concatenate([experiment_rays(experiment) for experiment in experiments])
+    return localize(rays, grid_around(rays, size, max_range), max_range, **kwargs)
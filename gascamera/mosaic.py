@@ -0,0 +1,136 @@
+# Copyright (c) 2023 Bundesanstalt für Materialforschung und -prüfung, see LICENSE file
+# Motion compensated assembly of the mosaic image from the per-cell regions of interest.
+
+from logging import getLogger
+from typing import Tuple
+
+import cv2
+import numpy as np
+
+from gascamera.geometry import CellGeometry, Roi
+
+logger = getLogger(__name__)
+
+
+def _expand_roi(roi: Roi, margin: int, frame_width: int, frame_height: int) -> Roi:
+    """Grows roi by margin on all sides, the result is moved (not cropped) to stay inside the frame."""
+    width = min(roi.width + 2 * margin, frame_width)
+    height = min(roi.height + 2 * margin, frame_height)
+    x = min(max(roi.x - margin, 0), frame_width - width)
+    y = min(max(roi.y - margin, 0), frame_height - height)
+    return Roi(x, y, width, height)
+
+
+class MosaicBuilder:
+    """
+    Assembles the mosaic image cell by cell. Each region of interest is registered against the neutral image
+    (phase correlation on downscaled or ORB features on full resolution gray images), so residual gimbal angle errors do
+    not show up as seams.
+    The method None copies the fixed source ROI without registration.
+    The assembled image is kept in memory, unless a store of the same size is given (e.g. gascamera.tiles.TiledImageStore).
+    """
+
+    def __init__(self, neutral_image, method: str = "phase", downscale: float = 0.5, search_margin: int = 16,
+                 min_response: float = 0.1, store=None) -> None:
+        if method not in (None, "phase", "orb"):
+            raise ValueError(f"unknown registration method '{method}', expected 'phase', 'orb' or None")
+        self.method = method
+        # the search regions of a cell are only a few dozen pixels, ORB needs all of them to find features
+        self.downscale = downscale if method != "orb" else 1.0
+        self.search_margin = search_margin # pixels around the ROI used for registration, limits the correctable offset
+        self.min_response = min_response # phase correlation peaks below this are considered failed registrations
+        self.neutral_image = neutral_image
+        self.assembled_image = np.zeros_like(neutral_image) if store is None else store
+        self._frame_height, self._frame_width = neutral_image.shape[:2]
+        self._neutral_gray = self._prepare(neutral_image)
+        self._orb = cv2.ORB_create(nfeatures=200, nlevels=1, fastThreshold=5) if method == "orb" else None
+        self._matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True) if method == "orb" else None
+
+    def _prepare(self, image) -> np.ndarray:
+        """Returns the downscaled gray version of image used for registration."""
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(gray, None, fx=self.downscale, fy=self.downscale, interpolation=cv2.INTER_AREA)
+
+    def _scaled(self, roi: Roi) -> Tuple[slice, slice]:
+        """Returns the slices of roi in the downscaled images."""
+        x, y = int(roi.x * self.downscale), int(roi.y * self.downscale)
+        width, height = int(roi.width * self.downscale), int(roi.height * self.downscale)
+        return slice(y, y + height), slice(x, x + width)
+
+    def _register_phase(self, reference: np.ndarray, current: np.ndarray) -> Tuple[float, float]:
+        window = cv2.createHanningWindow(reference.shape[::-1], cv2.CV_32F)
+        (shift_x, shift_y), response = cv2.phaseCorrelate(reference.astype(np.float32), current.astype(np.float32), window)
+        if response < self.min_response:
+            logger.debug(f"phase correlation failed, response {response}")
+            return 0.0, 0.0
+        return shift_x, shift_y
+
+    def _register_orb(self, reference: np.ndarray, current: np.ndarray) -> Tuple[float, float]:
+        # the default patch size of 31 pixels leaves no room for keypoints in a small search region, ORB skips a border
+        # of edgeThreshold pixels, so use a quarter of the region
+        patch_size = min(31, max(7, min(reference.shape) // 4))
+        self._orb.setPatchSize(patch_size)
+        self._orb.setEdgeThreshold(patch_size)
+        reference_keypoints, reference_descriptors = self._orb.detectAndCompute(reference, None)
+        current_keypoints, current_descriptors = self._orb.detectAndCompute(current, None)
+        if reference_descriptors is None or current_descriptors is None:
+            logger.debug("ORB registration failed, no features")
+            return 0.0, 0.0
+        matches = self._matcher.match(reference_descriptors, current_descriptors)
+        if len(matches) < 3:
+            logger.debug(f"ORB registration failed, only {len(matches)} matches")
+            return 0.0, 0.0
+        shifts = np.array([np.subtract(current_keypoints[match.trainIdx].pt, reference_keypoints[match.queryIdx].pt)
+                           for match in matches])
+        shift_x, shift_y = np.median(shifts, axis=0) # the median ignores mismatched features
+        return float(shift_x), float(shift_y)
+
+    def register(self, frame, cell: CellGeometry) -> Tuple[float, float]:
+        """
+        Returns the offset (x, y in pixels) of the cell content in frame relative to the expected source ROI,
+        i.e. the residual pointing error of the gimbal. Offsets beyond the search margin are discarded.
+        """
+        if self.method is None:
+            return 0.0, 0.0
+        reference_roi = _expand_roi(cell.destination, self.search_margin, self._frame_width, self._frame_height)
+        current_roi = _expand_roi(cell.source, self.search_margin, self._frame_width, self._frame_height)
+        # only the region around the ROI is converted, not the whole frame
+        current = cv2.resize(cv2.cvtColor(frame[current_roi.y:current_roi.y+current_roi.height, current_roi.x:current_roi.x+current_roi.width], cv2.COLOR_BGR2GRAY),
+                             None, fx=self.downscale, fy=self.downscale, interpolation=cv2.INTER_AREA)
+        reference = self._neutral_gray[self._scaled(reference_roi)]
+        # both regions have the same size unless they were moved differently at the frame borders
+        height = min(reference.shape[0], current.shape[0])
+        width = min(reference.shape[1], current.shape[1])
+        reference, current = reference[:height, :width], current[:height, :width]
+
+        if self.method == "phase":
+            shift_x, shift_y = self._register_phase(reference, current)
+        else:
+            shift_x, shift_y = self._register_orb(reference, current)
+        # back to full resolution and account for differently moved search regions
+        offset_x = shift_x / self.downscale + (current_roi.x - cell.source.x) - (reference_roi.x - cell.destination.x)
+        offset_y = shift_y / self.downscale + (current_roi.y - cell.source.y) - (reference_roi.y - cell.destination.y)
+        if abs(offset_x) > self.search_margin or abs(offset_y) > self.search_margin:
+            logger.debug(f"registration offset {offset_x:.1f}, {offset_y:.1f} beyond search margin, ignored")
+            return 0.0, 0.0
+        return offset_x, offset_y
+
+    def insert(self, frame, cell: CellGeometry) -> Tuple[float, float]:
+        """
+        Registers the cell in frame and copies the content at the measured position into the destination ROI
+        of the assembled image. Returns the measured offset (see register()).
+        """
+        offset_x, offset_y = self.register(frame, cell)
+        source = cell.source
+        x = min(max(int(round(source.x + offset_x)), 0), self._frame_width - source.width)
+        y = min(max(int(round(source.y + offset_y)), 0), self._frame_height - source.height)
+        destination = cell.destination
+        self.assembled_image[destination.y:destination.y+destination.height, destination.x:destination.x+destination.width] = \
+            frame[y:y+source.height, x:x+source.width]
+        return offset_x, offset_y
+
+    def insert_neutral(self, cell: CellGeometry) -> None:
+        """Fills the destination ROI of a cell that is not visited (e.g. covered by another sensor) from the neutral image."""
+        destination = cell.destination
+        self.assembled_image[destination.y:destination.y+destination.height, destination.x:destination.x+destination.width] = \
+            self.neutral_image[destination.y:destination.y+destination.height, destination.x:destination.x+destination.width]
@@ -0,0 +1,202 @@
+# Copyright (c) 2023 Bundesanstalt für Materialforschung und -prüfung, see LICENSE file
+# Rendering of column density overlays on the assembled image and on the live stream.
+
+import threading
+
+import cv2
+import numpy as np
+
+import gascamera.reconstruction
+from gascamera.geometry import Roi
+from gascamera.tiles import TiledImageStore
+
+
+def _colorize(image, density_map, min_column_density: float, span_column_density: float) -> np.ndarray:
+    """Returns image with the saturation set from density_map, scaled so min = 0 and min + span = 255 saturation."""
+    # convert image to grayscale and then to HSV
+    overlay = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    # set same hue everwhere
+    overlay[:, :, 0] = 5
+    # scale and offset values so max = 255, min = 0 saturation, pixels without data (NaN) stay unsaturated
+    saturation = np.nan_to_num((density_map - min_column_density) / span_column_density * 255, nan=0)
+    overlay[:, :, 1] = np.clip(saturation, 0, 255).astype(np.uint8) # set saturation
+    return cv2.cvtColor(overlay, cv2.COLOR_HSV2BGR) # convert overlay back to RGB
+
+
+def _density_range(density_map) -> tuple:
+    """Returns minimum and span of a density map, the span of a flat map is 1 to avoid division by zero."""
+    if not np.isfinite(density_map).any():
+        return 0.0, 1 # no data, e.g. aborted panorama
+    min_column_density = np.nanmin(density_map)
+    span_column_density = np.nanmax(density_map) - min_column_density
+    return min_column_density, span_column_density if span_column_density != 0 else 1
+
+
+def create_overlay(assembled_image, column_densities, method: str = "block") -> np.ndarray:
+    """
+    Returns an overlay image of assembled_image, using the data in column_densities to set the saturation.
+    The cells of the data are distributed evenly over the full image (see gascamera.geometry.cell_edges()).
+    The method selects how the grid is reconstructed at image resolution, see gascamera.reconstruction.reconstruct().
+    """
+    # reconstruct a column density value for every pixel of the overlay
+    density_map = gascamera.reconstruction.reconstruct(column_densities, assembled_image.shape[1], assembled_image.shape[0], method)
+    return _colorize(assembled_image, density_map, *_density_range(density_map))
+
+
+def _block_density(blocks, density_maps, frame_width: int, frame_height: int, roi: Roi) -> np.ndarray:
+    """
+    Returns the column densities of the pixels in roi from the density maps of blocks placed at their pixel origins
+    (x, y, ...) with frame_width * frame_height pixels each. Later blocks win where blocks overlap, pixels outside of
+    all blocks are NaN. The density maps may have a lower resolution than the frames.
+    """
+    density = np.full((roi.height, roi.width), np.nan)
+    for (x, y, _), density_map in zip(blocks, density_maps):
+        x0, x1 = max(roi.x, x), min(roi.x + roi.width, x + frame_width)
+        y0, y1 = max(roi.y, y), min(roi.y + roi.height, y + frame_height)
+        if x0 >= x1 or y0 >= y1:
+            continue
+        map_height, map_width = density_map.shape
+        rows = ((np.arange(y0, y1) - y + 0.5) * map_height / frame_height).astype(int)
+        columns = ((np.arange(x0, x1) - x + 0.5) * map_width / frame_width).astype(int)
+        density[y0 - roi.y:y1 - roi.y, x0 - roi.x:x1 - roi.x] = density_map[np.ix_(rows, columns)]
+    return density
+
+
+def create_block_overlay(image, blocks, frame_width: int, frame_height: int, method: str = "block") -> np.ndarray:
+    """
+    Returns the overlay of a stitched image of several blocks (e.g. a gascamera.panorama.PanoramaCanvas) given as
+    (x, y, column_densities) with the pixel origin of every block image. The grid of every block is reconstructed over
+    its own frame_width * frame_height pixels, so the cells stay where they were measured.
+    """
+    density_maps = [gascamera.reconstruction.reconstruct(np.asarray(column_densities, dtype=float), frame_width, frame_height, method)
+                    for _, _, column_densities in blocks]
+    density_map = _block_density(blocks, density_maps, frame_width, frame_height, Roi(0, 0, image.shape[1], image.shape[0]))
+    return _colorize(image, density_map, *_density_range(density_map))
+
+
+def create_tiled_overlay(store: TiledImageStore, blocks, frame_width: int, frame_height: int, directory: str,
+                         method: str = "block", samples_per_cell: int = 32) -> TiledImageStore:
+    """
+    Renders the overlay of a tiled image of several blocks (see create_block_overlay()) tile by tile into a new store
+    in directory, so neither the image nor the overlay is held in memory. The grid of every block is reconstructed
+    once at samples_per_cell pixels per cell (at most the frame resolution) and sampled for the pixels of every tile
+    the block covers.
+    """
+    density_maps = []
+    for _, _, column_densities in blocks:
+        grid = np.asarray(column_densities, dtype=float)
+        y_steps, x_steps = grid.shape
+        density_maps.append(gascamera.reconstruction.reconstruct(grid, min(frame_width, x_steps * samples_per_cell),
+                                                                 min(frame_height, y_steps * samples_per_cell), method))
+    finite = [density_map[np.isfinite(density_map)] for density_map in density_maps]
+    min_column_density, span_column_density = _density_range(np.concatenate(finite) if finite else np.zeros(0))
+
+    overlay = TiledImageStore(directory, store.width, store.height, tile_size=store.tile_size)
+    for tile_x, tile_y, roi in store.tiles():
+        tile_map = _block_density(blocks, density_maps, frame_width, frame_height, roi)
+        overlay.write(0, roi.x, roi.y, _colorize(store.read_tile(tile_x, tile_y), tile_map, min_column_density, span_column_density))
+    overlay.flush()
+    return overlay
+
+
+class LiveOverlay:
+    """
+    Running column density overlay and target crosshair for the live stream, updated per cell during the sweep.
+    The colored cell layer is cached in a preallocated image and only repainted when a cell changes, so compositing a
+    frame with apply() has constant cost. The layer is in neutral image coordinates and shifted by the current view
+    offset, because the live frames move with the gimbal. Updates and apply() may be called from different threads.
+    """
+
+    def __init__(self, frame_width: int, frame_height: int, alpha: float = 0.4, colormap: int = cv2.COLORMAP_JET) -> None:
+        self.alpha = alpha
+        self._width = frame_width
+        self._height = frame_height
+        self._layer = np.zeros((frame_height, frame_width, 3), np.uint8) # colored cells
+        self._mask = np.zeros((frame_height, frame_width, 1), bool) # pixels covered by measured cells
+        self._output = np.empty((frame_height, frame_width, 3), np.uint8)
+        self._colors = cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(256, 1), colormap).reshape(256, 3)
+        self._cells = {} # roi -> column density
+        self._min = None
+        self._max = None
+        self._offset = (0, 0)
+        self._target = None
+        self._alerts = [] # rois of cells with a plume alert
+        self._lock = threading.Lock()
+
+    def _color(self, value: float) -> tuple:
+        span = self._max - self._min
+        index = int((value - self._min) / span * 255) if span > 0 else 0
+        return tuple(int(channel) for channel in self._colors[index])
+
+    def _paint(self, roi: Roi, value: float) -> None:
+        self._layer[roi.y:roi.y+roi.height, roi.x:roi.x+roi.width] = self._color(value)
+        self._mask[roi.y:roi.y+roi.height, roi.x:roi.x+roi.width] = True
+
+    def update_cell(self, roi: Roi, value: float) -> None:
+        """Sets the column density of the cell covering roi (neutral image coordinates). Non-finite values are skipped."""
+        if not np.isfinite(value):
+            return # e.g. the median of a measurement without sub-values, would break the color scale
+        with self._lock:
+            self._cells[roi] = value
+            if self._min is None or value < self._min or value > self._max:
+                # color scale changed, all cells need new colors
+                self._min = value if self._min is None else min(self._min, value)
+                self._max = value if self._max is None else max(self._max, value)
+                for cell_roi, cell_value in self._cells.items():
+                    self._paint(cell_roi, cell_value)
+            else:
+                self._paint(roi, value)
+
+    def set_view_offset(self, offset_x: float, offset_y: float) -> None:
+        """Sets where the current view is relative to the neutral view (pixels), e.g. from the gimbal target angle."""
+        with self._lock:
+            self._offset = (int(round(offset_x)), int(round(offset_y)))
+
+    def set_target(self, x: float, y: float) -> None:
+        """Shows a crosshair at the given pixel of the live frame, e.g. the beam spot. None hides it."""
+        with self._lock:
+            self._target = None if x is None else (int(round(x)), int(round(y)))
+
+    def flag_cell(self, roi: Roi) -> None:
+        """Marks the cell covering roi (neutral image coordinates) with a plume alert, shown as frame and banner."""
+        with self._lock:
+            if roi not in self._alerts:
+                self._alerts.append(roi)
+
+    def reset(self) -> None:
+        """Removes all cells, the crosshair and the view offset, e.g. before the next sweep."""
+        with self._lock:
+            self._layer[:] = 0
+            self._mask[:] = False
+            self._cells = {}
+            self._min = None
+            self._max = None
+            self._offset = (0, 0)
+            self._target = None
+            self._alerts = []
+
+    def apply(self, frame) -> np.ndarray:
+        """
+        Returns frame with the overlay composited. The returned image is a preallocated buffer that is overwritten by
+        the next call, so it has to be used (e.g. written to the stream) before apply() is called again.
+        """
+        with self._lock:
+            np.copyto(self._output, frame)
+            offset_x, offset_y = self._offset
+            # overlap of the shifted layer with the frame
+            x0, x1 = max(0, -offset_x), min(self._width, self._width - offset_x)
+            y0, y1 = max(0, -offset_y), min(self._height, self._height - offset_y)
+            if self._cells and x0 < x1 and y0 < y1:
+                output_region = self._output[y0:y1, x0:x1]
+                layer_region = self._layer[y0+offset_y:y1+offset_y, x0+offset_x:x1+offset_x]
+                blended = cv2.addWeighted(output_region, 1 - self.alpha, layer_region, self.alpha, 0)
+                np.copyto(output_region, blended, where=self._mask[y0+offset_y:y1+offset_y, x0+offset_x:x1+offset_x])
+            for roi in self._alerts:
+                # layer pixel p is shown at p - offset in the frame
+                cv2.rectangle(self._output, (roi.x - offset_x, roi.y - offset_y),
+                              (roi.x - offset_x + roi.width - 1, roi.y - offset_y + roi.height - 1), (0, 0, 255), 2)
+            if self._alerts:
+                cv2.putText(self._output, f"PLUME ALERT ({len(self._alerts)})", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255), 2)
+            if self._target is not None:
+                cv2.drawMarker(self._output, self._target, (255, 255, 255), cv2.MARKER_CROSS, 20, 2)
+        return self._output
@@ -0,0 +1,177 @@
+# Copyright (c) 2023 Bundesanstalt für Materialforschung und -prüfung, see LICENSE file
+# Panorama mode: sweeps of several camera field of view blocks stitched into one large image and density map.
+
+import math
+import os
+from logging import getLogger
+from typing import List, NamedTuple, Sequence
+
+import numpy as np
+
+from gascamera.tiles import TiledImageStore
+
+logger = getLogger(__name__)
+
+MEMMAP_THRESHOLD = 256 * 1024 * 1024 # bytes, larger canvases are memory-mapped files
+
+
+class PanoramaBlock(NamedTuple):
+    """One camera field of view of the panorama, swept like a single rig sweep around yaw, pitch (degrees)."""
+    column: int
+    row: int
+    yaw: float
+    pitch: float
+
+
+def _block_centers(scene: float, fov: float, overlap: float, center: float) -> List[float]:
+    """Returns the centers of the blocks along one axis so that the blocks cover the scene."""
+    if scene <= fov:
+        return [center]
+    count = math.ceil((scene - fov) / (fov * (1 - overlap))) + 1
+    step = (scene - fov) / (count - 1) # spread evenly, so the overlap is at least the requested one
+    return [center - (scene - fov) / 2 + index * step for index in range(count)]
+
+
+def plan_blocks(scene_yaw: float, scene_pitch: float, fov_yaw: float, fov_pitch: float, overlap: float = 0.0,
+                center_yaw: float = 0.0, center_pitch: float = 0.0, start_yaw: float = 0.0,
+                start_pitch: float = 0.0) -> List[PanoramaBlock]:
+    """
+    Returns the blocks covering a scene of scene_yaw * scene_pitch degrees around center_yaw, center_pitch in the order
+    to sweep them. The blocks are visited in serpentine order along the axis with more blocks, so consecutive blocks
+    are neighbours and there are few long moves. The serpentine starts at the corner closest to start_yaw, start_pitch
+    (the current gimbal direction). The overlap is the fraction of the field of view shared by neighbouring blocks.
+    """
+    if not 0 <= overlap < 1:
+        raise ValueError(f"overlap must be in [0, 1), got {overlap}")
+    yaws = _block_centers(scene_yaw, fov_yaw, overlap, center_yaw)
+    pitches = _block_centers(scene_pitch, fov_pitch, overlap, center_pitch)
+    columns = list(range(len(yaws)))
+    rows = list(range(len(pitches)))
+    if abs(yaws[-1] - start_yaw) < abs(yaws[0] - start_yaw):
+        columns.reverse()
+    if abs(pitches[-1] - start_pitch) < abs(pitches[0] - start_pitch):
+        rows.reverse()
+
+    blocks = []
+    if len(yaws) >= len(pitches):
+        for index, row in enumerate(rows):
+            for column in (columns if index % 2 == 0 else columns[::-1]):
+                blocks.append(PanoramaBlock(column, row, yaws[column], pitches[row]))
+    else:
+        for index, column in enumerate(columns):
+            for row in (rows if index % 2 == 0 else rows[::-1]):
+                blocks.append(PanoramaBlock(column, row, yaws[column], pitches[row]))
+    return blocks
+
+
+def travel(blocks: Sequence[PanoramaBlock], start_yaw: float = 0.0, start_pitch: float = 0.0) -> float:
+    """Returns the gimbal travel (degrees, largest axis per move) to visit blocks in order from the start direction."""
+    total = 0.0
+    yaw, pitch = start_yaw, start_pitch
+    for block in blocks:
+        total += max(abs(block.yaw - yaw), abs(block.pitch - pitch))
+        yaw, pitch = block.yaw, block.pitch
+    return total
+
+
+def _allocate(filename: str, shape: tuple, dtype, fill, memmap_threshold: int) -> np.ndarray:
+    """Returns an array initialized to fill, as .npy memory-mapped file if it is larger than memmap_threshold bytes."""
+    if filename is not None and np.prod(shape) * np.dtype(dtype).itemsize > memmap_threshold:
+        logger.info(f"memory-mapping {filename} ({np.prod(shape) * np.dtype(dtype).itemsize / 1e6:.0f} MB)")
+        array = np.lib.format.open_memmap(filename, mode="w+", dtype=dtype, shape=shape)
+        array[:] = fill
+        return array
+    return np.full(shape, fill, dtype=dtype)
+
+
+class PanoramaCanvas:
+    """
+    Stitched image and density maps of a panorama. The block images are placed by their angle (pixels per degree of
+    the camera), overlapping regions are taken from the block swept last. The density maps hold the cells of all
+    blocks in block layout (row * y_steps + y_step, column * x_steps + x_step), so overlapping cells stay separate,
+    block_densities() places them at the pixels of their blocks for the overlays.
+    An image larger than memmap_threshold bytes is a gascamera.tiles.TiledImageStore in directory/panorama_image,
+    larger density maps are memory-mapped .npy files in directory.
+    """
+
+    def __init__(self, blocks: Sequence[PanoramaBlock], frame_width: int, frame_height: int, fov_yaw: float,
+                 fov_pitch: float, x_steps: int, y_steps: int, directory: str = None,
+                 memmap_threshold: int = MEMMAP_THRESHOLD) -> None:
+        self.blocks = list(blocks)
+        self.frame_width = frame_width
+        self.frame_height = frame_height
+        self.x_steps = x_steps
+        self.y_steps = y_steps
+        self._pixels_per_degree_x = frame_width / fov_yaw
+        self._pixels_per_degree_y = frame_height / fov_pitch
+        self._yaw_min = min(block.yaw for block in blocks)
+        self._pitch_min = min(block.pitch for block in blocks)
+        self._inserted = [] # swept blocks in sweep order
+        columns = max(block.column for block in blocks) + 1
+        rows = max(block.row for block in blocks) + 1
+        width = max(self._origin(block)[0] for block in blocks) + frame_width
+        height = max(self._origin(block)[1] for block in blocks) + frame_height
+
+        def path(name):
+            return None if directory is None else os.path.join(directory, name)
+
+        if directory is not None and height * width * 3 > memmap_threshold:
+            logger.info(f"storing panorama image as tiles ({height * width * 3 / 1e6:.0f} MB)")
+            self.image = TiledImageStore(path("panorama_image"), width, height)
+        else:
+            self.image = np.zeros((height, width, 3), np.uint8)
+        self.column_densities_mean = _allocate(path("panorama_mean.npy"), (rows * y_steps, columns * x_steps), np.float64, np.nan, memmap_threshold)
+        self.column_densities_median = _allocate(path("panorama_median.npy"), (rows * y_steps, columns * x_steps), np.float64, np.nan, memmap_threshold)
+
+    def _origin(self, block: PanoramaBlock) -> tuple:
+        """Returns the pixel position of the top left corner of the block image in the canvas."""
+        return (int(round((block.yaw - self._yaw_min) * self._pixels_per_degree_x)),
+                int(round((block.pitch - self._pitch_min) * self._pixels_per_degree_y)))
+
+    def insert(self, block: PanoramaBlock, assembled_image, column_densities_mean, column_densities_median) -> None:
+        """Copies the assembled image and the density maps of a swept block into the canvas."""
+        x, y = self._origin(block)
+        self.image[y:y + self.frame_height, x:x + self.frame_width] = assembled_image
+        cells = (slice(block.row * self.y_steps, (block.row + 1) * self.y_steps),
+                 slice(block.column * self.x_steps, (block.column + 1) * self.x_steps))
+        self.column_densities_mean[cells] = column_densities_mean
+        self.column_densities_median[cells] = column_densities_median
+        self._inserted.append(block)
+
+    def block_densities(self, statistic: str = "median") -> list:
+        """
+        Returns (x, y, column densities) of the swept blocks in sweep order, with the pixel origin of the block image,
+        see gascamera.overlay.create_block_overlay(). Blocks that were not swept (aborted panorama) are left out.
+        """
+        densities = self.column_densities_median if statistic == "median" else self.column_densities_mean
+        return [self._origin(block) + (np.array(densities[block.row * self.y_steps:(block.row + 1) * self.y_steps,
+                                                          block.column * self.x_steps:(block.column + 1) * self.x_steps]),)
+                for block in self._inserted]
+
+    def flush(self) -> None:
+        """Writes the memory-mapped and tiled canvases to disk."""
+        for array in (self.image, self.column_densities_mean, self.column_densities_median):
+            if isinstance(array, (np.memmap, TiledImageStore)):
+                array.flush()
+
+
+def run_panorama(camera, blocks: Sequence[PanoramaBlock], canvas: PanoramaCanvas) -> dict:
+    """
+    Sweeps all blocks with an opened gascamera.camera.VirtualGasCamera and stitches them into canvas.
+    Returns the panorama experiment data with the experiment data of every block (without the images).
+    """
+    block_experiments = []
+    for index, block in enumerate(blocks):
+        logger.info(f"panorama block {index + 1}/{len(blocks)}: column {block.column}, row {block.row}, "
+                    f"yaw {block.yaw:.2f} deg, pitch {block.pitch:.2f} deg")
+        camera.center_yaw, camera.center_pitch = block.yaw, block.pitch
+        camera.reset_experiment()
+        experiment = camera.sweep()
+        canvas.insert(block, camera.assembled_image, experiment["column_densities_mean"], experiment["column_densities_median"])
+        block_experiments.append(dict(experiment, block=block._asdict()))
+        if experiment["aborted"]:
+            break
+    canvas.flush()
+    camera.center_yaw, camera.center_pitch = camera.config.center_yaw, camera.config.center_pitch
+    camera.hold(0, 0)
+    return {"blocks": block_experiments, "travel": travel(blocks, camera.config.center_yaw, camera.config.center_pitch)}
@@ -0,0 +1,92 @@
+# Copyright (c) 2023 Bundesanstalt für Materialforschung und -prüfung, see LICENSE file
+# Quality scoring of the per-cell measurements (signal strength, sub-value spread, outliers) for selective re-measurement.
+
+from logging import getLogger
+from typing import NamedTuple
+
+import numpy as np
+
+logger = getLogger(__name__)
+
+FLAG_WEAK_SIGNAL = "weak_signal"
+FLAG_SPREAD = "spread"
+FLAG_OUTLIER = "outlier"
+
+
+class QualityThresholds(NamedTuple):
+    """
+    Limits for flagging cells. The relative limits compare against the median over all cells of the sweep, so they
+    work without knowing the absolute signal levels of a setup. The absolute limits are optional (None disables them).
+    """
+    weak_signal_fraction: float = 0.2 # flag if the 1f signal is below this fraction of the median 1f signal
+    min_signal_1f: float = None # flag if the 1f signal is below this level
+    spread_factor: float = 3.0 # flag if the sub-value std is above this factor times the median std
+    max_spread: float = None # flag if the sub-value std is above this (ppm*m)
+    outlier_z: float = 3.5 # flag if the robust z-score against the neighbouring cells is above this
+
+
+def cell_statistics(measurement: dict) -> dict:
+    """Returns the quality relevant statistics of a measurement as returned by laserfalcon.device.Device.get_measurement()."""
+    values = [sub_value["value"] for sub_value in measurement["sub_values"]]
+    return {
+        "main_value": measurement["main_value"],
+        "median": float(np.median(values)),
+        "mean": float(np.mean(values)),
+        "std": float(np.std(values)),
+        # the 1f amplitude is proportional to the received laser power, i.e. the strength of the reflection
+        "signal_1f": float(np.median([sub_value["1f"] for sub_value in measurement["sub_values"]])),
+        "signal_2f": float(np.median([sub_value["2f"] for sub_value in measurement["sub_values"]])),
+        "subsamples": len(values),
+    }
+
+
+def _neighbour_median(grid: np.ndarray) -> np.ndarray:
+    """Returns the median of the (up to 8) neighbours of every cell, NaN cells are ignored."""
+    padded = np.pad(grid, 1, constant_values=np.nan)
+    height, width = grid.shape
+    neighbours = np.stack([padded[1 + dy:1 + dy + height, 1 + dx:1 + dx + width]
+                           for dy in (-1, 0, 1) for dx in (-1, 0, 1) if (dy, dx) != (0, 0)])
+    return np.nanmedian(neighbours, axis=0)
+
+
+def flag_cells(statistics, thresholds: QualityThresholds = QualityThresholds()) -> list:
+    """
+    Returns the quality flags (list of FLAG_* strings, empty for good cells) for a y_steps * x_steps grid of
+    cell_statistics() dicts. Cells without statistics (None) get no flags.
+    Outliers are detected on the median values against the median of the neighbouring cells, so extended plumes
+    are not flagged, but single cells that differ strongly from their surroundings are.
+    """
+    height, width = len(statistics), len(statistics[0])
+
+    def field(key):
+        return np.array([[np.nan if cell is None else cell[key] for cell in row] for row in statistics], dtype=float)
+
+    signal_1f, spread, median = field("signal_1f"), field("std"), field("median")
+    weak = signal_1f < thresholds.weak_signal_fraction * np.nanmedian(signal_1f)
+    if thresholds.min_signal_1f is not None:
+        weak |= signal_1f < thresholds.min_signal_1f
+    high_spread = spread > thresholds.spread_factor * np.nanmedian(spread)
+    if thresholds.max_spread is not None:
+        high_spread |= spread > thresholds.max_spread
+
+    residuals = median - _neighbour_median(median)
+    mad = np.nanmedian(np.abs(residuals - np.nanmedian(residuals)))
+    # 1.4826 scales the MAD to the standard deviation of normally distributed residuals
+    outlier = np.abs(residuals) > thresholds.outlier_z * 1.4826 * max(mad, 1e-9)
+
+    flags = [[[] for _ in range(width)] for _ in range(height)]
+    for mask, flag in ((weak, FLAG_WEAK_SIGNAL), (high_spread, FLAG_SPREAD), (outlier, FLAG_OUTLIER)):
+        for y_step, x_step in zip(*np.nonzero(mask)):
+            flags[y_step][x_step].append(flag)
+    return flags
+
+
+def is_better(statistics: dict, flags: list, other_statistics: dict, other_flags: list) -> bool:
+    """
+    Returns True if the first measurement of a cell should be kept over the other: fewer flags, then lower noise.
+    The noise is the standard error of the sub-values, so merged repeats (more sub-values, pooled spread) compare fairly.
+    """
+    def noise(entry):
+        return entry["std"] / np.sqrt(entry.get("subsamples", 1))
+
+    return (len(flags), noise(statistics)) < (len(other_flags), noise(other_statistics))
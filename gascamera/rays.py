@@ -0,0 +1,188 @@
+# Copyright (c) 2023 Bundesanstalt für Materialforschung und -prüfung, see LICENSE file
+# Georeferenced measurement rays (robot pose + gimbal angles) and their fusion into a voxel grid for source localization.
+
+from datetime import datetime
+from logging import getLogger
+from typing import Iterator, NamedTuple, Sequence, Tuple
+
+import numpy as np
+
+from gascamera.geometry import Calibration
+
+logger = getLogger(__name__)
+
+# one measurement ray: origin and unit direction in world coordinates (meters, east/north/up), the column density
+# (ppm*m), the range to the reflecting surface (meters, NaN if unknown) and the measurement time (unix seconds)
+RAY_DTYPE = np.dtype([
+    ("origin", np.float32, 3),
+    ("direction", np.float32, 3),
+    ("column_density", np.float32),
+    ("range", np.float32),
+    ("time", np.float64),
+])
+
+
+class RobotPose(NamedTuple):
+    """
+    Position of the gimbal (meters, east/north/up in a local world frame) and the bearing of its yaw zero (degrees
+    clockwise from north). The gimbal IMU levels pitch against gravity, so the tilt of the robot is not needed.
+    """
+    east: float = 0.0
+    north: float = 0.0
+    up: float = 0.0
+    heading: float = 0.0
+
+
+def ray_directions(yaw, pitch, heading: float = 0.0) -> np.ndarray:
+    """
+    Returns the unit directions (east, north, up) for gimbal angles in degrees, positive yaw turns right (clockwise)
+    and positive pitch points down, like the angles of the sweep. The result has the shape of yaw plus the axis 3.
+    """
+    bearing = np.radians(np.asarray(yaw, dtype=float) + heading)
+    elevation = -np.radians(np.asarray(pitch, dtype=float))
+    return np.stack([np.cos(elevation) * np.sin(bearing), np.cos(elevation) * np.cos(bearing), np.sin(elevation)], axis=-1)
+
+
+def experiment_rays(experiment: dict, pose: RobotPose = None, key: str = "column_densities_median",
+                    range_estimate: float = None) -> np.ndarray:
+    """
+    Returns the rays of all measured cells of an experiment as array of RAY_DTYPE. The frame angles of the gimbal read
+    after settling ("cell_gimbal_angles") are used if present, else the target angles ("cell_angles"), both turned by
+    the offset of the measurement beam from the camera axis (see Calibration.beam_angles()). Gimbal angles of earlier
+    experiments are IMU angles with their own yaw zero, those experiments use the target angles. The time of a ray is the
+    measurement time of its cell ("cell_times"), or the end of the sweep for experiments without. The pose defaults
+    to the one stored in the experiment. The range estimate (meters) is the same for all cells, None leaves it unknown.
+    """
+    if pose is None:
+        pose = RobotPose(**experiment["pose"]) if experiment.get("pose") else RobotPose()
+    values = np.asarray(experiment[key], dtype=float).ravel()
+    angles = np.asarray(experiment["cell_angles"], dtype=float).reshape(-1, 2)
+    yaw, pitch = angles[:, 0], angles[:, 1]
+    if experiment.get("cell_gimbal_angles") is not None and experiment.get("cell_gimbal_angles_reference") == "frame":
+        # roll, pitch, yaw per cell, cells without reading are None and keep their target angles
+        gimbal_angles = np.array([[np.nan] * 3 if cell is None else cell for row in experiment["cell_gimbal_angles"] for cell in row], dtype=float)
+        read = ~np.isnan(gimbal_angles[:, 2])
+        yaw, pitch = np.where(read, gimbal_angles[:, 2], yaw), np.where(read, gimbal_angles[:, 1], pitch)
+    if experiment.get("calibration"):
+        beam_yaw, beam_pitch = Calibration(**experiment["calibration"]).beam_angles()
+        yaw, pitch = yaw + beam_yaw, pitch + beam_pitch
+    if experiment.get("cell_times") is not None and "start" in experiment:
+        start = datetime.strptime(experiment["start"], '%Y-%m-%dT%H:%M:%S.%fZ').timestamp()
+        times = start + np.array([np.nan if time is None else time for row in experiment["cell_times"] for time in row], dtype=float)
+    else:
+        times = np.full(len(values), datetime.strptime(experiment["end"], '%Y-%m-%dT%H:%M:%S.%fZ').timestamp() if "end" in experiment else np.nan)
+    measured = ~(np.isnan(values) | np.isnan(yaw) | np.isnan(pitch))
+
+    rays = np.zeros(np.count_nonzero(measured), RAY_DTYPE)
+    rays["origin"] = (pose.east, pose.north, pose.up)
+    rays["direction"] = ray_directions(yaw[measured], pitch[measured], pose.heading)
+    rays["column_density"] = values[measured]
+    rays["range"] = np.nan if range_estimate is None else range_estimate
+    rays["time"] = times[measured]
+    return rays
+
+
+def ray_points(rays: np.ndarray) -> np.ndarray:
+    """Returns the 3D points (surface hits) of rays with known range, rays without range are skipped."""
+    known = ~np.isnan(rays["range"])
+    return rays["origin"][known] + rays["direction"][known] * rays["range"][known, np.newaxis]
+
+
+def save_rays(filename: str, rays: np.ndarray) -> None:
+    """Writes rays as .npy file, 36 bytes per ray."""
+    np.save(filename, np.asarray(rays, RAY_DTYPE))
+
+
+def load_rays(filename: str) -> np.ndarray:
+    rays = np.load(filename)
+    if rays.dtype != RAY_DTYPE:
+        raise ValueError(f"{filename} does not contain rays, dtype is {rays.dtype}")
+    return rays
+
+
+def ray_lengths(rays: np.ndarray, max_range: float) -> np.ndarray:
+    """Returns the length of the rays in meters, max_range for rays without range."""
+    return np.where(np.isnan(rays["range"]), max_range, rays["range"]).astype(np.float64)
+
+
+def sample_rays(rays: np.ndarray, origin, shape: Tuple[int, int, int], size: float, max_range: float,
+                chunk_samples: int = 2 ** 22) -> Iterator[Tuple[np.ndarray, np.ndarray, float]]:
+    """
+    Samples the rays at half the voxel size inside a grid starting at origin with shape voxels of size meters.
+    Yields the ray index and flat voxel index of every sample inside the grid and the sample length (meters), in
+    chunks of about chunk_samples samples so the memory use stays bounded for many rays.
+    """
+    origin = np.asarray(origin, dtype=np.float64)
+    lengths = ray_lengths(rays, max_range)
+    step = size / 2
+    samples = int(np.ceil(lengths.max() / step))
+    rays_per_chunk = max(1, chunk_samples // samples)
+    t = (np.arange(samples) + 0.5) * step
+    for start in range(0, len(rays), rays_per_chunk):
+        chunk = rays[start:start + rays_per_chunk]
+        # rays x samples x 3 sample points, samples beyond the ray length are masked
+        points = chunk["origin"][:, np.newaxis, :] + chunk["direction"][:, np.newaxis, :] * t[np.newaxis, :, np.newaxis]
+        indices = np.floor((points - origin) / size).astype(np.int64)
+        inside = (t[np.newaxis, :] < lengths[start:start + len(chunk), np.newaxis]) & np.all((indices >= 0) & (indices < shape), axis=2)
+        ray_index = np.broadcast_to(np.arange(start, start + len(chunk))[:, np.newaxis], inside.shape)[inside]
+        yield ray_index, np.ravel_multi_index(tuple(indices[inside].T), shape), step
+
+
+class VoxelAccumulator:
+    """
+    Fuses the rays of many sweeps (e.g. from different robot positions) into a voxel grid by back-projection:
+    the column density of a ray is spread evenly over its path (mean concentration = column density / path length),
+    every voxel keeps the path length weighted mean of the rays through it. Voxels crossed by rays from several
+    directions with high values localize the source.
+    The grid starts at origin (meters, east/north/up), has shape voxels along the axes and cubic voxels of size meters.
+    """
+
+    def __init__(self, origin: Sequence[float], shape: Tuple[int, int, int], size: float, max_range: float = 50.0,
+                 chunk_samples: int = 2 ** 22) -> None:
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.shape = tuple(shape)
+        self.size = size
+        self.max_range = max_range # meters, used for rays without range
+        self.chunk_samples = chunk_samples # ray samples per vectorized step, limits the memory use
+        self.weighted_sum = np.zeros(self.shape) # sum of concentration * path length
+        self.path_length = np.zeros(self.shape) # sum of path length, the support of a voxel
+        self.rays = 0
+
+    def add(self, rays: np.ndarray) -> None:
+        """Casts the rays through the grid, sampled at half the voxel size along every ray."""
+        if len(rays) == 0:
+            return
+        concentration = rays["column_density"] / ray_lengths(rays, self.max_range)
+        # the grids are contiguous, so the flat views write through
+        weighted_sum, path_length = self.weighted_sum.reshape(-1), self.path_length.reshape(-1)
+        for ray_index, voxel, step in sample_rays(rays, self.origin, self.shape, self.size, self.max_range, self.chunk_samples):
+            np.add.at(weighted_sum, voxel, concentration[ray_index] * step)
+            np.add.at(path_length, voxel, step)
+        self.rays += len(rays)
+
+    def concentration(self) -> np.ndarray:
+        """Returns the mean concentration (ppm) per voxel, NaN for voxels not crossed by any ray."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.path_length > 0, self.weighted_sum / self.path_length, np.nan)
+
+    def voxel_center(self, index) -> np.ndarray:
+        """Returns the world position of the center of a voxel index."""
+        return self.origin + (np.asarray(index) + 0.5) * self.size
+
+    def localize(self, min_path_length: float = None) -> Tuple[np.ndarray, float]:
+        """
+        Returns the center of the voxel with the highest mean concentration and the concentration. Only voxels with a
+        support of at least min_path_length (default: one voxel size, i.e. two ray samples) are considered.
+        """
+        min_path_length = self.size if min_path_length is None else min_path_length
+        concentration = self.concentration()
+        concentration[~(self.path_length >= min_path_length)] = np.nan
+        if np.all(np.isnan(concentration)):
+            raise RuntimeError("no voxel with enough support for localization")
+        index = np.unravel_index(np.nanargmax(concentration), self.shape)
+        return self.voxel_center(index), float(concentration[index])
+
+    def save(self, filename: str) -> None:
+        """Writes the grid (concentration, support and geometry) as .npz file."""
+        np.savez_compressed(filename, concentration=self.concentration(), path_length=self.path_length,
+                            origin=self.origin, size=self.size, rays=self.rays)
@@ -0,0 +1,166 @@
+# Copyright (c) 2023 Bundesanstalt für Materialforschung und -prüfung, see LICENSE file
+# Reconstruction of dense (image resolution) column density maps from the coarse per-cell measurement grid.
+
+from logging import getLogger
+
+import cv2
+import numpy as np
+
+from gascamera.geometry import cell_edges
+
+logger = getLogger(__name__)
+
+CHUNK_PIXELS = 16384 # number of output pixels evaluated at once by the point based methods, limits memory use
+
+
+def cell_centers(x_steps: int, y_steps: int, width: int, height: int) -> np.ndarray:
+    """
+    Returns the pixel coordinates of the cell centers of an x_steps * y_steps grid covering an image of width * height pixels.
+    The result has the shape (y_steps * x_steps, 2) with columns x, y in row-major cell order (same as grid.ravel()).
+    """
+    x_edges = cell_edges(x_steps, width)
+    y_edges = cell_edges(y_steps, height)
+    x_centers = (x_edges[:-1] + x_edges[1:]) / 2
+    y_centers = (y_edges[:-1] + y_edges[1:]) / 2
+    grid_x, grid_y = np.meshgrid(x_centers, y_centers)
+    return np.column_stack((grid_x.ravel(), grid_y.ravel()))
+
+
+def _pixel_chunks(width: int, height: int):
+    """Yields (start, stop, pixel coordinates) for chunks of the flattened width * height pixel grid."""
+    n_pixels = width * height
+    for start in range(0, n_pixels, CHUNK_PIXELS):
+        indices = np.arange(start, min(start + CHUNK_PIXELS, n_pixels))
+        # use pixel centers
+        coordinates = np.column_stack((indices % width + 0.5, indices // width + 0.5)).astype(np.float32)
+        yield start, start + len(indices), coordinates
+
+
+def _squared_distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Returns the matrix of squared euclidean distances between the rows of a and b."""
+    return ((a[:, np.newaxis, :] - b[np.newaxis, :, :]) ** 2).sum(axis=2)
+
+
+def block(column_densities, width: int, height: int) -> np.ndarray:
+    """Paints every cell as a flat block of pixels (no interpolation), this is what the overlay originally used."""
+    grid = np.asarray(column_densities, dtype=np.float32)
+    y_steps, x_steps = grid.shape
+    col_counts = np.diff(cell_edges(x_steps, width))
+    row_counts = np.diff(cell_edges(y_steps, height))
+    return np.repeat(np.repeat(grid, row_counts, axis=0), col_counts, axis=1)
+
+
+def inverse_distance_weighting(points, values, width: int, height: int, power: float = 2.0, neighbours: int = None) -> np.ndarray:
+    """
+    Interpolates the values measured at points (array of pixel coordinates x, y) to a dense width * height map
+    using inverse distance weighting. If neighbours is given, only this many nearest points are used per pixel.
+    """
+    points = np.asarray(points, dtype=np.float32)
+    values = np.asarray(values, dtype=np.float32)
+    result = np.empty(width * height, np.float32)
+
+    for start, stop, pixels in _pixel_chunks(width, height):
+        distances = _squared_distances(pixels, points) ** (power / 2)
+        if neighbours is not None and neighbours < len(points):
+            nearest = np.argpartition(distances, neighbours, axis=1)[:, :neighbours]
+            distances = np.take_along_axis(distances, nearest, axis=1)
+            chunk_values = values[nearest]
+        else:
+            chunk_values = values[np.newaxis, :]
+        # pixels on top of a measurement point get its value directly
+        weights = 1.0 / np.maximum(distances, 1e-6)
+        result[start:stop] = (weights * chunk_values).sum(axis=1) / weights.sum(axis=1)
+
+    return result.reshape(height, width)
+
+
+def gaussian_process(points, values, width: int, height: int, length_scale: float = None, noise: float = 0.05, return_std: bool = False):
+    """
+    Interpolates the values measured at points (array of pixel coordinates x, y) to a dense width * height map
+    using Gaussian process regression (simple kriging) with a squared exponential covariance and a constant mean.
+    The length_scale is given in pixels and defaults to the mean distance to the nearest measurement point.
+    The noise is the measurement noise variance relative to the variance of the values.
+    If return_std is True, the standard deviation of the prediction is returned as second map.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+
+    mean = values.mean()
+    variance = values.var()
+    if variance == 0:
+        variance = 1.0 # flat field, any positive value works
+    if length_scale is None:
+        point_distances = _squared_distances(points, points)
+        np.fill_diagonal(point_distances, np.inf)
+        length_scale = np.sqrt(point_distances.min(axis=1)).mean()
+    logger.debug(f"gaussian process length scale: {length_scale} pixels")
+
+    covariance = variance * np.exp(-_squared_distances(points, points) / (2 * length_scale ** 2))
+    covariance[np.diag_indices_from(covariance)] += noise * variance
+    cholesky = np.linalg.cholesky(covariance)
+    alpha = np.linalg.solve(cholesky.T, np.linalg.solve(cholesky, values - mean))
+
+    result = np.empty(width * height, np.float32)
+    result_std = np.empty(width * height, np.float32) if return_std else None
+    for start, stop, pixels in _pixel_chunks(width, height):
+        cross_covariance = variance * np.exp(-_squared_distances(pixels.astype(np.float64), points) / (2 * length_scale ** 2))
+        result[start:stop] = mean + cross_covariance @ alpha
+        if return_std:
+            solved = np.linalg.solve(cholesky, cross_covariance.T)
+            result_std[start:stop] = np.sqrt(np.maximum(variance - (solved ** 2).sum(axis=0), 0))
+
+    if return_std:
+        return result.reshape(height, width), result_std.reshape(height, width)
+    return result.reshape(height, width)
+
+
+def deconvolve_gaussian_beam(column_densities, width: int, height: int, beam_sigma: float = 0.5, iterations: int = 20) -> np.ndarray:
+    """
+    Removes the blur of a Gaussian measurement beam from the grid using Richardson-Lucy deconvolution
+    and upsamples the result to width * height with bicubic interpolation.
+    The beam_sigma is given in cells. Negative values are clipped to zero before deconvolution, cells that were not
+    measured (NaN) are filled with the median of the measured cells.
+    """
+    observed = np.asarray(column_densities, dtype=np.float32)
+    observed = np.clip(np.where(np.isnan(observed), np.nanmedian(observed) if not np.isnan(observed).all() else 0, observed), 0, None)
+    estimate = np.full_like(observed, max(observed.mean(), 1e-6))
+
+    def blur(grid):
+        return cv2.GaussianBlur(grid, (0, 0), sigmaX=beam_sigma, borderType=cv2.BORDER_REFLECT)
+
+    for _ in range(iterations):
+        # the gaussian kernel is symmetric, so the adjoint blur equals the blur
+        ratio = observed / np.maximum(blur(estimate), 1e-6)
+        estimate *= blur(ratio)
+
+    return cv2.resize(estimate, (width, height), interpolation=cv2.INTER_CUBIC)
+
+
+def _grid_to_points(column_densities, width: int, height: int):
+    """Returns the pixel coordinates and values of all measured (not NaN) cells of the grid."""
+    grid = np.asarray(column_densities, dtype=np.float32)
+    y_steps, x_steps = grid.shape
+    points = cell_centers(x_steps, y_steps, width, height)
+    values = grid.ravel()
+    measured = ~np.isnan(values)
+    return points[measured], values[measured]
+
+
+RECONSTRUCTION_METHODS = {
+    "block": lambda grid, width, height, **kwargs: block(grid, width, height),
+    "idw": lambda grid, width, height, **kwargs: inverse_distance_weighting(*_grid_to_points(grid, width, height), width, height, **kwargs),
+    "kriging": lambda grid, width, height, **kwargs: gaussian_process(*_grid_to_points(grid, width, height), width, height, **kwargs),
+    "deconvolution": deconvolve_gaussian_beam,
+}
+
+
+def reconstruct(column_densities, width: int, height: int, method: str = "block", **kwargs) -> np.ndarray:
+    """
+    Returns a dense height * width float32 map of column densities reconstructed from the y_steps * x_steps grid.
+    Cells that were not measured can be set to NaN, they are skipped by the 'idw' and 'kriging' methods, stay NaN
+    with 'block' (unsaturated in the overlays) and are filled with the median for 'deconvolution'.
+    The method is one of RECONSTRUCTION_METHODS, additional keyword arguments are passed on.
+    """
+    if method not in RECONSTRUCTION_METHODS:
+        raise ValueError(f"unknown reconstruction method '{method}', expected one of {list(RECONSTRUCTION_METHODS)}")
+    return RECONSTRUCTION_METHODS[method](column_densities, width, height, **kwargs)
@@ -0,0 +1,336 @@
+# Copyright (c) 2023 Bundesanstalt für Materialforschung und -prüfung, see LICENSE file
+# Recording of complete sessions (serial traffic and camera frames) and deterministic replay for offline runs.
+
+import glob
+import os
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from time import perf_counter, sleep
+
+import cv2
+import numpy as np
+
+logger = getLogger(__name__)
+
+# serial log record header: timestamp (seconds since session start), direction, payload length
+RECORD_HEADER = struct.Struct('<dcI')
+DIRECTION_WRITE = b'w'
+DIRECTION_READ = b'r'
+FRAME_CHUNK_SIZE = 100 # frames per .npy chunk file
+
+
+class RecordingSerial:
+    """Wraps a serial.Serial and appends every written and read byte with its timestamp to a log file."""
+
+    def __init__(self, connection, filename: str, start_time: float) -> None:
+        self._connection = connection
+        self._start_time = start_time
+        self._log = open(filename, 'wb')
+        self._lock = threading.Lock()
+
+    def _record(self, direction: bytes, data: bytes) -> None:
+        if not data:
+            return
+        with self._lock:
+            self._log.write(RECORD_HEADER.pack(perf_counter() - self._start_time, direction, len(data)))
+            self._log.write(data)
+
+    def write(self, data: bytes) -> int:
+        self._record(DIRECTION_WRITE, bytes(data))
+        return self._connection.write(data)
+
+    def read(self, size: int = 1) -> bytes:
+        data = self._connection.read(size)
+        self._record(DIRECTION_READ, data)
+        return data
+
+    def read_until(self, expected: bytes = b'\n', size: int = None) -> bytes:
+        data = self._connection.read_until(expected, size)
+        self._record(DIRECTION_READ, data)
+        return data
+
+    def flush(self) -> None:
+        self._connection.flush()
+        with self._lock:
+            self._log.flush()
+
+    def close(self) -> None:
+        self._connection.close()
+        with self._lock:
+            self._log.close()
+
+    def __getattr__(self, name):
+        # everything else (timeout, in_waiting, ...) is passed to the real connection
+        return getattr(self._connection, name)
+
+
+def read_serial_log(filename: str) -> list:
+    """Returns the records of a serial log as list of (timestamp, direction, data)."""
+    records = []
+    with open(filename, 'rb') as log:
+        while True:
+            header = log.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            timestamp, direction, length = RECORD_HEADER.unpack(header)
+            records.append((timestamp, direction, log.read(length)))
+    return records
+
+
+def read_serial_data(filename: str, direction: bytes = DIRECTION_READ) -> bytes:
+    """
+    Returns all bytes of one direction of a serial log concatenated, e.g. for parsing all recorded Laser Falcon
+    measurements at once with laserfalcon.parser.parse_measurements().
+    """
+    return b''.join(data for _, record_direction, data in read_serial_log(filename) if record_direction == direction)
+
+
+class FrameRecorder:
+    """
+    Records camera frames with timestamps into chunks of FRAME_CHUNK_SIZE frames (frames_NNNNN.npy and
+    timestamps_NNNNN.npy). Frames are copied into a preallocated chunk, full chunks are saved in a background thread.
+    """
+
+    def __init__(self, directory: str, start_time: float) -> None:
+        self._directory = directory
+        self._start_time = start_time
+        self._chunk = None
+        self._timestamps = np.empty(FRAME_CHUNK_SIZE)
+        self._count = 0
+        self._chunk_index = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="frame_recorder")
+
+    def write(self, frame) -> None:
+        if self._chunk is None:
+            self._chunk = np.empty((FRAME_CHUNK_SIZE, *frame.shape), frame.dtype)
+        self._chunk[self._count] = frame
+        self._timestamps[self._count] = perf_counter() - self._start_time
+        self._count += 1
+        if self._count == FRAME_CHUNK_SIZE:
+            self._save()
+
+    def _save(self) -> None:
+        if self._count == 0:
+            return
+        base = os.path.join(self._directory, f"{{}}_{self._chunk_index:05d}.npy")
+        # hand the full buffers to the writer thread and continue with new ones
+        chunk, timestamps = self._chunk[:self._count], self._timestamps[:self._count]
+        self._executor.submit(np.save, base.format("frames"), chunk)
+        self._executor.submit(np.save, base.format("timestamps"), timestamps)
+        self._chunk = np.empty_like(self._chunk)
+        self._timestamps = np.empty(FRAME_CHUNK_SIZE)
+        self._count = 0
+        self._chunk_index += 1
+
+    def close(self) -> None:
+        self._save()
+        self._executor.shutdown()
+
+
+class RecordingCapture:
+    """Wraps a cv2.VideoCapture and records every frame read with a FrameRecorder."""
+
+    def __init__(self, capture: cv2.VideoCapture, recorder: FrameRecorder) -> None:
+        self._capture = capture
+        self._recorder = recorder
+
+    def read(self):
+        ret, frame = self._capture.read()
+        if ret:
+            self._recorder.write(frame)
+        return ret, frame
+
+    def release(self) -> None:
+        self._capture.release()
+        self._recorder.close()
+
+    def __getattr__(self, name):
+        # get(), isOpened(), ... are passed to the real capture
+        return getattr(self._capture, name)
+
+
+class SessionRecorder:
+    """
+    Records a whole session into a directory: one serial log per named connection (<name>.bin),
+    the camera frames (see FrameRecorder) and the capture properties (capture.txt).
+    """
+
+    def __init__(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self._start_time = perf_counter()
+        logger.info(f"recording session to {directory}")
+
+    def serial(self, name: str, connection) -> RecordingSerial:
+        return RecordingSerial(connection, os.path.join(self.directory, f"{name}.bin"), self._start_time)
+
+    def capture(self, capture: cv2.VideoCapture) -> RecordingCapture:
+        properties = {"width": capture.get(cv2.CAP_PROP_FRAME_WIDTH), "height": capture.get(cv2.CAP_PROP_FRAME_HEIGHT),
+                      "fps": capture.get(cv2.CAP_PROP_FPS)}
+        with open(os.path.join(self.directory, "capture.txt"), 'w') as properties_file:
+            properties_file.write("\n".join(f"{key} {value}" for key, value in properties.items()))
+        return RecordingCapture(capture, FrameRecorder(self.directory, self._start_time))
+
+
+class ReplayClock:
+    """
+    Recorded session time during a replay. Serial replays synchronize it to the timestamps of matched commands, in
+    between it runs with speed times real time. A speed of None replays as fast as possible (time only advances with
+    the serial traffic), 1.0 replays in real time.
+    """
+
+    def __init__(self, speed: float = None) -> None:
+        self.speed = speed
+        self._recorded_time = 0.0
+        self._wall_time = perf_counter()
+        self._lock = threading.Lock()
+
+    def now(self) -> float:
+        with self._lock:
+            if self.speed is None:
+                return self._recorded_time
+            return self._recorded_time + (perf_counter() - self._wall_time) * self.speed
+
+    def sync(self, recorded_time: float) -> None:
+        with self._lock:
+            self._recorded_time = max(self._recorded_time, recorded_time)
+            self._wall_time = perf_counter()
+
+    def wait_until(self, recorded_time: float) -> None:
+        """Blocks until the recorded time is reached (real time replays only)."""
+        if self.speed is None:
+            return
+        remaining = (recorded_time - self.now()) / self.speed
+        if remaining > 0:
+            sleep(remaining)
+
+
+class ReplaySerial:
+    """
+    Replays a serial log in place of a serial.Serial. Every write is matched against the next recorded write with the
+    same bytes (non-matching recorded writes are skipped, e.g. if the idle phase was longer during recording), reads
+    return the bytes recorded after the matched write. Keeps the response latency in real time replays.
+    """
+
+    def __init__(self, filename: str, clock: ReplayClock) -> None:
+        self._clock = clock
+        records = read_serial_log(filename)
+        # group the records into (timestamp of write, written bytes, timestamp of response, response bytes)
+        self._exchanges = []
+        for timestamp, direction, data in records:
+            if direction == DIRECTION_WRITE:
+                if self._exchanges and self._exchanges[-1][2] is None:
+                    # consecutive writes without response in between belong to the same command
+                    previous = self._exchanges[-1]
+                    self._exchanges[-1] = (previous[0], previous[1] + data, None, b'')
+                else:
+                    self._exchanges.append((timestamp, data, None, b''))
+            elif self._exchanges:
+                write_time, written, response_time, response = self._exchanges[-1]
+                self._exchanges[-1] = (write_time, written, response_time if response_time is not None else timestamp, response + data)
+        self._index = 0
+        self._pending_write = b''
+        self._response = b''
+        self.timeout = None
+
+    def write(self, data: bytes) -> int:
+        # commands may be written in several parts, match once the bytes form a complete recorded command
+        self._pending_write += bytes(data)
+        for index in range(self._index, len(self._exchanges)):
+            write_time, written, response_time, response = self._exchanges[index]
+            if written == self._pending_write:
+                if index != self._index:
+                    logger.debug(f"replay skipped {index - self._index} recorded commands")
+                self._index = index + 1
+                self._pending_write = b''
+                self._clock.sync(write_time)
+                if response_time is not None:
+                    self._clock.wait_until(response_time)
+                self._response += response
+                return len(data)
+            if written.startswith(self._pending_write):
+                return len(data) # command not complete yet
+        raise RuntimeError(f"replay: no recorded command matches {self._pending_write}")
+
+    def read(self, size: int = 1) -> bytes:
+        data, self._response = self._response[:size], self._response[size:]
+        return data
+
+    def read_until(self, expected: bytes = b'\n', size: int = None) -> bytes:
+        end = self._response.find(expected)
+        end = len(self._response) if end < 0 else end + len(expected)
+        if size is not None:
+            end = min(end, size)
+        data, self._response = self._response[:end], self._response[end:]
+        return data
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    @property
+    def in_waiting(self) -> int:
+        return len(self._response)
+
+
+class ReplayCapture:
+    """
+    Replays recorded frames in place of a cv2.VideoCapture. read() returns the latest frame recorded before the
+    current time of the replay clock, so frames stay in sync with the replayed serial traffic at any replay speed.
+    """
+
+    def __init__(self, directory: str, clock: ReplayClock) -> None:
+        self._clock = clock
+        self._chunk_files = sorted(glob.glob(os.path.join(directory, "frames_*.npy")))
+        timestamps = [np.load(filename.replace("frames_", "timestamps_")) for filename in self._chunk_files]
+        self._timestamps = np.concatenate(timestamps) if timestamps else np.empty(0)
+        self._chunk_starts = np.cumsum([0] + [len(chunk) for chunk in timestamps])
+        self._loaded_chunk = (None, None)
+        self._properties = {}
+        with open(os.path.join(directory, "capture.txt"), 'r') as properties_file:
+            for line in properties_file:
+                key, value = line.split()
+                self._properties[key] = float(value)
+        self._opened = len(self._timestamps) > 0
+
+    def _frame(self, index: int):
+        chunk = int(np.searchsorted(self._chunk_starts, index, side='right') - 1)
+        if self._loaded_chunk[0] != chunk:
+            self._loaded_chunk = (chunk, np.load(self._chunk_files[chunk], mmap_mode='r'))
+        return np.array(self._loaded_chunk[1][index - self._chunk_starts[chunk]])
+
+    def read(self):
+        if not self._opened:
+            return False, None
+        index = max(int(np.searchsorted(self._timestamps, self._clock.now(), side='right')) - 1, 0)
+        return True, self._frame(index)
+
+    def get(self, property_id: int) -> float:
+        return {cv2.CAP_PROP_FRAME_WIDTH: self._properties.get("width", 0),
+                cv2.CAP_PROP_FRAME_HEIGHT: self._properties.get("height", 0),
+                cv2.CAP_PROP_FPS: self._properties.get("fps", 0)}.get(property_id, 0)
+
+    def isOpened(self) -> bool:
+        return self._opened
+
+    def release(self) -> None:
+        self._opened = False
+
+
+class SessionReplay:
+    """Replays a directory written by SessionRecorder. See ReplayClock for the meaning of speed."""
+
+    def __init__(self, directory: str, speed: float = None) -> None:
+        self.directory = directory
+        self.clock = ReplayClock(speed)
+        logger.info(f"replaying session from {directory}")
+
+    def serial(self, name: str) -> ReplaySerial:
+        return ReplaySerial(os.path.join(self.directory, f"{name}.bin"), self.clock)
+
+    def capture(self) -> ReplayCapture:
+        return ReplayCapture(self.directory, self.clock)
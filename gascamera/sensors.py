@@ -0,0 +1,164 @@
+# Copyright (c) 2023 Bundesanstalt für Materialforschung und -prüfung, see LICENSE file
+# Gas sensor abstraction: several sensors sampled concurrently, each on its own serial worker, merged per cell.
+
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from typing import Callable, List, Sequence, Tuple
+
+import numpy as np
+
+import laserfalcon.device
+from gascamera.geometry import Calibration, CellGeometry, cell_edges
+
+logger = getLogger(__name__)
+
+
+class Sensor(ABC):
+    """
+    Common interface of the gas sensors, subclasses implement measure(). The boresight offset is the direction of the
+    sensor beam relative to the main beam in degrees, the main sensor has an offset of 0, 0.
+    """
+
+    def __init__(self, name: str, boresight_yaw: float = 0.0, boresight_pitch: float = 0.0) -> None:
+        self.name = name
+        self.boresight_yaw = boresight_yaw
+        self.boresight_pitch = boresight_pitch
+
+    @abstractmethod
+    def measure(self) -> dict:
+        """
+        Returns one measurement in the layout of laserfalcon.device.Device.get_measurement(): 'error' (1 for a valid
+        measurement), 'main_value' (ppm*m) and 'sub_values', a list of dicts with 'value', '1f', '2f' and 'time'.
+        """
+
+    def settings(self) -> dict:
+        return {}
+
+    def close(self) -> None:
+        pass
+
+
+class LaserFalconSensor(Sensor):
+    """Laser Falcon TDLAS unit on its own serial connection."""
+
+    def __init__(self, name: str, connection, boresight_yaw: float = 0.0, boresight_pitch: float = 0.0) -> None:
+        super().__init__(name, boresight_yaw, boresight_pitch)
+        self._connection = connection
+        self.device = laserfalcon.device.Device(connection=connection)
+        self.version = self.device.get_version()
+
+    def measure(self) -> dict:
+        return self.device.get_measurement()
+
+    def settings(self) -> dict:
+        return self.device.get_settings()
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+class SensorArray:
+    """
+    Samples several sensors concurrently. Every sensor has a single worker thread, so the commands to one serial
+    connection stay in order while the sensors wait for their responses in parallel.
+    """
+
+    def __init__(self, sensors: Sequence[Sensor]) -> None:
+        if not sensors:
+            raise ValueError("at least one sensor is required")
+        self.sensors = list(sensors)
+        self._workers = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"sensor_{sensor.name}") for sensor in self.sensors]
+
+    def measure(self, indices: Sequence[int] = None, reposition: Callable[[], None] = None) -> Tuple[List[dict], List[List[int]]]:
+        """
+        Measures with the sensors at indices (default: all) concurrently until every one returned a valid measurement.
+        Failed sensors are measured again, after calling reposition (e.g. to clear optically related errors).
+        Returns the measurements and the error codes of the failed attempts, both per sensor (None for sensors not
+        measured).
+        """
+        indices = range(len(self.sensors)) if indices is None else indices
+        measurements = [None] * len(self.sensors)
+        error_codes = [None] * len(self.sensors)
+        for index in indices:
+            error_codes[index] = []
+        pending = list(indices)
+        while pending:
+            futures = [(index, self._workers[index].submit(self.sensors[index].measure)) for index in pending]
+            pending = []
+            for index, future in futures:
+                measurement = future.result()
+                if measurement["error"] == 1:
+                    measurements[index] = measurement
+                else:
+                    logger.error(f"sensor {self.sensors[index].name}: measurement failed with error code {measurement['error']}. Retrying")
+                    error_codes[index].append(measurement["error"])
+                    pending.append(index)
+            if pending and reposition is not None:
+                reposition()
+        return measurements, error_codes
+
+    def settings(self) -> dict:
+        """Returns the settings of all sensors by sensor name."""
+        return {sensor.name: sensor.settings() for sensor in self.sensors}
+
+    def close(self) -> None:
+        for worker, sensor in zip(self._workers, self.sensors):
+            worker.shutdown()
+            sensor.close()
+
+
+def sensor_cells(calibration: Calibration, cell: CellGeometry, sensors: Sequence[Sensor], x_steps: int, y_steps: int) -> list:
+    """
+    Returns the (x_step, y_step) of the cell each sensor points at while the main beam points at cell, or None if the
+    sensor beam is outside of the neutral frame.
+    """
+    x_edges = cell_edges(x_steps, calibration.frame_width)
+    y_edges = cell_edges(y_steps, calibration.frame_height)
+    result = []
+    for sensor in sensors:
+        if sensor.boresight_yaw == 0 and sensor.boresight_pitch == 0:
+            result.append((cell.x_step, cell.y_step))
+            continue
+        x, y = calibration.angle_to_pixel(cell.yaw + sensor.boresight_yaw, cell.pitch + sensor.boresight_pitch)
+        if not (0 <= x < calibration.frame_width and 0 <= y < calibration.frame_height):
+            result.append(None)
+            continue
+        result.append((int(np.searchsorted(x_edges, x, side='right') - 1), int(np.searchsorted(y_edges, y, side='right') - 1)))
+    return result
+
+
+def plan_sweep(calibration: Calibration, cell_table: Sequence[CellGeometry], sensors: Sequence[Sensor], x_steps: int,
+               y_steps: int) -> List[Tuple[CellGeometry, list]]:
+    """
+    Returns the cells to visit in sweep order with the cells covered by each sensor there (see sensor_cells()).
+    Cells already covered by a sensor at an earlier position are skipped, so sensors pointing at adjacent cells
+    divide the number of gimbal moves.
+    """
+    covered = set()
+    plan = []
+    for cell in cell_table:
+        if (cell.x_step, cell.y_step) in covered:
+            continue
+        targets = sensor_cells(calibration, cell, sensors, x_steps, y_steps)
+        covered.update(target for target in targets if target is not None)
+        plan.append((cell, targets))
+    return plan
+
+
+def merge_statistics(statistics: Sequence[dict]) -> dict:
+    """
+    Merges the gascamera.quality.cell_statistics() of several measurements of the same cell (e.g. by different
+    sensors): values are averaged, the spread is pooled and the signal is the weakest one.
+    """
+    if len(statistics) == 1:
+        return statistics[0]
+    return {
+        "main_value": float(np.mean([entry["main_value"] for entry in statistics])),
+        "median": float(np.mean([entry["median"] for entry in statistics])),
+        "mean": float(np.mean([entry["mean"] for entry in statistics])),
+        "std": float(np.sqrt(np.mean([entry["std"] ** 2 for entry in statistics]))),
+        "signal_1f": float(min(entry["signal_1f"] for entry in statistics)),
+        "signal_2f": float(min(entry["signal_2f"] for entry in statistics)),
+        "subsamples": sum(entry.get("subsamples", 1) for entry in statistics),
+    }
@@ -0,0 +1,210 @@
+# Copyright (c) 2023 Bundesanstalt für Materialforschung und -prüfung, see LICENSE file
+# Headless control of a camera rig: local asyncio HTTP server to start, abort and monitor sweeps and to download results.
+
+import asyncio
+import json
+import os
+from datetime import datetime
+from http import HTTPStatus
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+STATE_IDLE = "idle"
+STATE_SWEEPING = "sweeping"
+STATE_ERROR = "error"
+
+KEEPALIVE_INTERVAL = 15 # seconds between comments on idle event streams, so proxies do not close them
+
+
+class ControlServer:
+    """
+    HTTP/1.1 control API of an opened gascamera.camera.VirtualGasCamera, plain asyncio without further dependencies:
+
+        GET  /status            state, progress, last error and result files
+        GET  /progress          progress of the running sweep
+        POST /start             starts a sweep (409 if one is running)
+        POST /abort             stops the running sweep after the current cell
+        GET  /results           files of the last sweep
+        GET  /results/<name>    downloads one of these files
+        GET  /events            server-sent events: "cell" per measured cell, "state" on state changes
+
+    The sweep runs in a worker thread, the server stays responsive. Between sweeps the gimbal holds neutral, the hold
+    is checked every hold_check_interval of the camera config (see VirtualGasCamera.check_hold()). Binds to localhost by default, there is no authentication.
+    """
+
+    def __init__(self, camera, host: str = "127.0.0.1", port: int = 8000) -> None:
+        self.camera = camera
+        self.host = host
+        self.port = port
+        self.state = STATE_IDLE
+        self.error = None
+        self.identifier = None
+        self.results = [] # filenames of the last sweep
+        self._subscribers = set() # asyncio.Queue per event stream
+        self._loop = None
+        self._sweep_task = None
+        self._gimbal_lock = None # asyncio.Lock, sweeps and hold checks use the serial link of the gimbal in turn
+        camera.cell_listeners.append(self._on_cell)
+
+    def _on_cell(self, cell: dict) -> None:
+        """Called from the sweep thread, hands the cell to the event loop."""
+        self._loop.call_soon_threadsafe(self._publish, "cell", cell)
+
+    def _publish(self, event: str, data: dict) -> None:
+        for queue in self._subscribers:
+            queue.put_nowait((event, data))
+
+    def _set_state(self, state: str) -> None:
+        self.state = state
+        self._publish("state", self._status())
+
+    def _status(self) -> dict:
+        return {"state": self.state, "progress": self.camera.progress, "error": self.error, "identifier": self.identifier,
+                "results": [os.path.basename(filename) for filename in self.results]}
+
+    def _run_sweep(self, identifier: str) -> list:
+        """Runs a sweep and its export in the worker thread, returns the written files."""
+        self.camera.reset_experiment()
+        self.camera.sweep()
+        return self.camera.export(identifier).close()
+
+    async def _sweep(self) -> None:
+        name = self.camera.config.name
+        self.identifier = datetime.now().strftime('%Y-%m-%dT%H.%M.%S')
+        if name:
+            self.identifier = f"{name}_{self.identifier}"
+        self.error = None
+        self._set_state(STATE_SWEEPING)
+        try:
+            async with self._gimbal_lock:
+                self.results = await self._loop.run_in_executor(None, self._run_sweep, self.identifier)
+            self._set_state(STATE_IDLE)
+        except Exception as error:
+            logger.exception("sweep failed")
+            self.error = str(error)
+            self._set_state(STATE_ERROR)
+
+    async def _check_hold(self) -> None:
+        while True:
+            await asyncio.sleep(self.camera.config.hold_check_interval)
+            async with self._gimbal_lock:
+                if self.state == STATE_SWEEPING:
+                    continue
+                try:
+                    await self._loop.run_in_executor(None, self.camera.check_hold)
+                except Exception:
+                    logger.exception("hold check failed")
+
+    async def _respond(self, writer: asyncio.StreamWriter, status: HTTPStatus, body: bytes = b"",
+                       content_type: str = "application/json", headers: dict = None) -> None:
+        head = [f"HTTP/1.1 {status.value} {status.phrase}", f"Content-Type: {content_type}",
+                f"Content-Length: {len(body)}", "Connection: close"]
+        head += [f"{key}: {value}" for key, value in (headers or {}).items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + body)
+        await writer.drain()
+
+    async def _respond_json(self, writer: asyncio.StreamWriter, data, status: HTTPStatus = HTTPStatus.OK) -> None:
+        await self._respond(writer, status, json.dumps(data).encode())
+
+    async def _events(self, writer: asyncio.StreamWriter) -> None:
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n")
+        queue = asyncio.Queue()
+        self._subscribers.add(queue)
+        try:
+            writer.write(f"event: state\ndata: {json.dumps(self._status())}\n\n".encode())
+            await writer.drain()
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), KEEPALIVE_INTERVAL)
+                    writer.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode())
+                except asyncio.TimeoutError:
+                    writer.write(b": keepalive\n\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._subscribers.discard(queue)
+
+    async def _route(self, method: str, path: str, writer: asyncio.StreamWriter) -> None:
+        if method == "GET" and path == "/status":
+            await self._respond_json(writer, self._status())
+        elif method == "GET" and path == "/progress":
+            await self._respond_json(writer, self.camera.progress)
+        elif method == "POST" and path == "/start":
+            if self.state == STATE_SWEEPING:
+                await self._respond_json(writer, {"error": "a sweep is running"}, HTTPStatus.CONFLICT)
+                return
+            self.state = STATE_SWEEPING # before the task runs, so a second start is refused
+            self._sweep_task = asyncio.create_task(self._sweep())
+            await self._respond_json(writer, self._status(), HTTPStatus.ACCEPTED)
+        elif method == "POST" and path == "/abort":
+            if self.state != STATE_SWEEPING:
+                await self._respond_json(writer, {"error": "no sweep is running"}, HTTPStatus.CONFLICT)
+                return
+            self.camera.abort()
+            await self._respond_json(writer, self._status(), HTTPStatus.ACCEPTED)
+        elif method == "GET" and path == "/results":
+            await self._respond_json(writer, self._status()["results"])
+        elif method == "GET" and path.startswith("/results/"):
+            # only the files of the last sweep can be downloaded
+            files = {os.path.basename(filename): filename for filename in self.results}
+            filename = files.get(path[len("/results/"):])
+            if filename is None:
+                await self._respond_json(writer, {"error": "unknown result file"}, HTTPStatus.NOT_FOUND)
+                return
+            with open(filename, 'rb') as result_file:
+                body = await self._loop.run_in_executor(None, result_file.read)
+            await self._respond(writer, HTTPStatus.OK, body, "application/octet-stream",
+                                {"Content-Disposition": f'attachment; filename="{os.path.basename(filename)}"'})
+        elif method == "GET" and path == "/events":
+            await self._events(writer)
+        else:
+            await self._respond_json(writer, {"error": f"unknown endpoint {method} {path}"}, HTTPStatus.NOT_FOUND)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            if len(request_line) != 3:
+                await self._respond_json(writer, {"error": "malformed request"}, HTTPStatus.BAD_REQUEST)
+                return
+            method, path, _ = request_line
+            content_length = 0
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if not line:
+                    break
+                key, _, value = line.partition(":")
+                if key.strip().lower() == "content-length":
+                    content_length = int(value)
+            if content_length:
+                await reader.readexactly(content_length) # the endpoints take no body
+            await self._route(method, path.split("?")[0], writer)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as error:
+            logger.debug(f"control connection failed: {error}")
+        finally:
+            writer.close()
+
+    async def serve(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._gimbal_lock = asyncio.Lock()
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"control server listening on http://{self.host}:{self.port}")
+        hold_task = asyncio.create_task(self._check_hold())
+        try:
+            async with server:
+                await server.serve_forever()
+        except asyncio.CancelledError:
+            # stopped (e.g. ctrl+c), the running sweep ends after the current cell before the worker thread is joined
+            if self.state == STATE_SWEEPING:
+                self.camera.abort()
+            raise
+        finally:
+            hold_task.cancel()
+
+    def run(self) -> None:
+        """Serves until interrupted (ctrl+c)."""
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            logger.info("control server stopped")
@@ -0,0 +1,151 @@
+# Copyright (c) 2023 Bundesanstalt für Materialforschung und -prüfung, see LICENSE file
+# Configurable GStreamer backends for the live stream (encoder, downscaling, multiple sinks or no stream at all).
+
+from logging import getLogger
+from time import perf_counter, process_time, thread_time
+from typing import NamedTuple, Sequence
+
+import cv2
+import numpy as np
+
+logger = getLogger(__name__)
+
+# encoder pipeline elements and the type of their output, used to choose the matching sink elements
+ENCODERS = {
+    "x264": ("x264enc key-int-max={key_int_max} byte-stream=true tune=zerolatency bitrate={bitrate} speed-preset={preset}", "h264"),
+    "vaapi": ("vaapih264enc keyframe-period={key_int_max} bitrate={bitrate}", "h264"), # Intel/AMD GPUs
+    "v4l2": ("v4l2h264enc extra-controls=\"controls,video_bitrate={bitrate_bps}\" ! video/x-h264,level=(string)4", "h264"), # e.g. Raspberry Pi
+    "nvenc": ("nvh264enc bitrate={bitrate} gop-size={key_int_max} preset=low-latency-hq", "h264"), # NVIDIA GPUs
+    "mjpeg": ("jpegenc quality={quality}", "jpeg"),
+    "raw": ("video/x-raw,format=I420", "raw"),
+}
+
+SINKS = {
+    ("tcp", "h264"): "mpegtsmux ! tcpserversink port={port} host={host}",
+    ("tcp", "jpeg"): "multipartmux ! tcpserversink port={port} host={host}",
+    ("tcp", "raw"): "gdppay ! tcpserversink port={port} host={host}",
+    ("udp", "h264"): "rtph264pay config-interval=1 pt=96 ! udpsink host={host} port={port}",
+    ("udp", "jpeg"): "rtpjpegpay ! udpsink host={host} port={port}",
+    ("udp", "raw"): "rtpvrawpay ! udpsink host={host} port={port}",
+    ("file", "h264"): "h264parse ! matroskamux ! filesink location={location}",
+    ("file", "jpeg"): "matroskamux ! filesink location={location}",
+    ("file", "raw"): "matroskamux ! filesink location={location}",
+}
+
+
+class StreamSink(NamedTuple):
+    """Destination of the stream: kind is 'tcp' (server), 'udp' (RTP) or 'file' (recording)."""
+    kind: str
+    port: int = 5000
+    host: str = "0.0.0.0"
+    location: str = None
+
+
+class StreamConfig(NamedTuple):
+    """
+    Settings of the live stream. With no sinks, nothing is encoded ('no stream' mode), but frames are still read.
+    If the encoder can not be opened (e.g. missing hardware), the fallback encoders are tried in order.
+    """
+    encoder: str = "x264"
+    preset: str = "superfast" # x264 only
+    bitrate: int = 500 # kbit/s
+    key_int_max: int = 12
+    quality: int = 80 # mjpeg only
+    scale: float = 1.0 # downscaling factor applied before encoding
+    sinks: Sequence[StreamSink] = (StreamSink("tcp"),)
+    fallback_encoders: Sequence[str] = ("mjpeg",)
+
+
+def build_pipeline(config: StreamConfig, encoder: str) -> str:
+    """Returns the GStreamer pipeline string for cv2.VideoWriter using the given encoder."""
+    if encoder not in ENCODERS:
+        raise ValueError(f"unknown encoder '{encoder}', expected one of {list(ENCODERS)}")
+    encoder_template, output_type = ENCODERS[encoder]
+    encoder_element = encoder_template.format(key_int_max=config.key_int_max, bitrate=config.bitrate,
+                                              bitrate_bps=config.bitrate * 1000, preset=config.preset, quality=config.quality)
+    sink_elements = []
+    for sink in config.sinks:
+        if (sink.kind, output_type) not in SINKS:
+            raise ValueError(f"sink '{sink.kind}' does not support {output_type} output")
+        sink_elements.append(SINKS[(sink.kind, output_type)].format(**sink._asdict()))
+
+    pipeline = f'appsrc is_live=1 ! videoconvert !{encoder_element}'
+    if len(sink_elements) == 1:
+        return f'{pipeline} ! {sink_elements[0]}'
+    # several sinks share one encoder via a tee
+    branches = ' '.join(f't. ! queue ! {element}' for element in sink_elements)
+    return f'{pipeline} ! tee name=t {branches}'
+
+
+class StreamBackend:
+    """
+    Encodes and sends frames according to a StreamConfig. Measures the CPU time spent per frame, so the encoder
+    settings can be chosen per robot, see statistics(). GStreamer encodes in its own threads, so the process CPU time
+    per frame has to be compared against a run in 'no stream' mode (no sinks) to get the cost of streaming.
+    """
+
+    def __init__(self, config: StreamConfig, frame_width: int, frame_height: int, fps: int) -> None:
+        self.config = config
+        self.size = (int(frame_width * config.scale), int(frame_height * config.scale))
+        self.encoder = None
+        self._writer = None
+        self._scaled = np.empty((self.size[1], self.size[0], 3), np.uint8) if config.scale != 1.0 else None
+        self._frames = 0
+        self._thread_cpu_time = 0.0
+        self._wall_time = 0.0
+        self._process_cpu_start = None
+
+        if not config.sinks:
+            logger.info("no stream sinks configured, not streaming")
+            return
+        for encoder in (config.encoder, *config.fallback_encoders):
+            pipeline = build_pipeline(config, encoder)
+            logger.debug(f"opening stream pipeline: {pipeline}")
+            writer = cv2.VideoWriter(pipeline, cv2.CAP_GSTREAMER, 0, fps, self.size)
+            if writer.isOpened():
+                self.encoder = encoder
+                self._writer = writer
+                logger.info(f"streaming with encoder {encoder} at {self.size[0]}x{self.size[1]}")
+                return
+            logger.warning(f"could not open stream with encoder {encoder}")
+        raise RuntimeError("could not open stream with any of the configured encoders")
+
+    @property
+    def streaming(self) -> bool:
+        """True if frames are actually encoded and sent."""
+        return self._writer is not None
+
+    def isOpened(self) -> bool:
+        """Same meaning as cv2.VideoWriter.isOpened(), the 'no stream' mode is always open."""
+        return self._writer is None or self._writer.isOpened()
+
+    def write(self, frame) -> None:
+        if self._process_cpu_start is None:
+            self._process_cpu_start = process_time()
+        self._frames += 1
+        if self._writer is None:
+            return
+        cpu_start, wall_start = thread_time(), perf_counter()
+        if self._scaled is not None:
+            cv2.resize(frame, self.size, dst=self._scaled, interpolation=cv2.INTER_AREA)
+            frame = self._scaled
+        self._writer.write(frame)
+        self._thread_cpu_time += thread_time() - cpu_start
+        self._wall_time += perf_counter() - wall_start
+
+    def statistics(self) -> dict:
+        """
+        Returns the encoder, the number of frames and the mean times per frame in milliseconds: CPU time of the
+        writing thread (resize and handing over to GStreamer), wall time of write() and CPU time of the whole process.
+        """
+        frames = max(self._frames, 1)
+        process_cpu_time = process_time() - self._process_cpu_start if self._process_cpu_start is not None else 0.0
+        return {"encoder": self.encoder, "size": list(self.size), "frames": self._frames,
+                "thread_cpu_ms_per_frame": self._thread_cpu_time / frames * 1000,
+                "wall_ms_per_frame": self._wall_time / frames * 1000,
+                "process_cpu_ms_per_frame": process_cpu_time / frames * 1000}
+
+    def release(self) -> None:
+        if self._writer is not None:
+            self._writer.release()
+        logger.info(f"stream statistics: {self.statistics()}")
@@ -0,0 +1,190 @@
+# Copyright (c) 2023 Bundesanstalt für Materialforschung und -prüfung, see LICENSE file
+# Tiled image storage on disk for large mosaics and panoramas, with lazily opened tiles and pyramid levels for previews.
+
+import json
+import math
+import os
+from collections import OrderedDict
+from logging import getLogger
+from typing import Iterator, Tuple
+
+import cv2
+import numpy as np
+
+from gascamera.geometry import Roi
+
+logger = getLogger(__name__)
+
+TILE_SIZE = 512 # pixels, a 512 * 512 * 3 uint8 tile is 768 kB
+METADATA_FILE = "tiles.json"
+
+
+class TiledImageStore:
+    """
+    Large image split into square tiles, every tile is a memory-mapped .npy file in directory (level_0/tile_<y>_<x>.npy).
+    Tiles are created on first write and opened lazily, at most max_open_tiles are kept open, so the memory use does
+    not grow with the image size. Reading a tile that was never written returns fill.
+    The store is indexed like a numpy image, store[y0:y1, x0:x1] reads a copy and store[y0:y1, x0:x1] = image writes,
+    so it can replace the in-memory assembled image (e.g. of gascamera.mosaic.MosaicBuilder).
+    build_pyramid() adds levels downscaled by 2 each (level_1, level_2, ...) for quick previews.
+    """
+
+    def __init__(self, directory: str, width: int, height: int, channels: int = 3, dtype=np.uint8,
+                 tile_size: int = TILE_SIZE, fill=0, max_open_tiles: int = 64) -> None:
+        self.directory = directory
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.dtype = np.dtype(dtype)
+        self.tile_size = tile_size
+        self.fill = fill
+        self.max_open_tiles = max_open_tiles
+        self.levels = 1
+        self._open_tiles = OrderedDict() # (level, tile_x, tile_y) -> memmap, least recently used first
+        os.makedirs(os.path.join(directory, "level_0"), exist_ok=True)
+        self._save_metadata()
+
+    @classmethod
+    def open(cls, directory: str, max_open_tiles: int = 64) -> "TiledImageStore":
+        """Opens an existing store written before."""
+        with open(os.path.join(directory, METADATA_FILE), 'r') as jsonfile:
+            metadata = json.load(jsonfile)
+        levels = metadata.pop("levels")
+        store = cls(directory, max_open_tiles=max_open_tiles, **metadata)
+        store.levels = levels
+        return store
+
+    def _save_metadata(self) -> None:
+        with open(os.path.join(self.directory, METADATA_FILE), 'w') as jsonfile:
+            json.dump({"width": self.width, "height": self.height, "channels": self.channels, "dtype": self.dtype.str,
+                       "tile_size": self.tile_size, "fill": self.fill, "levels": self.levels}, jsonfile, indent=2)
+
+    @property
+    def shape(self) -> tuple:
+        return (self.height, self.width, self.channels) if self.channels > 1 else (self.height, self.width)
+
+    def level_size(self, level: int) -> Tuple[int, int]:
+        """Returns width and height of a pyramid level."""
+        return math.ceil(self.width / 2 ** level), math.ceil(self.height / 2 ** level)
+
+    def tiles(self, level: int = 0) -> Iterator[Tuple[int, int, Roi]]:
+        """Yields tile_x, tile_y and the region in the image of all tiles of a level."""
+        width, height = self.level_size(level)
+        for tile_y in range(math.ceil(height / self.tile_size)):
+            for tile_x in range(math.ceil(width / self.tile_size)):
+                x, y = tile_x * self.tile_size, tile_y * self.tile_size
+                yield tile_x, tile_y, Roi(x, y, min(self.tile_size, width - x), min(self.tile_size, height - y))
+
+    def _tile_path(self, level: int, tile_x: int, tile_y: int) -> str:
+        return os.path.join(self.directory, f"level_{level}", f"tile_{tile_y}_{tile_x}.npy")
+
+    def _tile(self, level: int, tile_x: int, tile_y: int, create: bool):
+        """Returns the memmap of a tile, or None if it does not exist and create is False."""
+        key = (level, tile_x, tile_y)
+        tile = self._open_tiles.get(key)
+        if tile is not None:
+            self._open_tiles.move_to_end(key)
+            return tile
+        path = self._tile_path(level, tile_x, tile_y)
+        if os.path.exists(path):
+            tile = np.load(path, mmap_mode="r+")
+        elif create:
+            shape = (self.tile_size, self.tile_size, self.channels) if self.channels > 1 else (self.tile_size, self.tile_size)
+            tile = np.lib.format.open_memmap(path, mode="w+", dtype=self.dtype, shape=shape)
+            tile[:] = self.fill
+        else:
+            return None
+        self._open_tiles[key] = tile
+        if len(self._open_tiles) > self.max_open_tiles:
+            _, closed = self._open_tiles.popitem(last=False)
+            closed.flush()
+        return tile
+
+    def _region(self, key, width: int, height: int) -> Tuple[int, int, int, int]:
+        """Returns x0, y0, x1, y1 of a key of two slices (steps are not supported)."""
+        if not isinstance(key, tuple) or len(key) != 2 or not all(isinstance(part, slice) for part in key):
+            raise IndexError("tiled images are indexed with two slices, e.g. store[y0:y1, x0:x1]")
+        (y0, y1, y_step), (x0, x1, x_step) = key[0].indices(height), key[1].indices(width)
+        if y_step != 1 or x_step != 1:
+            raise IndexError("tiled images do not support slice steps")
+        return x0, y0, max(x1, x0), max(y1, y0)
+
+    def read(self, level: int, x0: int, y0: int, x1: int, y1: int) -> np.ndarray:
+        """Returns a copy of the region x0:x1, y0:y1 of a level."""
+        shape = (y1 - y0, x1 - x0, self.channels) if self.channels > 1 else (y1 - y0, x1 - x0)
+        result = np.full(shape, self.fill, dtype=self.dtype)
+        size = self.tile_size
+        for tile_y in range(y0 // size, math.ceil(y1 / size)):
+            for tile_x in range(x0 // size, math.ceil(x1 / size)):
+                tile = self._tile(level, tile_x, tile_y, create=False)
+                if tile is None:
+                    continue
+                top, bottom = max(y0, tile_y * size), min(y1, (tile_y + 1) * size)
+                left, right = max(x0, tile_x * size), min(x1, (tile_x + 1) * size)
+                result[top - y0:bottom - y0, left - x0:right - x0] = \
+                    tile[top - tile_y * size:bottom - tile_y * size, left - tile_x * size:right - tile_x * size]
+        return result
+
+    def write(self, level: int, x0: int, y0: int, image) -> None:
+        """Writes image to the region starting at x0, y0 of a level."""
+        image = np.asarray(image)
+        y1, x1 = y0 + image.shape[0], x0 + image.shape[1]
+        size = self.tile_size
+        for tile_y in range(y0 // size, math.ceil(y1 / size)):
+            for tile_x in range(x0 // size, math.ceil(x1 / size)):
+                tile = self._tile(level, tile_x, tile_y, create=True)
+                top, bottom = max(y0, tile_y * size), min(y1, (tile_y + 1) * size)
+                left, right = max(x0, tile_x * size), min(x1, (tile_x + 1) * size)
+                tile[top - tile_y * size:bottom - tile_y * size, left - tile_x * size:right - tile_x * size] = \
+                    image[top - y0:bottom - y0, left - x0:right - x0]
+
+    def __getitem__(self, key) -> np.ndarray:
+        x0, y0, x1, y1 = self._region(key, self.width, self.height)
+        return self.read(0, x0, y0, x1, y1)
+
+    def __setitem__(self, key, image) -> None:
+        x0, y0, x1, y1 = self._region(key, self.width, self.height)
+        image = np.broadcast_to(image, (y1 - y0, x1 - x0) + self.shape[2:])
+        self.write(0, x0, y0, image)
+
+    def read_tile(self, tile_x: int, tile_y: int, level: int = 0) -> np.ndarray:
+        """Returns a copy of a tile cropped to the image, see tiles()."""
+        width, height = self.level_size(level)
+        x0, y0 = tile_x * self.tile_size, tile_y * self.tile_size
+        return self.read(level, x0, y0, min(x0 + self.tile_size, width), min(y0 + self.tile_size, height))
+
+    def build_pyramid(self, levels: int = None) -> int:
+        """
+        Builds the pyramid levels, each downscaled by 2 (area interpolation) from the one below, by default until a
+        level fits into a single tile. Only the tiles of the level below that overlap a tile are read. Returns the number of levels.
+        """
+        if levels is None:
+            levels = 1 + max(0, math.ceil(math.log2(max(self.width, self.height) / self.tile_size)))
+        for level in range(1, levels):
+            os.makedirs(os.path.join(self.directory, f"level_{level}"), exist_ok=True)
+            source_width, source_height = self.level_size(level - 1)
+            for tile_x, tile_y, roi in self.tiles(level):
+                source = self.read(level - 1, 2 * roi.x, 2 * roi.y, min(2 * (roi.x + roi.width), source_width),
+                                   min(2 * (roi.y + roi.height), source_height))
+                self.write(level, roi.x, roi.y, cv2.resize(source, (roi.width, roi.height), interpolation=cv2.INTER_AREA))
+        self.levels = max(levels, 1)
+        self._save_metadata()
+        logger.debug(f"built {self.levels} pyramid levels of {self.directory}")
+        return self.levels
+
+    def preview(self, level: int = None) -> np.ndarray:
+        """Returns the full image of a pyramid level in memory, by default the smallest one."""
+        level = self.levels - 1 if level is None else level
+        if level >= self.levels:
+            raise ValueError(f"level {level} not built, the store has {self.levels} levels")
+        width, height = self.level_size(level)
+        return self.read(level, 0, 0, width, height)
+
+    def flush(self) -> None:
+        """Writes all open tiles to disk."""
+        for tile in self._open_tiles.values():
+            tile.flush()
+
+    def close(self) -> None:
+        self.flush()
+        self._open_tiles.clear()
@@ -0,0 +1,165 @@
+# Copyright (c) 2023 Bundesanstalt für Materialforschung und -prüfung, see LICENSE file
+# Tuning of the settle thresholds and delays from the per-cell telemetry recorded in past experiments.
+
+import json
+from logging import getLogger
+from typing import NamedTuple
+
+import numpy as np
+
+logger = getLogger(__name__)
+
+PROFILE_KEYS = ("angle_settle_threshold", "angle_settle_delay", "video_settle_threshold", "video_settle_delay")
+
+
+class SettleProfile(NamedTuple):
+    """Settle thresholds and delays of one gimbal/camera setup, see wait_angle_error() and wait_video_settle()."""
+    angle_settle_threshold: float # degrees
+    angle_settle_delay: float # seconds
+    video_settle_threshold: float # mean pixel difference of frames
+    video_settle_delay: float # seconds
+
+
+def save_profile(profile: SettleProfile, filename: str, tuning: dict = None) -> None:
+    """Writes the profile to a JSON file, tuning (e.g. the predicted sweep times) is stored alongside for reference."""
+    data = profile._asdict()
+    if tuning is not None:
+        data["tuning"] = tuning
+    with open(filename, 'w') as profile_file:
+        json.dump(data, profile_file, indent=2)
+
+
+def load_profile(filename: str) -> SettleProfile:
+    with open(filename, 'r') as profile_file:
+        data = json.load(profile_file)
+    return SettleProfile(**{key: float(data[key]) for key in PROFILE_KEYS})
+
+
+def load_telemetry(files) -> list:
+    """
+    Returns (settle settings, cell telemetry) of all experiment files that contain telemetry, the settings
+    are the SettleProfile the experiment was recorded with. Cells settled with scaled thresholds (stricter for dwell
+    repeats, "settle_scale") are left out, their traces were not recorded with these settings.
+    """
+    experiments = []
+    for path in files:
+        with open(path, 'r') as json_file:
+            experiment_data = json.load(json_file)
+        if "cell_telemetry" not in experiment_data or "settle_settings" not in experiment_data:
+            logger.warning(f"{path} has no settle telemetry, skipping")
+            continue
+        settings = SettleProfile(**{key: float(experiment_data["settle_settings"][key]) for key in PROFILE_KEYS})
+        cells = [cell for cell in experiment_data["cell_telemetry"] if cell.get("settle_scale", 1.0) == 1.0]
+        if len(cells) < len(experiment_data["cell_telemetry"]):
+            logger.info(f"{path}: skipping {len(experiment_data['cell_telemetry']) - len(cells)} cells with scaled settle thresholds")
+        experiments.append((settings, cells))
+    return experiments
+
+
+def settle_time(trace, threshold: float, delay: float = None) -> float:
+    """
+    Returns the time at which a recorded trace (list of [time, value]) first fell below threshold, rounded up to
+    the next check if delay is given. Returns None if it did not within the recording.
+    """
+    for time, value in trace:
+        if value <= threshold:
+            return float(np.ceil(time / delay) * delay) if delay else time
+    return None
+
+
+def _quality_slope(residuals: np.ndarray, quality: np.ndarray):
+    """Returns intercept and slope of a linear fit of the quality metric over the residual at measurement start."""
+    if len(residuals) < 3 or np.ptp(residuals) == 0:
+        return float(np.mean(quality)) if len(quality) else 0.0, 0.0
+    slope, intercept = np.polyfit(residuals, quality, 1)
+    return float(intercept), float(slope)
+
+
+def recommend_threshold(cells: list, trace_key: str, recorded_threshold: float, tolerance: float = 0.1,
+                        failure_tolerance: float = 0.05, max_factor: float = 2.0, candidates: int = 20) -> float:
+    """
+    Returns the largest threshold for the traces stored under trace_key that does not hurt measurement quality.
+    Quality is modelled by linear fits of the subsample standard deviation and of the number of failed measurements
+    over the residual (last trace value, i.e. the value when the measurement started). A threshold is accepted if the
+    predicted standard deviation at this residual is at most (1 + tolerance) times the one at zero residual and the
+    predicted failures grow by at most failure_tolerance. Thresholds are searched up to max_factor times the
+    recorded one and not beyond the largest recorded residual, the models are not trusted further out.
+    """
+    residuals = np.array([cell[trace_key][-1][1] for cell in cells if cell[trace_key]])
+    deviations = np.array([cell["subsample_std"] for cell in cells if cell[trace_key]])
+    failures = np.array([len(cell["error_codes"]) for cell in cells if cell[trace_key]], dtype=float)
+    std_intercept, std_slope = _quality_slope(residuals, deviations)
+    failure_intercept, failure_slope = _quality_slope(residuals, failures)
+    logger.debug(f"{trace_key}: std {std_intercept:.3f} + {std_slope:.3f}/unit, failures {failure_intercept:.3f} + {failure_slope:.3f}/unit")
+
+    # no cell was measured at a larger residual, beyond it the fits are pure extrapolation
+    largest = min(recorded_threshold * max_factor, float(residuals.max())) if len(residuals) else recorded_threshold
+    best = None
+    for threshold in np.linspace(largest / candidates, largest, candidates):
+        std_ok = std_slope * threshold <= tolerance * max(std_intercept, 1e-9)
+        failures_ok = failure_slope * threshold <= failure_tolerance
+        if std_ok and failures_ok:
+            best = float(threshold)
+    if best is None:
+        logger.warning(f"{trace_key}: quality degrades even at small thresholds, keeping the smallest candidate")
+        best = float(largest / candidates)
+    elif best == float(largest) and largest < recorded_threshold * max_factor:
+        logger.info(f"{trace_key}: recommended threshold {best:.4f} is the largest recorded residual, "
+                    f"sweeps with a looser threshold are needed to tell whether it can be loosened further")
+    return best
+
+
+def recommend_angle_delay(cells: list, recorded_delay: float, min_delay: float = 0.005) -> float:
+    """
+    Returns the angle polling delay: twice the measured duration of one poll (the time between recorded samples
+    minus the recorded delay), so the serial link stays mostly free, but at least min_delay.
+    """
+    intervals = [np.diff([time for time, _ in cell["angle_errors"]]) for cell in cells if len(cell["angle_errors"]) > 1]
+    if not intervals:
+        return recorded_delay
+    poll_time = max(float(np.median(np.concatenate(intervals))) - recorded_delay, 0.0)
+    return max(2 * poll_time, min_delay)
+
+
+def predicted_settle_time(cells: list, profile: SettleProfile) -> float:
+    """
+    Returns the total settle time of all cells predicted from their traces. Cells whose traces never reach a
+    threshold count with their full recorded trace, so stricter profiles are underestimated.
+    """
+    total = 0.0
+    for cell in cells:
+        for trace_key, threshold, delay in (("angle_errors", profile.angle_settle_threshold, profile.angle_settle_delay),
+                                            ("frame_diffs", profile.video_settle_threshold, profile.video_settle_delay)):
+            trace = cell[trace_key]
+            if not trace:
+                continue
+            time = settle_time(trace, threshold, delay)
+            total += time if time is not None else trace[-1][0]
+    return total
+
+
+def tune(experiments: list, tolerance: float = 0.1) -> tuple:
+    """
+    Returns the recommended SettleProfile for experiments (see load_telemetry()) and a dict with the recorded and
+    predicted settle times. The video delay is kept as recorded, because the frame differences scale with it and
+    can not be predicted for other delays from the recorded traces.
+    """
+    if not experiments:
+        raise ValueError("no experiments with settle telemetry")
+    cells = [cell for _, experiment_cells in experiments for cell in experiment_cells]
+    # the telemetry is only comparable within the same settings, the loosest recorded settings cover most of the traces
+    recorded = max((settings for settings, _ in experiments), key=lambda settings: settings.angle_settle_threshold)
+
+    profile = SettleProfile(
+        angle_settle_threshold=recommend_threshold(cells, "angle_errors", recorded.angle_settle_threshold, tolerance),
+        angle_settle_delay=recommend_angle_delay(cells, recorded.angle_settle_delay),
+        video_settle_threshold=recommend_threshold(cells, "frame_diffs", recorded.video_settle_threshold, tolerance),
+        video_settle_delay=recorded.video_settle_delay)
+    tuning = {
+        "experiments": len(experiments),
+        "cells": len(cells),
+        "recorded_settle_time": predicted_settle_time(cells, recorded),
+        "predicted_settle_time": predicted_settle_time(cells, profile),
+        "tolerance": tolerance,
+    }
+    return profile, tuning
@@ -5,6 +5,10 @@ import serial
 from time import sleep 
 from logging import getLogger
 
+import numpy as np
+
+from laserfalcon.parser import parse_measurements, parse_settings, parse_version, measurement_to_dict
+
 logger = getLogger(__name__)
 
 #TODO: handle transmission errors with retry, more docstrings
@@ -66,36 +70,16 @@ class Device:
     def get_version(self) -> str:
         """Returns the version string as reported by the device."""
         CMD_GETVER = b'ETC:VER ?;' # bytes
-        RESP_START = "ETC:VER "# string
-        RESP_END = ";" # string
 
         response = self.send_command(CMD_GETVER)
-        response = response.decode()
-        start_index = response.find(RESP_START)
-        end_index = response.find(RESP_END, start_index + len(RESP_START))
-        version = response[start_index + len(RESP_START):end_index]
-        return version
+        return parse_version(response)
 
     def get_settings(self) -> dict:
         """Returns the device settings as a dictonary of returned key/value pairs. Values are strings."""
         GET_SETTINGS = b'CMN:ALL ?;' # bytes
-        RESP_START = "CMN:"# string
-        RESP_END = ";" # string
 
         response = self.send_command(GET_SETTINGS)
-        response = response.decode()
-        start_index = response.find(RESP_START)
-        # check response ends with correct end
-        if response[-1] != RESP_END:
-            raise RuntimeError(f"configuration response does not end with {RESP_END}")
-        settings_string = response[start_index + len(RESP_START):-1]
-        settings_pairs = settings_string.split(';')
-        # Split each substring by space and create key-value pairs
-        key_value_pairs = [substring.split(' ', 1) for substring in settings_pairs]
-        # Create a dictionary from the key-value pairs
-        settings_dict = {key.strip(): value.strip() for key, value in key_value_pairs}
-
-        return settings_dict
+        return parse_settings(response)
 
     def get_measurement(self) -> dict:
         """
@@ -103,43 +87,20 @@ class Device:
         The results can be acessed with the following keys 'error': reported error, 1 for none, 'main_value': averaged total/main result,
         'sub_values': list of 5 dicts with the individual measurements. each consists of the keys 'value', '1f', '2f', 'time'.
 
+        """
+        return measurement_to_dict(self.get_measurement_array()[0])
+
+    def get_measurement_array(self) -> np.ndarray:
+        """
+        Returns a single measurement as structured array of length 1 (see laserfalcon.parser.MEASUREMENT_DTYPE),
+        e.g. for collecting many samples with np.concatenate without going through dicts.
         """
         GET_MEASUREMENT = b'ETC:FWD ?;'
-        RESP_START = "ETC:FWD "# string
-        RESP_END = ";" # string
 
         response = self.send_command(GET_MEASUREMENT)
-        response = response.decode()
-        start_index = response.find(RESP_START)
-        # check response ends with correct end
-        if response[-1] != RESP_END:
-            raise RuntimeError(f"measurement data does not end with {RESP_END}")
-        measurements_string = response[start_index + len(RESP_START):-1]
-        values = measurements_string.split(";")
-
-        # assemble result dictionary
-        results = {}
-
-        results["error"] = int(values[0])
-        results["main_value"] = int(values[1])
-        results["sub_values"] = []
-        SUBVALUES_START = 2
-        SUBVALUES_ELEMENTS = 4
-
-        for subvalue_nr in range(5): # assemble all 5 subvalues
-            subvalue_dict = {}
-            THIS_SUBVALUE_START = SUBVALUES_START + (SUBVALUES_ELEMENTS * subvalue_nr)
-            subvalue_dict["value"] = int(values[THIS_SUBVALUE_START])
-            subvalue_dict["1f"]    = float(values[THIS_SUBVALUE_START+1])
-            subvalue_dict["2f"]    = float(values[THIS_SUBVALUE_START+2])
-            subvalue_dict["time"]  = int(values[THIS_SUBVALUE_START+3])
-            results["sub_values"].append(subvalue_dict)
-
-        return results
-    
-
-
-
-
-
- 
\ No newline at end of file
+        if not response.endswith(b';'):
+            raise RuntimeError("measurement data does not end with ;")
+        measurement = parse_measurements(response)
+        if len(measurement) != 1:
+            raise RuntimeError(f"no measurement in response: {response}")
+        return measurement
@@ -0,0 +1,78 @@
+# Copyright (c) 2023 Bundesanstalt für Materialforschung und -prüfung, see LICENSE file
+# Precompiled parsers for the responses of the Laser Falcon (version, settings and measurements).
+
+import re
+
+import numpy as np
+
+SUB_VALUES = 5 # sub-samples per measurement
+SUB_VALUE_FIELDS = 4 # value, 1f, 2f, time
+MEASUREMENT_FIELDS = 2 + SUB_VALUES * SUB_VALUE_FIELDS # error, main value, sub-values
+
+# structured dtype of one measurement, the sub-value fields are arrays over the sub-samples
+MEASUREMENT_DTYPE = np.dtype([
+    ("error", np.int32),
+    ("main_value", np.int32),
+    ("value", np.int32, SUB_VALUES),
+    ("1f", np.float64, SUB_VALUES),
+    ("2f", np.float64, SUB_VALUES),
+    ("time", np.int32, SUB_VALUES),
+])
+
+VERSION_PATTERN = re.compile(rb'ETC:VER ([^;]*);')
+SETTINGS_PATTERN = re.compile(rb'CMN:(.*;)$', re.DOTALL)
+SETTING_PATTERN = re.compile(rb'\s*([^;\s]+) ([^;]*);')
+# the fields are numbers separated by ';', the response ends with ';'
+MEASUREMENT_PATTERN = re.compile(rb'ETC:FWD ([-+0-9.eE;]*);')
+
+
+def parse_version(response: bytes) -> str:
+    """Returns the version string of an ETC:VER response."""
+    match = VERSION_PATTERN.search(response)
+    if match is None:
+        raise RuntimeError(f"no version in response: {response}")
+    return match.group(1).decode()
+
+
+def parse_settings(response: bytes) -> dict:
+    """Returns the key/value pairs of a CMN:ALL response as dict of strings."""
+    match = SETTINGS_PATTERN.search(response)
+    if match is None:
+        raise RuntimeError("configuration response does not end with ;")
+    return {key.decode(): value.decode().strip() for key, value in SETTING_PATTERN.findall(match.group(1))}
+
+
+def parse_measurements(data: bytes) -> np.ndarray:
+    """
+    Returns all ETC:FWD responses contained in data as structured array of MEASUREMENT_DTYPE. The data can be a single
+    response or many concatenated ones, e.g. everything read from the device in a recorded serial log, bytes between
+    the responses (framing, acknowledges, checksums) are skipped. Raises RuntimeError if a response does not have
+    MEASUREMENT_FIELDS fields.
+    """
+    payloads = MEASUREMENT_PATTERN.findall(data)
+    result = np.empty(len(payloads), MEASUREMENT_DTYPE)
+    if not payloads:
+        return result
+    for payload in payloads:
+        if payload.count(b';') + 1 != MEASUREMENT_FIELDS:
+            raise RuntimeError(f"measurement has {payload.count(b';') + 1} fields instead of {MEASUREMENT_FIELDS}: {payload}")
+    fields = b';'.join(payloads).split(b';')
+    # one conversion for all fields, integers are exactly representable as float64
+    values = np.array(fields).astype(np.float64).reshape(len(payloads), MEASUREMENT_FIELDS)
+    result["error"] = values[:, 0]
+    result["main_value"] = values[:, 1]
+    sub_values = values[:, 2:].reshape(len(payloads), SUB_VALUES, SUB_VALUE_FIELDS)
+    for index, name in enumerate(("value", "1f", "2f", "time")):
+        result[name] = sub_values[:, :, index]
+    return result
+
+
+def measurement_to_dict(measurement) -> dict:
+    """Returns one record of parse_measurements() in the dict layout of Device.get_measurement()."""
+    return {
+        "error": int(measurement["error"]),
+        "main_value": int(measurement["main_value"]),
+        "sub_values": [{"value": int(value), "1f": float(signal_1f), "2f": float(signal_2f), "time": int(time)}
+                       for value, signal_1f, signal_2f, time
+                       in zip(measurement["value"], measurement["1f"], measurement["2f"], measurement["time"])],
+    }
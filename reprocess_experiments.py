@@ -0,0 +1,147 @@
+# Copyright (c) 2023 Bundesanstalt für Materialforschung und -prüfung, see LICENSE file
+# Batch script to reprocess a directory (or glob) of experiment files: statistics and plots for all of them.
+# Example: python ./reprocess_experiments.py ./campaign_2024/ "./other/*.json" --output-dir ./plots
+
+import argparse
+import csv
+import glob
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DENSITY_KEYS = ("column_densities_median", "column_densities_mean")
+
+
+def find_experiment_files(patterns) -> list:
+    """Returns the sorted experiment JSON files matching the given directories or glob patterns."""
+    files = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*.json")
+        files.update(path for path in glob.glob(pattern) if path.endswith(".json"))
+    return sorted(files)
+
+
+def load_experiments(files, key: str):
+    """
+    Loads the column densities stored under key from all files into one stacked float array of shape (n, y, x).
+    Grids smaller than the largest one are padded with NaN. Files without the key are skipped.
+    Returns the stack, the list of loaded files, the grid shapes and the frame size (width, height) of each experiment.
+    """
+    grids = []
+    loaded_files = []
+    frame_sizes = []
+    for path in files:
+        with open(path, 'r') as json_file:
+            experiment_data = json.load(json_file)
+        if key not in experiment_data:
+            logger.warning(f"{path} has no {key}, skipping")
+            continue
+        grids.append(np.asarray(experiment_data[key], dtype=float))
+        loaded_files.append(path)
+        calibration = experiment_data.get("calibration", {})
+        frame_sizes.append((calibration.get("frame_width", 480), calibration.get("frame_height", 320)))
+
+    if not grids:
+        return np.empty((0, 0, 0)), [], [], []
+    height = max(grid.shape[0] for grid in grids)
+    width = max(grid.shape[1] for grid in grids)
+    stack = np.full((len(grids), height, width), np.nan)
+    for index, grid in enumerate(grids):
+        stack[index, :grid.shape[0], :grid.shape[1]] = grid
+    return stack, loaded_files, [grid.shape for grid in grids], frame_sizes
+
+
+def output_names(files) -> list:
+    """
+    Returns the names of the outputs of the experiment files: the path relative to the common directory of all files
+    without extension, with the directory separators replaced by "_", so equally named experiments of different
+    directories do not overwrite each other. Raises ValueError if names still collide.
+    """
+    paths = [os.path.abspath(path) for path in files]
+    common = os.path.commonpath([os.path.dirname(path) for path in paths]) if paths else ""
+    names = [os.path.splitext(os.path.relpath(path, common))[0].replace(os.sep, "_") for path in paths]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"experiment files with the same output name: {', '.join(duplicates)}")
+    return names
+
+
+def compute_statistics(stack: np.ndarray) -> dict:
+    """Returns per-experiment statistics (arrays of length n) computed in one vectorized pass over the stack."""
+    return {
+        "min": np.nanmin(stack, axis=(1, 2)),
+        "max": np.nanmax(stack, axis=(1, 2)),
+        "mean": np.nanmean(stack, axis=(1, 2)),
+        "median": np.nanmedian(stack, axis=(1, 2)),
+        "std": np.nanstd(stack, axis=(1, 2)),
+        "p95": np.nanpercentile(stack, 95, axis=(1, 2)),
+    }
+
+
+def render_plot(grid, filename: str, frame_size, vmin: float, vmax: float, title: str) -> str:
+    """Renders one column density grid to filename with the headless Agg backend. Runs in a worker process."""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(1, 1)
+    fig.set_dpi(300)
+    fig.set_size_inches(8.5/2.54, 4.6/2.54)
+    im = ax.imshow(grid, cmap='viridis', extent=[0, frame_size[0], 0, frame_size[1]], vmin=vmin, vmax=vmax)
+    ax.set_title(title, fontsize=10)
+    fig.colorbar(im)
+    fig.savefig(filename, dpi=600)
+    plt.close(fig)
+    return filename
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reprocess a set of virtual gas camera experiment files.")
+    parser.add_argument("patterns", nargs="+", help="experiment directories or glob patterns of experiment JSON files")
+    parser.add_argument("--output-dir", default=".", help="directory for plots and statistics (default: current directory)")
+    parser.add_argument("--key", default=DENSITY_KEYS[0], choices=DENSITY_KEYS, help="column densities to process")
+    parser.add_argument("--vmin", type=float, default=None, help="lower color limit, default: minimum over all experiments")
+    parser.add_argument("--vmax", type=float, default=None, help="upper color limit, default: maximum over all experiments")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: number of CPUs)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    files = find_experiment_files(args.patterns)
+    logger.info(f"found {len(files)} experiment files")
+    stack, files, shapes, frame_sizes = load_experiments(files, args.key)
+    if not files:
+        logger.error("no experiments to process")
+        return
+
+    statistics = compute_statistics(stack)
+    # a common color scale makes the plots of a campaign comparable
+    vmin = args.vmin if args.vmin is not None else float(np.nanmin(statistics["min"]))
+    vmax = args.vmax if args.vmax is not None else float(np.nanmax(statistics["max"]))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    names = output_names(files)
+    statistics_filename = os.path.join(args.output_dir, "statistics.csv")
+    with open(statistics_filename, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["experiment"] + list(statistics))
+        for index, name in enumerate(names):
+            writer.writerow([name] + [f"{values[index]:.3f}" for values in statistics.values()])
+    logger.info(f"statistics written to {statistics_filename}")
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(render_plot, stack[index, :shapes[index][0], :shapes[index][1]], os.path.join(args.output_dir, f"{name}_plot.png"),
+                                   frame_sizes[index], vmin, vmax, "Column Density (ppm$\\cdot$m)")
+                   for index, name in enumerate(names)]
+        for future in futures:
+            logger.info(f"written {future.result()}")
+
+
+if __name__ == "__main__":
+    main()
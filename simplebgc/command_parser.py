@@ -27,41 +27,55 @@ from simplebgc.commands import *
 # Nb => Ns
 
 
-# function convertFormat(format) {
-#   return format.split(' ').map(type => {
-#     if (type[type.length - 1] === 'b') return type.replace('b', 's');
-# 	const converted = {
-#       '1u': 'B',
-#       '1s': 'b',
-#       '2u': 'H',
-#       '2s': 'h',
-#       '4u': 'I',
-#       '4f': 'f',
-#       '4s': 'i',
-#     }[type];
-#     return converted;
-#   }).join('');
-# }
-
-
-def parse_board_info_cmd(payload: bytes) -> BoardInfoInCmd:
-    # noinspection PyProtectedMember
-    return BoardInfoInCmd._make(struct.unpack('<BHBHBI7s', payload))
+SPEC_TYPE_FORMATS = {
+    '1u': 'B',
+    '1s': 'b',
+    '2u': 'H',
+    '2s': 'h',
+    '4u': 'I',
+    '4f': 'f',
+    '4s': 'i',
+}
 
 
-def parse_board_info_3_cmd(payload: bytes) -> BoardInfo3InCmd:
-    # noinspection PyProtectedMember
-    return BoardInfo3InCmd._make(struct.unpack('<9s12sIHHHHHBB32s', payload))
+def spec_to_format(spec: str) -> str:
+    """
+    Converts a payload spec (NAME TYPE pairs, see the *_SPEC strings in commands.py) to a little-endian struct format.
+    Variable length types (string) are not supported.
+    """
+    formats = []
+    for spec_type in spec.split()[1::2]:
+        if spec_type.endswith('b'):
+            formats.append(spec_type.replace('b', 's'))
+        elif spec_type in SPEC_TYPE_FORMATS:
+            formats.append(SPEC_TYPE_FORMATS[spec_type])
+        else:
+            raise ValueError(f'unsupported type in payload spec: {spec_type}')
+    return '<' + ''.join(formats)
 
 
-def parse_read_params_3_cmd(payload: bytes) -> ReadParams3InCmd:
-    # noinspection PyProtectedMember
-    return ReadParams3InCmd._make(struct.unpack('<BBBBBBBBBBBBBBBBBBBBbbhhBBBBhhBBBBhhBBBBBBBBbbbBBBBBBBBBBBBBBbbbbbbbBBBBBBBBBBBBBBBBBhhhBBBBBBBBBBhhhBBBBBBBBBBBBHHBBBBB', payload))
+def spec_parser(command_type, spec: str):
+    """Returns a function that parses a payload described by spec into command_type (a NamedTuple)."""
+    payload_struct = struct.Struct(spec_to_format(spec))
+    assert len(spec.split()) // 2 == len(command_type._fields), \
+        f'spec has {len(spec.split()) // 2} fields, {command_type.__name__} has {len(command_type._fields)}'
 
+    def parse(payload: bytes):
+        # noinspection PyProtectedMember
+        return command_type._make(payload_struct.unpack(payload))
+    return parse
 
-def parse_read_params_ext_cmd(payload: bytes) -> ReadParamsExtInCmd:
-    # noinspection PyProtectedMember
-    return ReadParamsExtInCmd._make(struct.unpack('<BBBBBBBHHHBBBhhhhhhBBBBBBBBB2sBBBBHHHbbbbbbbbbbbbbbbBHHHBBBBBBBBBBBBbbBbHBBB', payload))
+
+parse_board_info_cmd = spec_parser(BoardInfoInCmd, BOARD_INFO_SPEC)
+
+
+parse_board_info_3_cmd = spec_parser(BoardInfo3InCmd, BOARD_INFO_3_SPEC)
+
+
+parse_read_params_3_cmd = spec_parser(ReadParams3InCmd, READ_PARAMS_3_SPEC)
+
+
+parse_read_params_ext_cmd = spec_parser(ReadParamsExtInCmd, READ_PARAMS_EXT_SPEC)
 
 
 def parse_read_params_ext2_cmd(payload: bytes) -> ReadParamsExt2InCmd:
@@ -70,38 +84,28 @@ def parse_read_params_ext2_cmd(payload: bytes) -> ReadParamsExt2InCmd:
 
 
 def parse_read_params_ext3_cmd(payload: bytes) -> ReadParamsExt3InCmd:
-    # noinspection PyProtectedMember
-    return ReadParamsExt3InCmd._make(struct.unpack('<', payload))
+    return ReadParamsExt3InCmd(profile_id=payload[0], data=payload[1:])
 
 
-def parse_realtime_data_3_cmd(payload: bytes) -> RealtimeData3InCmd:
-    # noinspection PyProtectedMember
-    return RealtimeData3InCmd._make(struct.unpack('<hhhhhhHHB3shhhhhhhhhhhhhhhHHBHBBBBBB', payload))
+parse_realtime_data_3_cmd = spec_parser(RealtimeData3InCmd, REALTIME_DATA_3_SPEC)
 
 
-def parse_realtime_data_4_cmd(payload: bytes) -> RealtimeData4InCmd:
-    # noinspection PyProtectedMember
-    return RealtimeData4InCmd._make(struct.unpack('<hhhhhhHHB3shhhhhhhhhhhhhhhHHBHBBBBBBhhh1shhhHhhhbbBBhhh30s', payload))
+parse_realtime_data_4_cmd = spec_parser(RealtimeData4InCmd, REALTIME_DATA_4_SPEC)
 
 
 def parse_confirm_cmd(payload: bytes) -> ConfirmInCmd:
-    # noinspection PyProtectedMember
-    return ConfirmInCmd._make(struct.unpack('<', payload))
+    # DATA is optional and 1 or 2 bytes long
+    data = int.from_bytes(payload[1:], 'little') if len(payload) > 1 else None
+    return ConfirmInCmd(cmd_id=payload[0], data=data)
 
 
-def parse_error_cmd(payload: bytes) -> ErrorInCmd:
-    # noinspection PyProtectedMember
-    return ErrorInCmd._make(struct.unpack('<', payload))
+parse_error_cmd = spec_parser(ErrorInCmd, ERROR_SPEC)
 
 
-def parse_get_angles_cmd(payload: bytes) -> GetAnglesInCmd:
-    # noinspection PyProtectedMember
-    return GetAnglesInCmd._make(struct.unpack('<9h', payload))
+parse_get_angles_cmd = spec_parser(GetAnglesInCmd, GET_ANGLES_SPEC)
 
 
-def parse_get_angles_ext_cmd(payload: bytes) -> GetAnglesExtInCmd:
-    # noinspection PyProtectedMember
-    return GetAnglesExtInCmd._make(struct.unpack('<', payload))
+parse_get_angles_ext_cmd = spec_parser(GetAnglesExtInCmd, GET_ANGLES_EXT_SPEC)
 
 
 def parse_read_profile_names_cmd(payload: bytes) \
@@ -117,13 +121,42 @@ def parse_auto_pid_cmd(payload: bytes) -> Optional[AutoPidInCmd]:
     return None
 
 
-def parse_debug_vars_info_3_cmd(payload: bytes) \
-        -> Optional[DebugVarsInfo3InCmd]:
-    return None
+def parse_debug_vars_info_3_cmd(payload: bytes) -> DebugVarsInfo3InCmd:
+    vars_num = payload[0]
+    offset = 1
+    debug_vars = []
+    for _ in range(vars_num):
+        # string: first byte is the length
+        name_length = payload[offset]
+        var_name = payload[offset + 1:offset + 1 + name_length].decode('ascii')
+        offset += 1 + name_length
+        var_type, reserved = struct.unpack_from('<B2s', payload, offset)
+        offset += 3
+        debug_vars.append(DebugVarInfo(var_name, var_type, reserved))
+    return DebugVarsInfo3InCmd(vars_num=vars_num, vars=debug_vars)
+
+
+def parse_debug_vars_3_cmd(payload: bytes) -> DebugVars3InCmd:
+    return DebugVars3InCmd(data=payload)
+
+
+# the lower 4 bits of VAR_TYPE select the value type
+DEBUG_VAR_TYPE_FORMATS = {
+    1: 'B',
+    2: 'b',
+    3: 'H',
+    4: 'h',
+    5: 'I',
+    6: 'i',
+    7: 'f',
+}
 
 
-def parse_debug_vars_3_cmd(payload: bytes) -> Optional[DebugVars3InCmd]:
-    return None
+def decode_debug_vars(cmd: DebugVars3InCmd, info: DebugVarsInfo3InCmd) -> dict:
+    """Returns the values of CMD_DEBUG_VARS_3 by variable name, using the types from CMD_DEBUG_VARS_INFO_3."""
+    values_format = '<' + ''.join(DEBUG_VAR_TYPE_FORMATS[debug_var.var_type & 0x0F] for debug_var in info.vars)
+    values = struct.unpack(values_format, cmd.data)
+    return {debug_var.var_name: value for debug_var, value in zip(info.vars, values)}
 
 
 def parse_read_external_data_cmd(payload: bytes) \
@@ -164,9 +197,41 @@ def parse_ahrs_helper_cmd(payload: bytes) -> Optional[AhrsHelperInCmd]:
     return None
 
 
-def parse_realtime_data_custom_cmd(payload: bytes) \
-        -> Optional[RealtimeDataCustomInCmd]:
-    return None
+def parse_realtime_data_custom_cmd(payload: bytes) -> RealtimeDataCustomInCmd:
+    timestamp_ms, = struct.unpack_from('<H', payload)
+    return RealtimeDataCustomInCmd(timestamp_ms=timestamp_ms, data=payload[2:])
+
+
+class RealtimeDataCustomDecoder:
+    """
+    Decodes the data of CMD_REALTIME_DATA_CUSTOM for a fixed set of flags. The struct is compiled once, so decoding
+    a poll is a single unpack.
+    """
+
+    def __init__(self, flags: int) -> None:
+        known_flags = 0
+        spec = []
+        self.fields = []  # (name, start, stop) into the unpacked values
+        for bit, name, field_spec in REALTIME_DATA_CUSTOM_FIELDS:
+            known_flags |= 1 << bit
+            if flags & (1 << bit):
+                start = len(spec)
+                spec.extend(field_spec.split()[1::2])
+                self.fields.append((name, start, len(spec)))
+        if flags & ~known_flags:
+            raise ValueError(f'unsupported CMD_REALTIME_DATA_CUSTOM flags: {flags & ~known_flags:#x}')
+        self.flags = flags
+        self.struct = struct.Struct(spec_to_format(' '.join(f'_ {spec_type}' for spec_type in spec)))
+
+    def decode(self, cmd: RealtimeDataCustomInCmd) -> dict:
+        """Returns the requested fields as dict of name: tuple of values (raw units)."""
+        values = self.struct.unpack(cmd.data)
+        return {name: values[start:stop] for name, start, stop in self.fields}
+
+
+def decode_realtime_data_custom(cmd: RealtimeDataCustomInCmd, flags: int) -> dict:
+    """Returns the fields of CMD_REALTIME_DATA_CUSTOM requested with flags as dict of name: tuple of values."""
+    return RealtimeDataCustomDecoder(flags).decode(cmd)
 
 
 def parse_adj_vars_state_cmd(payload: bytes) -> Optional[AdjVarsStateInCmd]:
@@ -177,8 +242,7 @@ def parse_read_rc_inputs_cmd(payload: bytes) -> Optional[ReadRcInputsInCmd]:
     return None
 
 
-def parse_event_cmd(payload: bytes) -> Optional[EventInCmd]:
-    return None
+parse_event_cmd = spec_parser(EventInCmd, EVENT_SPEC)
 
 
 def parse_ext_imu_debug_info_cmd(payload: bytes) \
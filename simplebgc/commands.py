@@ -1,12 +1,15 @@
 import struct
-from typing import NamedTuple
+from typing import List, NamedTuple, Optional
+
+# The *_SPEC strings describe the payload of incoming commands as NAME TYPE pairs, in the notation of the
+# SimpleBGC serial API specification (see top of command_parser.py). The parsers are generated from them.
 
 RawCmd = NamedTuple('RawCmd', [
     ('id', int),
     ('payload', bytes),
 ])
 
-# BOARD_VER 1u FIRMWARE_VER 2u STATE_FLAGS1 1u BOARD_FEATURES 2u CONNECTION_FLAG 1u FRW_EXTRA_ID 4u RESERVED 7b
+BOARD_INFO_SPEC = 'BOARD_VER 1u FIRMWARE_VER 2u STATE_FLAGS1 1u BOARD_FEATURES 2u CONNECTION_FLAG 1u FRW_EXTRA_ID 4u RESERVED 7b'
 BoardInfoInCmd = NamedTuple('BoardInfoInCmd', [
     ('board_ver', int),
     ('firmware_ver', int),
@@ -17,7 +20,7 @@ BoardInfoInCmd = NamedTuple('BoardInfoInCmd', [
     ('reserved', bytes),
 ])
 
-# DEVICE_ID 9b MCU_ID 12b EEPROM_SIZE 4u SCRIPT_SLOT1_SIZE 2u SCRIPT_SLOT2_SIZE 2u SCRIPT_SLOT3_SIZE 2u SCRIPT_SLOT4_SIZE 2u SCRIPT_SLOT5_SIZE 2u PROFILE_SET_SLOTS 1u PROFILE_SET_CUR 1u RESERVED 32b
+BOARD_INFO_3_SPEC = 'DEVICE_ID 9b MCU_ID 12b EEPROM_SIZE 4u SCRIPT_SLOT1_SIZE 2u SCRIPT_SLOT2_SIZE 2u SCRIPT_SLOT3_SIZE 2u SCRIPT_SLOT4_SIZE 2u SCRIPT_SLOT5_SIZE 2u PROFILE_SET_SLOTS 1u PROFILE_SET_CUR 1u RESERVED 32b'
 BoardInfo3InCmd = NamedTuple('BoardInfo3InCmd', [
     ('device_id', bytes),
     ('mcu_id', bytes),
@@ -32,7 +35,7 @@ BoardInfo3InCmd = NamedTuple('BoardInfo3InCmd', [
     ('reserved', bytes),
 ])
 
-# PROFILE_ID 1u P_AXIS_1 1u I_AXIS_1 1u D_AXIS_1 1u POWER_AXIS_1 1u INVERT_AXIS_1 1u POLES_AXIS_1 1u P_AXIS_2 1u I_AXIS_2 1u D_AXIS_2 1u POWER_AXIS_2 1u INVERT_AXIS_2 1u POLES_AXIS_2 1u P_AXIS_3 1u I_AXIS_3 1u D_AXIS_3 1u POWER_AXIS_3 1u INVERT_AXIS_3 1u POLES_AXIS_3 1u ACC_LIMITER_ALL 1u EXT_FC_GAIN_1 1s EXT_FC_GAIN_2 1s RC_MIN_ANGLE_AXIS_1 2s RC_MAX_ANGLE_AXIS_1 2s RC_MODE_AXIS_1 1u RC_LPF_AXIS_1 1u RC_SPEED_AXIS_1 1u RC_FOLLOW_AXIS_1 1u RC_MIN_ANGLE_AXIS_2 2s RC_MAX_ANGLE_AXIS_2 2s RC_MODE_AXIS_2 1u RC_LPF_AXIS_2 1u RC_SPEED_AXIS_2 1u RC_FOLLOW_AXIS_2 1u RC_MIN_ANGLE_AXIS_3 2s RC_MAX_ANGLE_AXIS_3 2s RC_MODE_AXIS_3 1u RC_LPF_AXIS_3 1u RC_SPEED_AXIS_3 1u RC_FOLLOW_AXIS_3 1u GYRO_TRUST 1u USE_MODEL 1u PWM_FREQ 1u SERIAL_SPPED 1u RC_TRIM_1 1s RC_TRIM_2 1s RC_TRIM_3 1s RC_DEADBAND 1u RC_EXPO_RATE 1u RC_VIRT_MODE 1u RC_MAP_ROLL 1u RC_MAP_PITCH 1u RC_MAP_YAW 1u RC_MAP_CMD 1u RC_MAP_FC_ROLL 1u RC_MAP_FC_PITCH 1u RC_MIX_FC_ROLL 1u RC_MIX_FC_PITCH 1u FOLLOW_MODE 1u FOLLOW_DEADBAND 1u FOLLOW_EXPO_RATE 1u FOLLOW_OFFSET_1 1s FOLLOW_OFFSET_2 1s FOLLOW_OFFSET_3 1s AXIS_TOP 1s AXIS_RIGHT 1s FRAME_AXIS_TOP 1s FRAME_AXIS_RIGHT 1s FRAME_IMU_POS 1u GYRO_DEADBAND 1u GYRO_SENS 1u I2C_SPEED_FAST 1u SKIP_GYRO_CALIB 1u RC_CMD_LOW 1u RC_CMD_MID 1u RC_CMD_HIGH 1u MENU_CMD_1 1u MENU_CMD_2 1u MENU_CMD_3 1u MENU_CMD_4 1u MENU_CMD_5 1u MENU_CMD_LONG 1u MOTOR_OUTPUT_1 1u MOTOR_OUTPUT_2 1u MOTOR_OUTPUT_3 1u BAT_THRESHOLD_ALARM 2s BAT_THRESHOLD_MOTORS 2s BAT_COMP_REF 2s BEEPER_MODES 1u FOLLOW_ROLL_MIX_START 1u FOLLOW_ROLL_MIX_RANGE 1u BOOSTER_POWER_1 1u BOOSTER_POWER_2 1u BOOSTER_POWER_3 1u FOLLOW_SPEED_1 1u FOLLOW_SPEED_2 1u FOLLOW_SPEED_3 1u FRAME_ANGLE_FROM_MOTORS 1u RC_MEMORY_1 2s RC_MEMORY_2 2s RC_MEMORY_3 2s SERVO1_OUT 1u SERVO2_OUT 1u SERVO3_OUT 1u SERVO4_OUT 1u SERVO_RATE 1u ADAPTIVE_PID_ENABLED 1u ADAPTIVE_PID_THRESHOLD 1u ADAPTIVE_PID_RATE 1u ADAPTIVE_PID_RECOVERY_FACTOR 1u FOLLOW_LPF_1 1u FOLLOW_LPF_2 1u FOLLOW_LPF_3 1u GENERAL_FLAGS1 2u PROFILE_FLAGS1 2u SPEKTRUM_MODE 1u ORDER_OF_AXES 1u EULER_ORDER 1u CUR_IMU 1u CUR_PROFILE_ID 1u
+READ_PARAMS_3_SPEC = 'PROFILE_ID 1u P_AXIS_1 1u I_AXIS_1 1u D_AXIS_1 1u POWER_AXIS_1 1u INVERT_AXIS_1 1u POLES_AXIS_1 1u P_AXIS_2 1u I_AXIS_2 1u D_AXIS_2 1u POWER_AXIS_2 1u INVERT_AXIS_2 1u POLES_AXIS_2 1u P_AXIS_3 1u I_AXIS_3 1u D_AXIS_3 1u POWER_AXIS_3 1u INVERT_AXIS_3 1u POLES_AXIS_3 1u ACC_LIMITER_ALL 1u EXT_FC_GAIN_1 1s EXT_FC_GAIN_2 1s RC_MIN_ANGLE_AXIS_1 2s RC_MAX_ANGLE_AXIS_1 2s RC_MODE_AXIS_1 1u RC_LPF_AXIS_1 1u RC_SPEED_AXIS_1 1u RC_FOLLOW_AXIS_1 1u RC_MIN_ANGLE_AXIS_2 2s RC_MAX_ANGLE_AXIS_2 2s RC_MODE_AXIS_2 1u RC_LPF_AXIS_2 1u RC_SPEED_AXIS_2 1u RC_FOLLOW_AXIS_2 1u RC_MIN_ANGLE_AXIS_3 2s RC_MAX_ANGLE_AXIS_3 2s RC_MODE_AXIS_3 1u RC_LPF_AXIS_3 1u RC_SPEED_AXIS_3 1u RC_FOLLOW_AXIS_3 1u GYRO_TRUST 1u USE_MODEL 1u PWM_FREQ 1u SERIAL_SPPED 1u RC_TRIM_1 1s RC_TRIM_2 1s RC_TRIM_3 1s RC_DEADBAND 1u RC_EXPO_RATE 1u RC_VIRT_MODE 1u RC_MAP_ROLL 1u RC_MAP_PITCH 1u RC_MAP_YAW 1u RC_MAP_CMD 1u RC_MAP_FC_ROLL 1u RC_MAP_FC_PITCH 1u RC_MIX_FC_ROLL 1u RC_MIX_FC_PITCH 1u FOLLOW_MODE 1u FOLLOW_DEADBAND 1u FOLLOW_EXPO_RATE 1u FOLLOW_OFFSET_1 1s FOLLOW_OFFSET_2 1s FOLLOW_OFFSET_3 1s AXIS_TOP 1s AXIS_RIGHT 1s FRAME_AXIS_TOP 1s FRAME_AXIS_RIGHT 1s FRAME_IMU_POS 1u GYRO_DEADBAND 1u GYRO_SENS 1u I2C_SPEED_FAST 1u SKIP_GYRO_CALIB 1u RC_CMD_LOW 1u RC_CMD_MID 1u RC_CMD_HIGH 1u MENU_CMD_1 1u MENU_CMD_2 1u MENU_CMD_3 1u MENU_CMD_4 1u MENU_CMD_5 1u MENU_CMD_LONG 1u MOTOR_OUTPUT_1 1u MOTOR_OUTPUT_2 1u MOTOR_OUTPUT_3 1u BAT_THRESHOLD_ALARM 2s BAT_THRESHOLD_MOTORS 2s BAT_COMP_REF 2s BEEPER_MODES 1u FOLLOW_ROLL_MIX_START 1u FOLLOW_ROLL_MIX_RANGE 1u BOOSTER_POWER_1 1u BOOSTER_POWER_2 1u BOOSTER_POWER_3 1u FOLLOW_SPEED_1 1u FOLLOW_SPEED_2 1u FOLLOW_SPEED_3 1u FRAME_ANGLE_FROM_MOTORS 1u RC_MEMORY_1 2s RC_MEMORY_2 2s RC_MEMORY_3 2s SERVO1_OUT 1u SERVO2_OUT 1u SERVO3_OUT 1u SERVO4_OUT 1u SERVO_RATE 1u ADAPTIVE_PID_ENABLED 1u ADAPTIVE_PID_THRESHOLD 1u ADAPTIVE_PID_RATE 1u ADAPTIVE_PID_RECOVERY_FACTOR 1u FOLLOW_LPF_1 1u FOLLOW_LPF_2 1u FOLLOW_LPF_3 1u GENERAL_FLAGS1 2u PROFILE_FLAGS1 2u SPEKTRUM_MODE 1u ORDER_OF_AXES 1u EULER_ORDER 1u CUR_IMU 1u CUR_PROFILE_ID 1u'
 ReadParams3InCmd = NamedTuple('ReadParams3InCmd', [
     ('profile_id', int),
     ('p_axis_1', int),
@@ -156,7 +159,7 @@ ReadParams3InCmd = NamedTuple('ReadParams3InCmd', [
     ('cur_profile_id', int),
 ])
 
-# PROFILE_ID 1u NOTCH_FREQ_AXIS_1 1u NOTCH_WIDTH_AXIS_1 1u NOTCH_FREQ_AXIS_2 1u NOTCH_WIDTH_AXIS_2 1u NOTCH_FREQ_AXIS_3 1u NOTCH_WIDTH_AXIS_3 1u LPF_FREQ_1 2u LPF_FREQ_2 2u LPF_FREQ_3 2u FILTERS_EN_1 1u FILTERS_EN_2 1u FILTERS_EN_3 1u ENCODER_OFFSET_1 2s ENCODER_OFFSET_2 2s ENCODER_OFFSET_3 2s ENCODER_FLD_OFFSET_1 2s ENCODER_FLD_OFFSET_2 2s ENCODER_FLD_OFFSET_3 2s ENCODER_MANUAL_SET_TIME_1 1u ENCODER_MANUAL_SET_TIME_2 1u ENCODER_MANUAL_SET_TIME_3 1u MOTOR_HEATING_FACTOR_1 1u MOTOR_HEATING_FACTOR_2 1u MOTOR_HEATING_FACTOR_3 1u MOTOR_COOLING_FACTOR_1 1u MOTOR_COOLING_FACTOR_2 1u MOTOR_COOLING_FACTOR_3 1u RESERVED 2b FOLLOW_INSIDE_DEADBAND 1u MOTOR_MAG_LINK_1 1u MOTOR_MAG_LINK_2 1u MOTOR_MAG_LINK_3 1u MOTOR_GEARING_1 2u MOTOR_GEARING_2 2u MOTOR_GEARING_3 2u ENCODER_LIMIT_MIN_1 1s ENCODER_LIMIT_MIN_2 1s ENCODER_LIMIT_MIN_3 1s ENCODER_LIMIT_MAX_1 1s ENCODER_LIMIT_MAX_2 1s ENCODER_LIMIT_MAX_3 1s NOTCH1_GAIN_1 1s NOTCH1_GAIN_2 1s NOTCH1_GAIN_3 1s NOTCH2_GAIN_1 1s NOTCH2_GAIN_2 1s NOTCH2_GAIN_3 1s NOTCH3_GAIN_1 1s NOTCH3_GAIN_2 1s NOTCH3_GAIN_3 1s BEEPER_VOLUME 1u ENCODER_GEAR_RATIO_1 2u ENCODER_GEAR_RATIO_2 2u ENCODER_GEAR_RATIO_3 2u ENCODER_TYPE_1 1u ENCODER_TYPE_2 1u ENCODER_TYPE_3 1u ENCODER_CFG_1 1u ENCODER_CFG_2 1u ENCODER_CFG_3 1u OUTER_P_1 1u OUTER_P_2 1u OUTER_P_3 1u OUTER_I_1 1u OUTER_I_2 1u OUTER_I_3 1u MAG_AXIS_TOP 1s MAG_AXIS_RIGHT 1s MAG_TRUST 1u MAG_DECLINATION 1s ACC_LPF_FREQ 2u D_TERM_LPF_FREQ_1 1u D_TERM_LPF_FREQ_2 1u D_TERM_LPF_FREQ_3 1u
+READ_PARAMS_EXT_SPEC = 'PROFILE_ID 1u NOTCH_FREQ_AXIS_1 1u NOTCH_WIDTH_AXIS_1 1u NOTCH_FREQ_AXIS_2 1u NOTCH_WIDTH_AXIS_2 1u NOTCH_FREQ_AXIS_3 1u NOTCH_WIDTH_AXIS_3 1u LPF_FREQ_1 2u LPF_FREQ_2 2u LPF_FREQ_3 2u FILTERS_EN_1 1u FILTERS_EN_2 1u FILTERS_EN_3 1u ENCODER_OFFSET_1 2s ENCODER_OFFSET_2 2s ENCODER_OFFSET_3 2s ENCODER_FLD_OFFSET_1 2s ENCODER_FLD_OFFSET_2 2s ENCODER_FLD_OFFSET_3 2s ENCODER_MANUAL_SET_TIME_1 1u ENCODER_MANUAL_SET_TIME_2 1u ENCODER_MANUAL_SET_TIME_3 1u MOTOR_HEATING_FACTOR_1 1u MOTOR_HEATING_FACTOR_2 1u MOTOR_HEATING_FACTOR_3 1u MOTOR_COOLING_FACTOR_1 1u MOTOR_COOLING_FACTOR_2 1u MOTOR_COOLING_FACTOR_3 1u RESERVED 2b FOLLOW_INSIDE_DEADBAND 1u MOTOR_MAG_LINK_1 1u MOTOR_MAG_LINK_2 1u MOTOR_MAG_LINK_3 1u MOTOR_GEARING_1 2u MOTOR_GEARING_2 2u MOTOR_GEARING_3 2u ENCODER_LIMIT_MIN_1 1s ENCODER_LIMIT_MIN_2 1s ENCODER_LIMIT_MIN_3 1s ENCODER_LIMIT_MAX_1 1s ENCODER_LIMIT_MAX_2 1s ENCODER_LIMIT_MAX_3 1s NOTCH1_GAIN_1 1s NOTCH1_GAIN_2 1s NOTCH1_GAIN_3 1s NOTCH2_GAIN_1 1s NOTCH2_GAIN_2 1s NOTCH2_GAIN_3 1s NOTCH3_GAIN_1 1s NOTCH3_GAIN_2 1s NOTCH3_GAIN_3 1s BEEPER_VOLUME 1u ENCODER_GEAR_RATIO_1 2u ENCODER_GEAR_RATIO_2 2u ENCODER_GEAR_RATIO_3 2u ENCODER_TYPE_1 1u ENCODER_TYPE_2 1u ENCODER_TYPE_3 1u ENCODER_CFG_1 1u ENCODER_CFG_2 1u ENCODER_CFG_3 1u OUTER_P_1 1u OUTER_P_2 1u OUTER_P_3 1u OUTER_I_1 1u OUTER_I_2 1u OUTER_I_3 1u MAG_AXIS_TOP 1s MAG_AXIS_RIGHT 1s MAG_TRUST 1u MAG_DECLINATION 1s ACC_LPF_FREQ 2u D_TERM_LPF_FREQ_1 1u D_TERM_LPF_FREQ_2 1u D_TERM_LPF_FREQ_3 1u'
 ReadParamsExtInCmd = NamedTuple('ReadParamsExtInCmd', [
     ('profile_id', int),
     ('notch_freq_axis_1', int),
@@ -239,10 +242,13 @@ ReadParamsExt2InCmd = NamedTuple('ReadParamsExt2InCmd', [
 
 ])
 
+# PROFILE_ID 1u, the remaining parameters are kept undecoded
 ReadParamsExt3InCmd = NamedTuple('ReadParamsExt3InCmd', [
-
+    ('profile_id', int),
+    ('data', bytes),
 ])
 
+REALTIME_DATA_3_SPEC = 'ACC_DATA_AXIS_1 2s GYRO_DATA_AXIS_1 2s ACC_DATA_AXIS_2 2s GYRO_DATA_AXIS_2 2s ACC_DATA_AXIS_3 2s GYRO_DATA_AXIS_3 2s SERIAL_ERR_CNT 2u SYSTEM_ERROR 2u SYSTEM_SUB_ERROR 1u RESERVED 3b RC_ROLL 2s RC_PITCH 2s RC_YAW 2s RC_CMD 2s EXT_FC_ROLL 2s EXT_FC_PITCH 2s IMU_ANGLE_1 2s IMU_ANGLE_2 2s IMU_ANGLE_3 2s FRAME_IMU_ANGLE_1 2s FRAME_IMU_ANGLE_2 2s FRAME_IMU_ANGLE_3 2s TARGET_ANGLE_1 2s TARGET_ANGLE_2 2s TARGET_ANGLE_3 2s CYCLE_TIME 2u I2C_ERROR_COUNT 2u ERROR_CODE 1u BAT_LEVEL 2u RT_DATA_FLAGS 1u CUR_IMU 1u CUR_PROFILE 1u MOTOR_POWER_1 1u MOTOR_POWER_2 1u MOTOR_POWER_3 1u'
 RealtimeData3InCmd = NamedTuple('RealtimeData3InCmd', [
     ('acc_data_axis_1', int),
     ('gyro_data_axis_1', int),
@@ -281,6 +287,7 @@ RealtimeData3InCmd = NamedTuple('RealtimeData3InCmd', [
     ('motor_power_3', int),
 ])
 
+REALTIME_DATA_4_SPEC = 'ACC_DATA_AXIS_1 2s GYRO_DATA_AXIS_1 2s ACC_DATA_AXIS_2 2s GYRO_DATA_AXIS_2 2s ACC_DATA_AXIS_3 2s GYRO_DATA_AXIS_3 2s SERIAL_ERR_CNT 2u SYSTEM_ERROR 2u SYSTEM_SUB_ERROR 1u RESERVED_3 3b RC_ROLL 2s RC_PITCH 2s RC_YAW 2s RC_CMD 2s EXT_FC_ROLL 2s EXT_FC_PITCH 2s IMU_ANGLE_1 2s IMU_ANGLE_2 2s IMU_ANGLE_3 2s FRAME_IMU_ANGLE_1 2s FRAME_IMU_ANGLE_2 2s FRAME_IMU_ANGLE_3 2s TARGET_ANGLE_1 2s TARGET_ANGLE_2 2s TARGET_ANGLE_3 2s CYCLE_TIME 2u I2C_ERROR_COUNT 2u ERROR_CODE 1u BAT_LEVEL 2u RT_DATA_FLAGS 1u CUR_IMU 1u CUR_PROFILE 1u MOTOR_POWER_1 1u MOTOR_POWER_2 1u MOTOR_POWER_3 1u STATOR_ROTOR_ANGLE_1 2s STATOR_ROTOR_ANGLE_2 2s STATOR_ROTOR_ANGLE_3 2s RESERVED_4_0 1b BALANCE_ERROR_1 2s BALANCE_ERROR_2 2s BALANCE_ERROR_3 2s CURRENT 2u MAG_DATA_1 2s MAG_DATA_2 2s MAG_DATA_3 2s IMU_TEMPERATURE 1s FRAME_IMU_TEMPERATURE 1s IMU_G_ERR 1u IMU_H_ERR 1u MOTOR_OUT_1 2s MOTOR_OUT_2 2s MOTOR_OUT_3 2s RESERVED_4_1 30b'
 RealtimeData4InCmd = NamedTuple('RealtimeData4InCmd', [
     ('acc_data_axis_1', int),
     ('gyro_data_axis_1', int),
@@ -338,14 +345,19 @@ RealtimeData4InCmd = NamedTuple('RealtimeData4InCmd', [
     ('reserved_4_1', bytes),
 ])
 
+# CMD_ID 1u DATA 1u or 2u (optional, depends on the confirmed command)
 ConfirmInCmd = NamedTuple('ConfirmInCmd', [
-
+    ('cmd_id', int),
+    ('data', Optional[int]),
 ])
 
+ERROR_SPEC = 'ERROR_CODE 1u ERROR_DATA 4b'
 ErrorInCmd = NamedTuple('ErrorInCmd', [
-
+    ('error_code', int),
+    ('error_data', bytes),
 ])
 
+GET_ANGLES_SPEC = 'IMU_ANGLE_1 2s TARGET_ANGLE_1 2s TARGET_SPEED_1 2s IMU_ANGLE_2 2s TARGET_ANGLE_2 2s TARGET_SPEED_2 2s IMU_ANGLE_3 2s TARGET_ANGLE_3 2s TARGET_SPEED_3 2s'
 GetAnglesInCmd = NamedTuple('GetAnglesInCmd', [
     ('imu_angle_1', int),
     ('target_angle_1', int),
@@ -358,8 +370,20 @@ GetAnglesInCmd = NamedTuple('GetAnglesInCmd', [
     ('target_speed_3', int),
 ])
 
+GET_ANGLES_EXT_SPEC = 'IMU_ANGLE_1 2s TARGET_ANGLE_1 2s STATOR_ROTOR_ANGLE_1 4s RESERVED_1 10b IMU_ANGLE_2 2s TARGET_ANGLE_2 2s STATOR_ROTOR_ANGLE_2 4s RESERVED_2 10b IMU_ANGLE_3 2s TARGET_ANGLE_3 2s STATOR_ROTOR_ANGLE_3 4s RESERVED_3 10b'
 GetAnglesExtInCmd = NamedTuple('GetAnglesExtInCmd', [
-
+    ('imu_angle_1', int),
+    ('target_angle_1', int),
+    ('stator_rotor_angle_1', int),
+    ('reserved_1', bytes),
+    ('imu_angle_2', int),
+    ('target_angle_2', int),
+    ('stator_rotor_angle_2', int),
+    ('reserved_2', bytes),
+    ('imu_angle_3', int),
+    ('target_angle_3', int),
+    ('stator_rotor_angle_3', int),
+    ('reserved_3', bytes),
 ])
 
 ReadProfileNamesInCmd = NamedTuple('ReadProfileNamesInCmd', [
@@ -374,12 +398,22 @@ AutoPidInCmd = NamedTuple('AutoPidInCmd', [
 
 ])
 
-DebugVarsInfo3InCmd = NamedTuple('DebugVarsInfo3InCmd', [
+# VAR_NAME string VAR_TYPE 1u RESERVED 2b, repeated VARS_NUM times in CMD_DEBUG_VARS_INFO_3
+DebugVarInfo = NamedTuple('DebugVarInfo', [
+    ('var_name', str),
+    ('var_type', int),
+    ('reserved', bytes),
+])
 
+# VARS_NUM 1u, followed by VARS_NUM DebugVarInfo
+DebugVarsInfo3InCmd = NamedTuple('DebugVarsInfo3InCmd', [
+    ('vars_num', int),
+    ('vars', List[DebugVarInfo]),
 ])
 
+# values of all variables, their types are only known from CMD_DEBUG_VARS_INFO_3, see decode_debug_vars()
 DebugVars3InCmd = NamedTuple('DebugVars3InCmd', [
-
+    ('data', bytes),
 ])
 
 ReadExternalDataInCmd = NamedTuple('ReadExternalDataInCmd', [
@@ -418,9 +452,24 @@ AhrsHelperInCmd = NamedTuple('AhrsHelperInCmd', [
 
 ])
 
+# TIMESTAMP_MS 2u, followed by the fields requested with FLAGS of the outgoing command (see REALTIME_DATA_CUSTOM_FIELDS)
 RealtimeDataCustomInCmd = NamedTuple('RealtimeDataCustomInCmd', [
-
-])
+    ('timestamp_ms', int),
+    ('data', bytes),
+])
+
+# fields of CMD_REALTIME_DATA_CUSTOM as (flag bit, name, spec), the data contains the requested fields in this order
+REALTIME_DATA_CUSTOM_FIELDS = [
+    (0, 'imu_angles', 'IMU_ANGLE_1 2s IMU_ANGLE_2 2s IMU_ANGLE_3 2s'),
+    (1, 'target_angles', 'TARGET_ANGLE_1 2s TARGET_ANGLE_2 2s TARGET_ANGLE_3 2s'),
+    (2, 'target_speed', 'TARGET_SPEED_1 2s TARGET_SPEED_2 2s TARGET_SPEED_3 2s'),
+    (3, 'stator_rotor_angle', 'STATOR_ROTOR_ANGLE_1 2s STATOR_ROTOR_ANGLE_2 2s STATOR_ROTOR_ANGLE_3 2s'),
+    (4, 'gyro_data', 'GYRO_DATA_1 2s GYRO_DATA_2 2s GYRO_DATA_3 2s'),
+    (5, 'rc_data', 'RC_ROLL 2s RC_PITCH 2s RC_YAW 2s RC_CMD 2s EXT_FC_ROLL 2s EXT_FC_PITCH 2s'),
+    (6, 'z_vector_h_vector', 'Z_VECTOR_1 4f Z_VECTOR_2 4f Z_VECTOR_3 4f H_VECTOR_1 4f H_VECTOR_2 4f H_VECTOR_3 4f'),
+    (7, 'rc_channels', 'RC_CHANNEL_1 2s RC_CHANNEL_2 2s RC_CHANNEL_3 2s RC_CHANNEL_4 2s RC_CHANNEL_5 2s RC_CHANNEL_6 2s RC_CHANNEL_7 2s RC_CHANNEL_8 2s RC_CHANNEL_9 2s RC_CHANNEL_10 2s RC_CHANNEL_11 2s RC_CHANNEL_12 2s RC_CHANNEL_13 2s RC_CHANNEL_14 2s RC_CHANNEL_15 2s RC_CHANNEL_16 2s RC_CHANNEL_17 2s RC_CHANNEL_18 2s'),
+    (8, 'acc_data', 'ACC_DATA_1 2s ACC_DATA_2 2s ACC_DATA_3 2s'),
+]
 
 AdjVarsStateInCmd = NamedTuple('AdjVarsStateInCmd', [
 
@@ -430,8 +479,11 @@ ReadRcInputsInCmd = NamedTuple('ReadRcInputsInCmd', [
 
 ])
 
+EVENT_SPEC = 'EVENT_ID 1u EVENT_TYPE 1u PARAM1 2b'
 EventInCmd = NamedTuple('EventInCmd', [
-
+    ('event_id', int),
+    ('event_type', int),
+    ('param1', bytes),
 ])
 
 ExtImuDebugInfoInCmd = NamedTuple('ExtImuDebugInfoInCmd', [
@@ -439,6 +491,27 @@ ExtImuDebugInfoInCmd = NamedTuple('ExtImuDebugInfoInCmd', [
 ])
 
 
+# outgoing CMD_REALTIME_DATA_CUSTOM - request the selected realtime data fields
+class RealtimeDataCustomOutCmd(NamedTuple):
+    flags: int
+    reserved: bytes = bytes(6)
+
+    def pack(self) -> bytes:
+        return struct.pack('<I6s', *self)
+
+
+# outgoing CMD_DATA_STREAM_INTERVAL - let the controller send a command periodically
+class DataStreamIntervalOutCmd(NamedTuple):
+    cmd_id: int
+    interval_ms: int
+    config: bytes = bytes(8)
+    sync_to_data: int = 0
+    reserved: bytes = bytes(9)
+
+    def pack(self) -> bytes:
+        return struct.pack('<BH8sB9s', *self)
+
+
 # outgoing CMD_CONTROL - control gimbal movement
 class ControlOutCmd(NamedTuple):
     roll_mode: int
@@ -1,14 +1,20 @@
-from enum import IntEnum
+from enum import IntEnum, IntFlag
 from logging import getLogger
+from math import ceil, sqrt
+from statistics import mean, median
+from time import perf_counter, sleep
+from typing import NamedTuple, Sequence, Tuple
 
 from serial import Serial
 
-from simplebgc.command_ids import CMD_CONTROL, CMD_GET_ANGLES, CMD_CONFIRM
-from simplebgc.command_parser import parse_cmd
-from simplebgc.commands import ControlOutCmd, GetAnglesInCmd
+from simplebgc.command_ids import CMD_CONTROL, CMD_GET_ANGLES, CMD_CONFIRM, \
+    CMD_REALTIME_DATA_CUSTOM, CMD_REALTIME_DATA_4, CMD_DATA_STREAM_INTERVAL
+from simplebgc.command_parser import parse_cmd, RealtimeDataCustomDecoder
+from simplebgc.commands import ControlOutCmd, GetAnglesInCmd, \
+    RealtimeDataCustomOutCmd, DataStreamIntervalOutCmd, RealtimeData4InCmd
 from simplebgc.serial_example import create_message, \
     pack_message, read_message, Message, read_cmd
-from simplebgc.units import from_degree_per_sec, from_degree
+from simplebgc.units import from_degree_per_sec, from_degree, to_degree
 
 logger = getLogger(__name__)
 
@@ -26,12 +32,37 @@ class ControlMode(IntEnum):
     # TODO flags
 
 
+class RealtimeDataField(IntFlag):
+    """Fields of CMD_REALTIME_DATA_CUSTOM (FLAGS of the outgoing command)
+    """
+    imu_angles = 1 << 0
+    target_angles = 1 << 1
+    target_speed = 1 << 2
+    stator_rotor_angle = 1 << 3  # frame angles
+    gyro_data = 1 << 4
+    rc_data = 1 << 5
+    z_vector_h_vector = 1 << 6
+    rc_channels = 1 << 7
+    acc_data = 1 << 8
+
+
+class HoldTarget(NamedTuple):
+    """Target of the hold state, see Gimbal.hold()."""
+    control: dict  # arguments of Gimbal.control()
+    tolerance: float  # degrees of angle error before the target is re-sent
+    keepalive: float  # seconds after which the target is re-sent anyway
+    sent: float  # perf_counter() of the last control command
+
+
 class Gimbal:
 
     def __init__(self, connection: Serial = None) -> None:
         if connection is None:
             connection = Serial('/dev/ttyUSB0', baudrate=115200, timeout=10)
         self._connection = connection
+        self._realtime_decoder = None
+        self._realtime_request = None
+        self._hold = None
 
     def send_message(self, message: Message):
         logger.debug(f'send message: {message}')
@@ -65,6 +96,64 @@ class Gimbal:
         assert confirmation.command_id == CMD_CONFIRM, \
             f'expected confirmation, but received command with ID' \
             f' {confirmation.command_id}'
+        # any other command replaces the hold target
+        self._hold = None
+
+    def hold(self, tolerance: float = 1.0, keepalive: float = 60.0,
+             **control):
+        """Sends the target (arguments of control()) once and enters the hold
+        state: the controller keeps the angle by itself, check_hold() only
+        monitors it and sends the target again if the angle error exceeds
+        tolerance degrees or after keepalive seconds. Leaves the link free
+        in between, e.g. for telemetry. The next control() ends the hold.
+        """
+        self.control(**control)
+        self._hold = HoldTarget(control, tolerance, keepalive, perf_counter())
+
+    @property
+    def holding(self) -> bool:
+        return self._hold is not None
+
+    def angle_error(self) -> float:
+        """Polls the largest difference between target and IMU angle of the
+        three axes in degrees, with the realtime fields if they contain both,
+        otherwise with get_angles().
+        """
+        fields = RealtimeDataField.imu_angles | RealtimeDataField.target_angles
+        if self._realtime_decoder is not None and \
+                self._realtime_decoder.flags & fields == fields:
+            data = self.get_realtime_data()
+            pairs = zip(data['target_angles'], data['imu_angles'])
+        else:
+            angles = self.get_angles()
+            pairs = ((angles.target_angle_1, angles.imu_angle_1),
+                     (angles.target_angle_2, angles.imu_angle_2),
+                     (angles.target_angle_3, angles.imu_angle_3))
+        # wrapped to +-180 degrees, the angles of a full yaw turn differ by 360
+        return max(abs((to_degree(target - imu) + 180) % 360 - 180)
+                   for target, imu in pairs)
+
+    def check_hold(self, angle_error: float = None) -> bool:
+        """Re-sends the hold target if the angle error (degrees, polled with
+        angle_error() if not given, e.g. from streamed telemetry) exceeds the
+        tolerance or the keepalive interval has passed. The error is only
+        polled if the keepalive is not due anyway. Returns whether the target
+        was sent, False if not holding.
+        """
+        hold = self._hold
+        if hold is None:
+            return False
+        if perf_counter() - hold.sent >= hold.keepalive:
+            logger.debug('hold: keepalive, sending target again')
+        else:
+            if angle_error is None:
+                angle_error = self.angle_error()
+            if angle_error <= hold.tolerance:
+                return False
+            logger.info(f'hold: angle error {angle_error:.2f} deg, '
+                        f'sending target again')
+        self.hold(hold.tolerance, hold.keepalive, **hold.control)
+        return True
 
     def stop(self):
         self.control(roll_mode=ControlMode.no_control,
@@ -77,6 +166,183 @@ class Gimbal:
         assert cmd.id == CMD_GET_ANGLES
         return parse_cmd(cmd)
 
+    def set_realtime_fields(self, fields: RealtimeDataField):
+        """Selects the fields returned by get_realtime_data() and read_realtime_data().
+        Only the selected fields are transferred and decoded, e.g. 14 bytes for
+        IMU and target angles instead of 18 bytes for get_angles().
+        """
+        self._realtime_decoder = RealtimeDataCustomDecoder(int(fields))
+        self._realtime_request = pack_message(create_message(
+            CMD_REALTIME_DATA_CUSTOM,
+            RealtimeDataCustomOutCmd(flags=int(fields)).pack()))
+
+    def get_realtime_data(self) -> dict:
+        """Polls the fields selected with set_realtime_fields(). Returns a dict
+        of field name: tuple of values per axis (raw units).
+        """
+        assert self._realtime_decoder is not None, \
+            'select the fields with set_realtime_fields() first'
+        self._connection.write(self._realtime_request)
+        return self.read_realtime_data()
+
+    def read_realtime_data(self) -> dict:
+        """Reads the next CMD_REALTIME_DATA_CUSTOM, either the response to a
+        poll or a message of the stream started with start_realtime_stream().
+        """
+        cmd = read_cmd(self._connection)
+        assert cmd.id == CMD_REALTIME_DATA_CUSTOM, \
+            f'expected realtime data, but received command with ID {cmd.id}'
+        return self._realtime_decoder.decode(parse_cmd(cmd))
+
+    def start_realtime_stream(self, interval_ms: int):
+        """Lets the controller send the selected fields every interval_ms
+        (firmware 2.60 or later). Read them with read_realtime_data(). No other
+        commands may be sent until stop_realtime_stream() is called, because
+        their responses would interleave with the stream.
+        """
+        assert self._realtime_decoder is not None, \
+            'select the fields with set_realtime_fields() first'
+        config = self._realtime_decoder.flags.to_bytes(4, 'little') + bytes(4)
+        self._send_stream_interval(interval_ms, config)
+
+    def stop_realtime_stream(self):
+        """Stops the stream, realtime data still in transit is discarded."""
+        self._send_stream_interval(0, bytes(8))
+
+    def _send_stream_interval(self, interval_ms: int, config: bytes):
+        stream_data = DataStreamIntervalOutCmd(
+            cmd_id=CMD_REALTIME_DATA_CUSTOM, interval_ms=interval_ms,
+            config=config)
+        self.send_message(
+            create_message(CMD_DATA_STREAM_INTERVAL, stream_data.pack()))
+        while True:
+            cmd = read_cmd(self._connection)
+            if cmd.id == CMD_CONFIRM:
+                return
+            assert cmd.id == CMD_REALTIME_DATA_CUSTOM, \
+                f'expected confirmation, but received command with ID {cmd.id}'
+
+    def get_realtime_data_4(self) -> RealtimeData4InCmd:
+        """Motor power and other diagnostics are not available as custom
+        realtime fields, they are read with the full CMD_REALTIME_DATA_4.
+        """
+        self.send_message(create_message(CMD_REALTIME_DATA_4))
+        cmd = read_cmd(self._connection)
+        assert cmd.id == CMD_REALTIME_DATA_4
+        return parse_cmd(cmd)
+
+
+def minimum_jerk(s: float) -> Tuple[float, float]:
+    """Returns position and velocity (both normalized to the move) of the
+    minimum jerk profile at the normalized time s in [0, 1].
+    """
+    s = min(max(s, 0.0), 1.0)
+    position = s ** 3 * (10 - 15 * s + 6 * s ** 2)
+    velocity = 30 * s ** 2 * (1 - s) ** 2
+    return position, velocity
+
+
+class MotionPlanner:
+    """Moves yaw and pitch along velocity and jerk limited profiles.
+
+    Both axes follow the same normalized minimum jerk profile, so they arrive
+    at the same time. The profile is sent as a series of angle setpoints, each
+    looking ahead by look_ahead seconds to make up for the controller lag, with
+    per-axis speeds following the profile. The maximum speed is chosen among
+    the candidate speeds by the settle times measured after previous moves
+    (see record_settle()), i.e. the speed with the lowest expected move plus
+    settle time wins. Every candidate is tried exploration_moves times first.
+    """
+
+    MIN_SPEED = 1.0  # degree/s, a speed of 0 selects the profile speed of the controller
+
+    def __init__(
+            self,
+            gimbal: 'Gimbal',
+            speeds: Sequence[float] = (720,),
+            max_acceleration: float = 720,
+            update_interval: float = 0.02,
+            look_ahead: float = 0.04,
+            exploration_moves: int = 3,
+            mode: ControlMode = ControlMode.angle_rel_frame,
+            yaw: float = 0,
+            pitch: float = 0) -> None:
+        self._gimbal = gimbal
+        self.speeds = tuple(speeds)  # degree/s
+        self.max_acceleration = max_acceleration  # degree/s^2
+        self.update_interval = update_interval  # seconds between setpoints
+        self.look_ahead = look_ahead  # seconds
+        self.exploration_moves = exploration_moves
+        self.mode = mode
+        self._position = (yaw, pitch)  # last commanded yaw, pitch
+        self._settle_times = {speed: [] for speed in self.speeds}
+        self._distances = []
+        self._last_speed = None
+
+    def profile_duration(self, distance: float, max_speed: float) -> float:
+        """Returns the duration of a minimum jerk move over distance degrees
+        limited by max_speed and max_acceleration.
+        """
+        # peak velocity is 1.875 d/T, peak acceleration 5.77 d/T^2
+        return max(1.875 * distance / max_speed,
+                   sqrt(5.77 * distance / self.max_acceleration))
+
+    def choose_speed(self) -> float:
+        """Returns the maximum speed for the next move, see class docstring."""
+        for speed in self.speeds:
+            if len(self._settle_times[speed]) < self.exploration_moves:
+                return speed
+        distance = median(self._distances)
+        return min(self.speeds, key=lambda speed: mean(self._settle_times[speed])
+                   + self.profile_duration(distance, speed))
+
+    def record_settle(self, settle_time: float):
+        """Records how long the gimbal took to settle after the last move."""
+        if self._last_speed is not None:
+            self._settle_times[self._last_speed].append(settle_time)
+
+    def _control(self, yaw: float, pitch: float, yaw_speed: float,
+                 pitch_speed: float):
+        self._gimbal.control(
+            pitch_mode=self.mode, pitch_speed=max(pitch_speed, self.MIN_SPEED),
+            pitch_angle=pitch,
+            yaw_mode=self.mode, yaw_speed=max(yaw_speed, self.MIN_SPEED),
+            yaw_angle=yaw)
+
+    def move_to(self, yaw: float, pitch: float):
+        """Moves to yaw, pitch (degrees), blocks for the duration of the
+        profile. Returns without waiting for the gimbal to settle.
+        """
+        start_yaw, start_pitch = self._position
+        delta_yaw, delta_pitch = yaw - start_yaw, pitch - start_pitch
+        distance = max(abs(delta_yaw), abs(delta_pitch))
+        self._position = (yaw, pitch)
+        if distance == 0:
+            self._last_speed = None
+            self._control(yaw, pitch, self.speeds[0], self.speeds[0])
+            return
+        max_speed = self.choose_speed()
+        self._last_speed = max_speed
+        self._distances.append(distance)
+        duration = self.profile_duration(distance, max_speed)
+
+        # the number of setpoints depends only on the move, so sessions replay the same commands
+        n_setpoints = max(ceil((duration - self.look_ahead) / self.update_interval), 0)
+        start = perf_counter()
+        for index in range(n_setpoints):
+            position, velocity = minimum_jerk(
+                (index * self.update_interval + self.look_ahead) / duration)
+            self._control(start_yaw + delta_yaw * position,
+                          start_pitch + delta_pitch * position,
+                          abs(delta_yaw) * velocity / duration,
+                          abs(delta_pitch) * velocity / duration)
+            remaining = start + (index + 1) * self.update_interval - perf_counter()
+            if remaining > 0:
+                sleep(remaining)
+        # final setpoint with the synchronized peak speeds, converges even if the controller lagged behind
+        self._control(yaw, pitch, abs(delta_yaw) / duration * 1.875,
+                      abs(delta_pitch) / duration * 1.875)
+
 
 def _main():
     from time import sleep
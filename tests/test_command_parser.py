@@ -0,0 +1,199 @@
+import struct
+
+import pytest
+
+from simplebgc.command_ids import *
+from simplebgc.command_parser import RealtimeDataCustomDecoder, \
+    decode_debug_vars, decode_realtime_data_custom, parse_cmd, spec_to_format
+from simplebgc.commands import *
+from simplebgc.gimbal import RealtimeDataField
+
+# (spec, command type, command id) of the incoming commands with fixed layout
+SPEC_COMMANDS = [
+    (BOARD_INFO_SPEC, BoardInfoInCmd, CMD_BOARD_INFO),
+    (BOARD_INFO_3_SPEC, BoardInfo3InCmd, CMD_BOARD_INFO_3),
+    (READ_PARAMS_3_SPEC, ReadParams3InCmd, CMD_READ_PARAMS_3),
+    (READ_PARAMS_EXT_SPEC, ReadParamsExtInCmd, CMD_READ_PARAMS_EXT),
+    (REALTIME_DATA_3_SPEC, RealtimeData3InCmd, CMD_REALTIME_DATA_3),
+    (REALTIME_DATA_4_SPEC, RealtimeData4InCmd, CMD_REALTIME_DATA_4),
+    (ERROR_SPEC, ErrorInCmd, CMD_ERROR),
+    (GET_ANGLES_SPEC, GetAnglesInCmd, CMD_GET_ANGLES),
+    (GET_ANGLES_EXT_SPEC, GetAnglesExtInCmd, CMD_GET_ANGLES_EXT),
+    (EVENT_SPEC, EventInCmd, CMD_EVENT),
+]
+
+
+def sample_values(spec: str) -> list:
+    """Returns distinct values for the fields of spec, at the type limits
+    where possible, so swapped or truncated fields are noticed."""
+    values = []
+    for index, spec_type in enumerate(spec.split()[1::2]):
+        if spec_type.endswith('b'):
+            values.append(bytes((index + offset) % 256
+                                for offset in range(int(spec_type[:-1]))))
+        elif spec_type == '4f':
+            values.append(index + 0.5)
+        else:
+            bits = int(spec_type[0]) * 8
+            if spec_type.endswith('s'):
+                values.append(-(1 << (bits - 1)) + index)
+            else:
+                values.append((1 << bits) - 1 - index)
+    return values
+
+
+def test_spec_formats_cover_all_fields():
+    for spec, command_type, _ in SPEC_COMMANDS:
+        assert len(spec.split()) // 2 == len(command_type._fields)
+        assert struct.calcsize(spec_to_format(spec)) == \
+            sum(int(spec_type[:-1]) for spec_type in spec.split()[1::2])
+
+
+@pytest.mark.parametrize('spec, command_type, command_id', SPEC_COMMANDS,
+                         ids=[entry[1].__name__ for entry in SPEC_COMMANDS])
+def test_spec_round_trip(spec, command_type, command_id):
+    values = sample_values(spec)
+    payload = struct.pack(spec_to_format(spec), *values)
+    assert parse_cmd(RawCmd(command_id, payload)) == command_type._make(values)
+
+
+# payloads written by hand from the SimpleBGC 2.6 serial protocol
+# specification, independent of the spec strings: little endian
+def test_get_angles_protocol_payload():
+    payload = bytes.fromhex('0001 feff 0300'  # roll: IMU 256, target -2, 3
+                            '9cff 6400 0000'  # pitch: IMU -100, target 100
+                            '0080 ff7f 01ff')  # yaw: limits of int16, -255
+    cmd = parse_cmd(RawCmd(CMD_GET_ANGLES, payload))
+    assert cmd == GetAnglesInCmd(256, -2, 3, -100, 100, 0, -32768, 32767, -255)
+
+
+def test_get_angles_ext_protocol_payload():
+    # per axis IMU angle, target angle, 32 bit stator/rotor angle, 10 reserved
+    payload = b''
+    for axis in range(3):
+        payload += bytes.fromhex('1000 f0ff 00000100') + bytes([axis] * 10)
+    cmd = parse_cmd(RawCmd(CMD_GET_ANGLES_EXT, payload))
+    assert (cmd.imu_angle_2, cmd.target_angle_2, cmd.stator_rotor_angle_2) == \
+        (16, -16, 65536)
+    assert cmd.reserved_3 == bytes([2] * 10)
+
+
+def test_realtime_data_3_protocol_payload():
+    payload = bytearray(63)
+    payload[0:2] = bytes.fromhex('f6ff')  # ACC_DATA roll -10
+    payload[14:16] = bytes.fromhex('0200')  # SYSTEM_ERROR
+    payload[32:38] = bytes.fromhex('0100 0200 0300')  # IMU_ANGLE
+    payload[44:50] = bytes.fromhex('fcff fbff faff')  # TARGET_ANGLE
+    payload[50:52] = bytes.fromhex('e803')  # CYCLE_TIME 1000 us
+    payload[55:57] = bytes.fromhex('6e04')  # BAT_LEVEL 11.34 V
+    payload[60:63] = bytes([10, 20, 30])  # MOTOR_POWER
+    cmd = parse_cmd(RawCmd(CMD_REALTIME_DATA_3, bytes(payload)))
+    assert cmd.acc_data_axis_1 == -10
+    assert cmd.system_error == 2
+    assert (cmd.imu_angle_1, cmd.imu_angle_2, cmd.imu_angle_3) == (1, 2, 3)
+    assert (cmd.target_angle_1, cmd.target_angle_2, cmd.target_angle_3) == \
+        (-4, -5, -6)
+    assert cmd.cycle_time == 1000
+    assert cmd.bat_level == 1134
+    assert (cmd.motor_power_1, cmd.motor_power_2, cmd.motor_power_3) == \
+        (10, 20, 30)
+
+
+def test_realtime_data_4_protocol_payload():
+    payload = bytearray(124)
+    payload[32:34] = bytes.fromhex('0700')  # IMU_ANGLE roll
+    payload[63:69] = bytes.fromhex('0a00 ecff 1e00')  # STATOR_ROTOR_ANGLE
+    payload[76:78] = bytes.fromhex('3412')  # CURRENT
+    payload[84:86] = bytes([0xe2, 40])  # IMU_TEMPERATURE -30, frame IMU 40
+    payload[88:94] = bytes.fromhex('0100 0200 ffff')  # MOTOR_OUT
+    cmd = parse_cmd(RawCmd(CMD_REALTIME_DATA_4, bytes(payload)))
+    assert cmd.imu_angle_1 == 7
+    assert (cmd.stator_rotor_angle_1, cmd.stator_rotor_angle_2,
+            cmd.stator_rotor_angle_3) == (10, -20, 30)
+    assert cmd.current == 0x1234
+    assert (cmd.imu_temperature, cmd.frame_imu_temperature) == (-30, 40)
+    assert (cmd.motor_out_1, cmd.motor_out_2, cmd.motor_out_3) == (1, 2, -1)
+
+
+def test_realtime_data_custom_protocol_payload():
+    flags = (RealtimeDataField.imu_angles | RealtimeDataField.target_angles
+             | RealtimeDataField.stator_rotor_angle)
+    payload = bytes.fromhex('1027'  # TIMESTAMP_MS 10000
+                            '0100 0200 0300'  # IMU angles
+                            'ffff feff fdff'  # target angles
+                            '6400 c8ff 2c01')  # stator/rotor angles
+    cmd = parse_cmd(RawCmd(CMD_REALTIME_DATA_CUSTOM, payload))
+    assert cmd.timestamp_ms == 10000
+    assert decode_realtime_data_custom(cmd, flags) == {
+        'imu_angles': (1, 2, 3), 'target_angles': (-1, -2, -3),
+        'stator_rotor_angle': (100, -56, 300)}
+
+
+def test_spec_to_format_rejects_variable_length():
+    with pytest.raises(ValueError):
+        spec_to_format('NAME string')
+
+
+@pytest.mark.parametrize('payload, data', [
+    (bytes([CMD_CONTROL]), None),
+    (bytes([CMD_CONTROL, 0x12]), 0x12),
+    (bytes([CMD_CONTROL, 0x34, 0x12]), 0x1234),
+])
+def test_confirm(payload, data):
+    assert parse_cmd(RawCmd(CMD_CONFIRM, payload)) == \
+        ConfirmInCmd(cmd_id=CMD_CONTROL, data=data)
+
+
+def test_read_params_ext3():
+    data = bytes(range(50))
+    cmd = parse_cmd(RawCmd(CMD_READ_PARAMS_EXT3, bytes([2]) + data))
+    assert cmd == ReadParamsExt3InCmd(profile_id=2, data=data)
+
+
+def test_debug_vars_round_trip():
+    variables = [('cycle_time', 3, 'H', 1234), ('error', 4, 'h', -5),
+                 ('speed', 7, 'f', 2.5), ('flags', 0x11, 'B', 200)]
+    info_payload = bytes([len(variables)])
+    for name, var_type, _, _ in variables:
+        info_payload += bytes([len(name)]) + name.encode('ascii') + \
+            bytes([var_type]) + b'\x00\x00'
+    info = parse_cmd(RawCmd(CMD_DEBUG_VARS_INFO_3, info_payload))
+    assert info.vars_num == len(variables)
+    assert [debug_var.var_name for debug_var in info.vars] == \
+        [name for name, _, _, _ in variables]
+
+    values_payload = struct.pack(
+        '<' + ''.join(value_format for _, _, value_format, _ in variables),
+        *(value for _, _, _, value in variables))
+    cmd = parse_cmd(RawCmd(CMD_DEBUG_VARS_3, values_payload))
+    assert decode_debug_vars(cmd, info) == \
+        {name: value for name, _, _, value in variables}
+
+
+@pytest.mark.parametrize('flags', [
+    1 << 0,
+    (1 << 0) | (1 << 1),
+    (1 << 3) | (1 << 6) | (1 << 8),
+    sum(1 << bit for bit, _, _ in REALTIME_DATA_CUSTOM_FIELDS),
+])
+def test_realtime_data_custom_round_trip(flags):
+    fields = [(name, spec) for bit, name, spec in REALTIME_DATA_CUSTOM_FIELDS
+              if flags & (1 << bit)]
+    spec = ' '.join(spec for _, spec in fields)
+    values = sample_values(spec)
+    payload = struct.pack('<H', 4321) + \
+        struct.pack(spec_to_format(spec), *values)
+    cmd = parse_cmd(RawCmd(CMD_REALTIME_DATA_CUSTOM, payload))
+    assert cmd.timestamp_ms == 4321
+
+    expected = {}
+    for name, field_spec in fields:
+        count = len(field_spec.split()) // 2
+        expected[name], values = tuple(values[:count]), values[count:]
+    assert RealtimeDataCustomDecoder(flags).decode(cmd) == expected
+    assert decode_realtime_data_custom(cmd, flags) == expected
+
+
+def test_realtime_data_custom_rejects_unsupported_flags():
+    with pytest.raises(ValueError):
+        RealtimeDataCustomDecoder((1 << 0) | (1 << 12))
@@ -0,0 +1,34 @@
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+np = pytest.importorskip('numpy')
+
+from gascamera.geometry import Calibration, build_cell_table
+from gascamera.mosaic import MosaicBuilder
+
+SHIFT = (6, 4) # pixels, residual pointing error of the gimbal
+
+
+@pytest.fixture
+def neutral_image():
+    rng = np.random.default_rng(0)
+    noise = (rng.random((320, 480, 3)) * 255).astype(np.uint8)
+    return cv2.GaussianBlur(noise, (0, 0), 2)
+
+
+def shifted_frame(neutral_image, cell):
+    """Returns the frame at the cell, with the cell content SHIFT away from the source ROI."""
+    dx = cell.source.x - cell.destination.x + SHIFT[0]
+    dy = cell.source.y - cell.destination.y + SHIFT[1]
+    return np.roll(neutral_image, (dy, dx), axis=(0, 1))
+
+
+def test_orb_recovers_shift(neutral_image):
+    # the sweep geometry of virtual_gas_camera.py, cells of about 32x21 pixels
+    calibration = Calibration.from_fov(480, 320, 22.7, 18.0)
+    cells = [cell for cell in build_cell_table(calibration, 15, 15)
+             if 0 < cell.x_step < 14 and 0 < cell.y_step < 14]
+    builder = MosaicBuilder(neutral_image, 'orb')
+    for cell in cells:
+        offset = builder.register(shifted_frame(neutral_image, cell), cell)
+        assert offset == pytest.approx(SHIFT, abs=1)
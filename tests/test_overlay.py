@@ -0,0 +1,15 @@
+import pytest
+
+pytest.importorskip('cv2')
+
+from gascamera.geometry import Roi
+from gascamera.overlay import LiveOverlay
+
+
+def test_live_overlay_skips_nan():
+    overlay = LiveOverlay(30, 10)
+    overlay.update_cell(Roi(0, 0, 10, 10), 1.0)
+    overlay.update_cell(Roi(10, 0, 10, 10), float('nan'))
+    overlay.update_cell(Roi(20, 0, 10, 10), 3.0)
+    assert not overlay._mask[:, 10:20].any()
+    assert overlay._mask[:, :10].all() and overlay._mask[:, 20:].all()
@@ -0,0 +1,60 @@
+from types import SimpleNamespace
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from gascamera.camera import DEGREE_FACTOR, VirtualGasCamera
+from gascamera.rays import experiment_rays, ray_directions
+
+CELL_ANGLES = [[[-10.0, -5.0], [10.0, -5.0]],
+               [[-10.0, 5.0], [10.0, 5.0]]] # yaw, pitch per cell, relative to the frame
+
+
+class FrameAnglesGimbal:
+    """Gimbal settled at yaw, pitch (degrees) relative to the frame."""
+
+    def __init__(self, yaw, pitch):
+        self.raw = (0, round(pitch / DEGREE_FACTOR), round(yaw / DEGREE_FACTOR))
+
+    def get_realtime_data(self):
+        return {'stator_rotor_angle': self.raw, 'imu_angles': (0, 0, 9000),
+                'target_angles': (0, 0, 0)}
+
+
+def experiment(**data):
+    return dict(column_densities_median=[[1.0, 2.0], [3.0, 4.0]],
+                cell_angles=CELL_ANGLES, **data)
+
+
+def test_ray_directions_convention():
+    # yaw zero points along the heading, positive yaw turns clockwise and
+    # positive pitch points down
+    assert ray_directions(0, 0) == pytest.approx([0, 1, 0])
+    assert ray_directions(90, 0) == pytest.approx([1, 0, 0])
+    assert ray_directions(0, 0, heading=90) == pytest.approx([1, 0, 0])
+    assert ray_directions(0, 30)[2] < 0
+
+
+def test_gimbal_angles_match_cell_angles():
+    gimbal_angles = []
+    for row in CELL_ANGLES:
+        gimbal_angles.append([])
+        for yaw, pitch in row:
+            camera = SimpleNamespace(gimbal=FrameAnglesGimbal(yaw, pitch))
+            gimbal_angles[-1].append(list(VirtualGasCamera.read_gimbal_angles(camera)))
+    rays = experiment_rays(experiment(cell_gimbal_angles=gimbal_angles,
+                                      cell_gimbal_angles_reference='frame'))
+    expected = experiment_rays(experiment())
+    assert rays['direction'] == pytest.approx(expected['direction'], abs=1e-3)
+    # the upper row (negative pitch) looks up, the left column to the west
+    assert (rays['direction'][:2, 2] > 0).all()
+    assert (rays['direction'][::2, 0] < 0).all()
+
+
+def test_imu_gimbal_angles_are_ignored():
+    # earlier experiments stored the IMU angles, their yaw zero is unknown
+    imu_angles = [[[0.0, 0.0, 170.0]] * 2] * 2
+    rays = experiment_rays(experiment(cell_gimbal_angles=imu_angles))
+    assert rays['direction'] == \
+        pytest.approx(experiment_rays(experiment())['direction'])
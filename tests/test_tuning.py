@@ -0,0 +1,35 @@
+import json
+
+import pytest
+
+pytest.importorskip('numpy')
+
+from gascamera.tuning import PROFILE_KEYS, load_telemetry, recommend_threshold
+
+SETTLE_SETTINGS = dict(zip(PROFILE_KEYS, (0.1, 0.01, 2.0, 0.05)))
+
+
+def cell(residual, settle_scale=None):
+    entry = {'angle_errors': [[0.01, 1.0], [0.02, residual]],
+             'frame_diffs': [[0.05, 5.0], [0.1, 1.0]], 'error_codes': [],
+             'subsample_std': 1.0}
+    if settle_scale is not None:
+        entry['settle_scale'] = settle_scale
+    return entry
+
+
+def test_load_telemetry_skips_scaled_cells(tmp_path):
+    path = tmp_path / 'experiment.json'
+    cells = [cell(0.05), cell(0.02, 0.5), cell(0.08, 1.0)]
+    path.write_text(json.dumps({'settle_settings': SETTLE_SETTINGS,
+                                'cell_telemetry': cells}))
+    [(settings, loaded)] = load_telemetry([str(path)])
+    assert settings.angle_settle_threshold == 0.1
+    assert loaded == [cells[0], cells[2]]
+
+
+def test_recommend_threshold_stays_within_data():
+    # quality does not depend on the residual, so only the data limits it
+    cells = [cell(residual) for residual in (0.02, 0.04, 0.06)]
+    threshold = recommend_threshold(cells, 'angle_errors', 0.1)
+    assert threshold == pytest.approx(0.06)
@@ -0,0 +1,41 @@
+# Copyright (c) 2023 Bundesanstalt für Materialforschung und -prüfung, see LICENSE file
+# Recommends settle thresholds and delays from the telemetry of past experiments and writes them as a settle profile.
+# Example: python ./tune_settling.py ./campaign_2024/ --output settle_profile.json
+
+import argparse
+import logging
+
+import gascamera.tuning
+from reprocess_experiments import find_experiment_files
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune the settle thresholds of the virtual gas camera from recorded sweeps.")
+    parser.add_argument("patterns", nargs="+", help="experiment directories or glob patterns of experiment JSON files")
+    parser.add_argument("--output", default="settle_profile.json", help="settle profile to write (default: settle_profile.json)")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="allowed relative increase of the subsample standard deviation (default: 0.1)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    files = find_experiment_files(args.patterns)
+    experiments = gascamera.tuning.load_telemetry(files)
+    logger.info(f"found {len(experiments)} experiments with settle telemetry in {len(files)} files")
+    if not experiments:
+        logger.error("no experiments to tune from")
+        return
+
+    profile, tuning = gascamera.tuning.tune(experiments, args.tolerance)
+    for key, value in profile._asdict().items():
+        logger.info(f"{key}: {value:.4f}")
+    logger.info(f"settle time of all cells: {tuning['recorded_settle_time']:.1f} s recorded, "
+                f"{tuning['predicted_settle_time']:.1f} s predicted")
+    gascamera.tuning.save_profile(profile, args.output, tuning)
+    logger.info(f"settle profile written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
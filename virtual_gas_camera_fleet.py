@@ -0,0 +1,58 @@
+# Copyright (c) 2023 Bundesanstalt für Materialforschung und -prüfung, see LICENSE file
+# Runs several camera rigs of one host in parallel, each sweeping its own sector of the scene, and stitches the results.
+# Example: python ./virtual_gas_camera_fleet.py --output fleet
+
+import argparse
+import json
+import logging
+from datetime import datetime
+
+import numpy as np
+
+import gascamera.camera
+import gascamera.fleet
+import gascamera.stream
+
+logger = logging.getLogger(__name__)
+
+SCENE_YAW = 45.0 # degrees, scene covered by all rigs together
+SCENE_PITCH = 18.0 # degrees
+
+# per rig: name, gas sensors, gimbal port, capture device and stream port, all different for every rig
+RIGS = [
+    ("rig1", (("laserfalcon", "/dev/ttyUSB1", 0.0, 0.0),), "/dev/ttyUSB0", 0, 5000),
+    ("rig2", (("laserfalcon", "/dev/ttyUSB3", 0.0, 0.0),), "/dev/ttyUSB2", 1, 5001),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run several virtual gas camera rigs in parallel and stitch their density maps.")
+    parser.add_argument("--output", default="fleet", help="prefix of the stitched map files (default: fleet)")
+    parser.add_argument("--threads", action="store_true", help="run the rigs in threads instead of processes")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    centers = gascamera.fleet.split_sectors(SCENE_YAW, SCENE_PITCH, len(RIGS))
+    configs = [gascamera.camera.CameraConfig(
+                   name=name, sensors=sensors, gimbal_port=gimbal_port, capture_device=capture_device,
+                   stream=gascamera.stream.StreamConfig(sinks=(gascamera.stream.StreamSink("tcp", port=port),)),
+                   center_yaw=center_yaw, center_pitch=center_pitch, calibration_file=f"calibration_{name}.json")
+               for (name, sensors, gimbal_port, capture_device, port), (center_yaw, center_pitch) in zip(RIGS, centers)]
+    for config in configs:
+        logger.info(f"{config.name}: sector center yaw {config.center_yaw:.2f} deg, pitch {config.center_pitch:.2f} deg")
+
+    experiments = gascamera.fleet.run_fleet(configs, processes=not args.threads)
+    density_map, extent = gascamera.fleet.stitch(experiments)
+
+    identifier = f"{args.output}_{datetime.now().strftime('%Y-%m-%dT%H.%M.%S')}"
+    np.save(f"{identifier}_stitched.npy", density_map)
+    with open(f"{identifier}.json", 'w') as jsonfile:
+        json.dump({"rigs": [config.name for config in configs], "extent": extent,
+                   "failed_rigs": [config.name for config, experiment in zip(configs, experiments) if experiment is None]},
+                  jsonfile, indent=2)
+    logger.info(f"stitched map written to {identifier}_stitched.npy")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# Copyright (c) 2023 Bundesanstalt für Materialforschung und -prüfung, see LICENSE file
+# Panorama mode of the virtual gas camera: sweeps a scene wider than the camera field of view block by block.
+# Uses the rig configuration of virtual_gas_camera.py.
+# Example: python ./virtual_gas_camera_panorama.py 90 36 --overlap 0.1
+
+import argparse
+import logging
+import os
+from datetime import datetime
+
+import gascamera.camera
+import gascamera.export
+import gascamera.overlay
+import gascamera.panorama
+import gascamera.tiles
+from virtual_gas_camera import CONFIG
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep a panorama of several camera field of view blocks and stitch it.")
+    parser.add_argument("scene_yaw", type=float, help="horizontal extent of the scene in degrees")
+    parser.add_argument("scene_pitch", type=float, help="vertical extent of the scene in degrees")
+    parser.add_argument("--overlap", type=float, default=0.0, help="fraction of the field of view shared by neighbouring blocks (default: 0)")
+    parser.add_argument("--no-wait", action="store_true", help="start right away instead of waiting for enter")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    identifier = datetime.now().strftime('%Y-%m-%dT%H.%M.%S')
+    directory = os.path.join(CONFIG.output_dir, f"{identifier}_panorama")
+    os.makedirs(directory)
+
+    blocks = gascamera.panorama.plan_blocks(args.scene_yaw, args.scene_pitch, CONFIG.fov_yaw, CONFIG.fov_pitch, args.overlap,
+                                            CONFIG.center_yaw, CONFIG.center_pitch, CONFIG.center_yaw, CONFIG.center_pitch)
+    logger.info(f"panorama of {len(blocks)} blocks, gimbal travel between blocks "
+                f"{gascamera.panorama.travel(blocks, CONFIG.center_yaw, CONFIG.center_pitch):.1f} deg")
+
+    camera = gascamera.camera.VirtualGasCamera(CONFIG)
+    camera.open()
+    try:
+        if not args.no_wait:
+            camera.wait_for_start()
+        canvas = gascamera.panorama.PanoramaCanvas(blocks, camera.frame_width, camera.frame_height, CONFIG.fov_yaw,
+                                                   CONFIG.fov_pitch, CONFIG.x_steps, CONFIG.y_steps, directory)
+        panorama = gascamera.panorama.run_panorama(camera, blocks, canvas)
+    finally:
+        camera.close()
+
+    with gascamera.export.Exporter(CONFIG.export_image_format, CONFIG.export_compression) as exporter:
+        exporter.write_json(os.path.join(directory, "panorama.json"), panorama)
+        if isinstance(canvas.image, gascamera.tiles.TiledImageStore):
+            # tiled canvases are already on disk, add pyramid levels and overlay tiles and export the previews
+            canvas.image.build_pyramid()
+            exporter.write_image(os.path.join(directory, "panorama_assembled_preview"), canvas.image.preview())
+            overlay = gascamera.overlay.create_tiled_overlay(canvas.image, canvas.block_densities(), canvas.frame_width, canvas.frame_height,
+                                                             os.path.join(directory, "panorama_overlay_median"), CONFIG.overlay_reconstruction)
+            overlay.build_pyramid()
+            exporter.write_image(os.path.join(directory, "panorama_overlay_median_preview"), overlay.preview())
+        else:
+            exporter.write_image(os.path.join(directory, "panorama_assembled"), canvas.image)
+            # every block's cells are painted over its own image region, later blocks win like in the image
+            exporter.write_image(os.path.join(directory, "panorama_overlay_median"),
+                                 gascamera.overlay.create_block_overlay(canvas.image, canvas.block_densities(), canvas.frame_width,
+                                                                        canvas.frame_height, CONFIG.overlay_reconstruction))
+        for filename in exporter.wait():
+            logger.info(f"written {filename}")
+
+
+if __name__ == "__main__":
+    main()